@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Test the batch submission manager against a fake backend.
+"""
+import os
+import sys
+from os.path import join
+import subprocess
+import tempfile
+import shutil
+import time
+
+from ugali.utils.batch import Batch, Manager, Pool, _run_job
+
+class FakeBatch(Batch):
+    def __init__(self, **kwargs):
+        super(FakeBatch,self).__init__(**kwargs)
+        self.queries = 0
+        self.submitted = []
+        self.arrays = []
+
+    def njobs(self):
+        self.queries += 1
+        return 0
+
+    def submit(self, command, jobname=None, logfile=None, **opts):
+        self.submitted.append(command)
+        return command
+
+    def submit_array(self, commands, jobname=None, logfiles=None, arrayfile=None, **opts):
+        self.arrays.append(commands)
+        return ['array %s'%arrayfile]
+
+def test_cached_njobs():
+    batch = FakeBatch()
+    manager = Manager(batch,max_jobs=10,interval=1e3)
+    for i in range(5): manager.njobs()
+    assert batch.queries == 1
+
+def test_array_flush():
+    batch = FakeBatch()
+    manager = Manager(batch,max_jobs=10,interval=0)
+    for i in range(25): 
+        manager.submit('echo %i'%i,'job','log_%i'%i,outputs=['out_%i'%i])
+    manager.flush('array.txt')
+    assert [len(a) for a in batch.arrays] == [10,10,5]
+    assert not batch.submitted
+    assert len(manager.outputs) == 25
+    assert not manager.done()
+
+    # Without arrays, one submission per command
+    manager = Manager(batch,max_jobs=None,array=False)
+    for i in range(3): manager.submit('echo %i'%i)
+    manager.flush('array.txt')
+    assert len(batch.submitted) == 3
+
+def test_write_array():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        arrayfile = join(tmpdir,'array.txt')
+        commands = ['echo %i'%i for i in range(3)]
+        logfiles = [join(tmpdir,'log_%i'%i) for i in range(3)]
+        driver = Batch().write_array(arrayfile,commands,logfiles,index='INDEX')
+        env = dict(os.environ,INDEX='2')
+        subprocess.check_call('sh %s'%driver,shell=True,env=env)
+        assert open(logfiles[1]).read().strip() == '1'
+        assert not os.path.exists(logfiles[0])
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_run_job_argv():
+    tmpdir = tempfile.mkdtemp()
+    argv = list(sys.argv)
+    try:
+        script = join(tmpdir,'job.py')
+        open(script,'w').write('import sys\nsys.exit(len(sys.argv))\n')
+        assert _run_job('python %s a b'%script,join(tmpdir,'job.log')) == 3
+        assert sys.argv == argv
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_pool_throttle():
+    pool = Pool(processes=2)
+    start = time.time()
+    pool.submit('sleep 5')
+    pool.submit('false')
+    # Returns once the short job is done, not the first one
+    pool.throttle(2)
+    assert time.time() - start < 4
+    assert pool.join() == ['false']
+    assert pool.join() == []
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Test the batched kernel evaluation against the scalar pdf.
+"""
+import numpy as np
+
+from ugali.analysis.kernel import factory
+
+def check_pdf_batch(kernel, **kwargs):
+    lon = np.random.uniform(44.5,45.5,500)
+    lat = np.random.uniform(44.5,45.5,500)
+    pdf = kernel.pdf_batch(lon,lat,**kwargs)
+
+    n = len(kwargs.values()[0])
+    assert pdf.shape == (n,len(lon))
+    for i in range(n):
+        for k,v in kwargs.items(): kernel.setp(k,v[i])
+        np.testing.assert_allclose(pdf[i],kernel.pdf(lon,lat),rtol=1e-6)
+
+def test_radial():
+    np.random.seed(0)
+    kernel = factory('RadialPlummer',lon=45,lat=45,extension=0.1)
+    check_pdf_batch(kernel,
+                    lon=[45.0,45.1,44.9],
+                    lat=[45.0,44.95,45.05],
+                    extension=[0.05,0.1,0.2])
+
+def test_elliptical():
+    np.random.seed(0)
+    kernel = factory('EllipticalPlummer',lon=45,lat=45,extension=0.1)
+    check_pdf_batch(kernel,
+                    lon=[45.0,45.1],
+                    extension=[0.1,0.15],
+                    ellipticity=[0.3,0.5],
+                    position_angle=[30.,120.])
+
+if __name__ == "__main__":
+    test_radial()
+    test_elliptical()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Test the job scheduler with the local batch backend.
+"""
+import os
+from os.path import join, exists
+import tempfile
+import shutil
+
+from ugali.utils.batch import Batch, Local
+from ugali.utils.scheduler import Scheduler, DONE, FAILED, CANCELLED
+
+def test_scheduler():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        a = join(tmpdir,'a.txt')
+        b = join(tmpdir,'b.txt')
+        flaky = join(tmpdir,'flaky.txt')
+
+        sched = Scheduler(Local(),statusdir=tmpdir,retries=1,backoff=0,poll=0)
+        sched.add('a','touch %s'%a,outputs=[a])
+        sched.add('b','cat %s > %s'%(a,b),outputs=[b],depends=['a'])
+        # Fails on the first attempt and succeeds on the retry
+        sched.add('flaky','test -e %s || (touch %s; false)'%(flaky,flaky))
+        sched.add('fail','false',retries=2)
+        sched.add('child','touch %s'%join(tmpdir,'child.txt'),depends=['fail'])
+        states = sched.run()
+
+        assert exists(b)
+        assert states['a'] == DONE and states['b'] == DONE
+        assert states['flaky'] == DONE 
+        assert sched.jobs['flaky'].attempts == 2
+        assert states['fail'] == FAILED 
+        assert sched.jobs['fail'].attempts == 3
+        assert states['child'] == CANCELLED
+        assert not exists(join(tmpdir,'child.txt'))
+
+        # Existing outputs are not rerun
+        sched = Scheduler(Local(),statusdir=tmpdir,poll=0)
+        sched.add('a','false',outputs=[a])
+        assert sched.run()['a'] == DONE
+        assert sched.jobs['a'].attempts == 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+class LostBatch(Batch):
+    """ Jobs vanish without running (e.g., killed by the batch system). """
+    def __init__(self, queued=[], **kwargs):
+        super(LostBatch,self).__init__(**kwargs)
+        self.queued = list(queued)
+        self.submitted = []
+        self.killed = []
+
+    def jobnames(self):
+        return set(self.queued)
+
+    def kill(self, jobname):
+        self.killed.append(jobname)
+
+    def submit(self, command, jobname=None, logfile=None, **opts):
+        self.submitted.append(command)
+        return command
+
+def test_lost_jobs():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # Gone from the queue without a status file
+        # (other jobs of the user are still queued)
+        batch = LostBatch(queued=['other'])
+        sched = Scheduler(batch,statusdir=tmpdir,retries=1,backoff=0,poll=0,grace=0)
+        sched.add('lost','true')
+        assert sched.run()['lost'] == FAILED
+        assert len(batch.submitted) == 2
+        assert not batch.killed
+
+        # Still queued, but past its timeout; killed before each retry
+        batch = LostBatch(queued=['stuck'])
+        sched = Scheduler(batch,statusdir=tmpdir,retries=1,backoff=0,poll=0,timeout=0)
+        sched.add('stuck','true')
+        assert sched.run()['stuck'] == FAILED
+        assert len(batch.submitted) == 2
+        assert batch.killed == ['stuck','stuck']
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_scheduler()
+    test_lost_jobs()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Test the labelling of the sparse HEALPix TS map.
+"""
+import numpy as np
+import healpy
+
+from ugali.analysis.search import CandidateSearch
+from ugali.utils.binning import reverseHistogram
+from ugali.utils.projector import Projector
+from ugali.utils.healpix import pix2ang
+
+NSIDE = 32
+
+def dilate_and_label(pixels, values, nside, threshold=0):
+    """
+    Reference labelling with the semantics of the former Mollweide
+    version: binary dilation by one step (full structure in pixel and
+    distance), labelling of the dilated set, and trimming back to the
+    pixels above threshold. Returns the groups of (pix, z) entries.
+    """
+    nz = values.shape[1]
+    def neighbours(pix, z):
+        out = []
+        for p in [pix] + list(healpy.get_all_neighbours(nside,pix)):
+            if p < 0: continue
+            for zz in [z-1,z,z+1]:
+                if 0 <= zz < nz: out.append((int(p),zz))
+        return out
+
+    seeds = set((int(pixels[i]),z) for i,z in zip(*np.nonzero(values > threshold)))
+    dilated = set()
+    for p,z in seeds: dilated.update(neighbours(p,z))
+
+    groups,visited = [],set()
+    for start in sorted(dilated):
+        if start in visited: continue
+        stack,group = [start],set()
+        visited.add(start)
+        while stack:
+            node = stack.pop()
+            if node in seeds: group.add(node)
+            for other in neighbours(*node):
+                if other in dilated and other not in visited:
+                    visited.add(other)
+                    stack.append(other)
+        groups.append(sorted(group))
+    return sorted(groups)
+
+def test_gapped_labels():
+    # Consecutive pixels along the equatorial ring are neighbours
+    p0 = healpy.ang2pix(NSIDE,np.pi/2,0.)
+    pixels = np.arange(p0-10,p0+30)
+    values = np.zeros((len(pixels),6))
+    select = lambda p: np.nonzero(pixels == p0+p)[0][0]
+
+    # A region with a one-pixel gap, and a separate region
+    for p in [0,1,3,4]: values[select(p),1] = 10
+    for p in [12,13]:   values[select(p),1] = 10
+    # A gap of one distance slice, and a gap of three slices
+    values[select(20),0] = values[select(20),2] = 10
+    values[select(25),0] = values[select(25),4] = 10
+
+    labels,nlabels = CandidateSearch.labelHealpix(pixels,values,NSIDE,threshold=5)
+    assert nlabels == 5
+    assert len(np.unique([labels[select(p),1] for p in [0,1,3,4]])) == 1
+    assert labels[select(0),1] != labels[select(12),1]
+    assert labels[select(20),0] == labels[select(20),2]
+    assert labels[select(25),0] != labels[select(25),4]
+    assert np.all(labels[values <= 5] == 0)
+
+    # Same partition as the dilate-then-label reference
+    groups = [sorted((int(pixels[i]),z) for i,z in zip(*np.nonzero(labels == l)))
+              for l in range(1,nlabels+1)]
+    assert sorted(groups) == dilate_and_label(pixels,values,NSIDE,threshold=5)
+
+def find_objects_loop(pixels, values, nside, zvalues, rev, good):
+    """
+    Reference characterization with the former per-object loop.
+    """
+    objs = np.recarray((len(good),),dtype=CandidateSearch.findObjects(
+            pixels,values,nside,zvalues,rev,[]).dtype)
+    objs['CUT'][:] = 0
+    ncol = values.shape[1]
+    for i in range(len(good)):
+        indices = rev[rev[good[i]]:rev[good[i]+1]]
+        idx = indices // ncol; zidx = indices % ncol
+        pix = pixels[idx]
+        xval,yval = pix2ang(nside, pix)
+        zval = zvalues[zidx]
+        island = values[idx,zidx]
+        imax = island.argmax()
+        objs[i]['LABEL'] = good[i]
+        objs[i]['NPIX'] = len(indices)
+        objs[i]['VAL_MAX'] = island[imax]
+        objs[i]['IDX_MAX'] = idx[imax]
+        objs[i]['ZIDX_MAX'] = zidx[imax]
+        objs[i]['PIX_MAX'] = pix[imax]
+        objs[i]['X_MAX'] = xval[imax]
+        objs[i]['Y_MAX'] = yval[imax]
+        objs[i]['Z_MAX'] = zval[imax]
+
+        proj = Projector(xval[imax],yval[imax])
+        xpix,ypix = proj.sphereToImage(xval,yval)
+        x_cent,y_cent,z_cent = np.average([xpix,ypix,zval],axis=1)
+        objs[i]['X_CENT'],objs[i]['Y_CENT'] = proj.imageToSphere(x_cent,y_cent)
+        objs[i]['Z_CENT'] = z_cent
+        weights = [island,island,island]
+        x_bary,y_bary,z_bary = np.average([xpix,ypix,zval],weights=weights,axis=1)
+        objs[i]['X_BARY'],objs[i]['Y_BARY'] = proj.imageToSphere(x_bary,y_bary)
+        objs[i]['Z_BARY'] = z_bary
+    return objs
+
+def test_find_objects():
+    np.random.seed(0)
+    # Objects straddling lon = 0, near the north pole, near the south
+    # pole and at an arbitrary position (deg)
+    centers = [(0.,0.),(45.,89.),(300.,-88.5),(150.,20.)]
+    discs = [healpy.query_disc(NSIDE,healpy.ang2vec(np.radians(90.-lat),np.radians(lon)),
+                               np.radians(4.)) for lon,lat in centers]
+    pixels = np.unique(np.concatenate(discs))
+    zvalues = np.linspace(16,24,5)
+    values = np.zeros((len(pixels),len(zvalues)))
+    labels = np.zeros(values.shape,dtype=int)
+    for i,disc in enumerate(discs):
+        idx = np.searchsorted(pixels,disc)
+        zidx = np.arange(i,i+2) % len(zvalues)
+        values[idx[:,np.newaxis],zidx] = np.random.uniform(5,10,(len(idx),len(zidx)))
+        labels[idx[:,np.newaxis],zidx] = i+1
+
+    # A tie in the maximum of the first object
+    idx = np.searchsorted(pixels,discs[0])
+    values[idx[3],0] = values[idx[-2],1] = 20.
+
+    hist,edges,rev = reverseHistogram(labels,bins=np.arange(len(discs)+2))
+    good = np.arange(1,len(discs)+1)
+    kwargs = dict(pixels=pixels,values=values,nside=NSIDE,zvalues=zvalues,rev=rev,good=good)
+    objs = CandidateSearch.findObjects(**kwargs)
+    ref = find_objects_loop(**kwargs)
+
+    assert objs.dtype == ref.dtype
+    for name in ['LABEL','NPIX','VAL_MAX','IDX_MAX','ZIDX_MAX','PIX_MAX','CUT',
+                 'X_MAX','Y_MAX','Z_MAX','Z_CENT','Z_BARY']:
+        np.testing.assert_array_equal(objs[name],ref[name],err_msg=name)
+    assert objs['VAL_MAX'][0] == 20.
+
+    # Projected positions agree to float32 precision (longitude wrapped)
+    for x,y in [('X_CENT','Y_CENT'),('X_BARY','Y_BARY')]:
+        dlon = (objs[x].astype(float) - ref[x] + 180.) % 360. - 180.
+        np.testing.assert_allclose(dlon,0,atol=1e-4,err_msg=x)
+        np.testing.assert_allclose(objs[y],ref[y],rtol=0,atol=1e-4,err_msg=y)
+
+if __name__ == "__main__":
+    test_gapped_labels()
+    test_find_objects()
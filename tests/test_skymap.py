@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Test the sparse HEALPix map against full-sky arrays.
+"""
+import os
+import tempfile
+import shutil
+
+import numpy as np
+import healpy
+
+from ugali.utils.skymap import SparseHealpixMap
+from ugali.utils.skymap import LikelihoodMerger, writeCompactHealpixMap
+from ugali.utils.skymap import writeSparseHealpixMap, mergeSparseHealpixMaps
+
+NSIDE = 16
+
+def full_sky():
+    m = healpy.UNSEEN * np.ones(healpy.nside2npix(NSIDE))
+    pix = np.arange(100,400)
+    m[pix] = np.linspace(20,24,len(pix))
+    return m
+
+def test_get_set():
+    m = full_sky()
+    sparse = SparseHealpixMap.fromMap(m)
+    assert len(sparse.pix) == 300
+    pix = np.arange(len(m))
+    np.testing.assert_equal(sparse[pix],m)
+    assert sparse[5] == healpy.UNSEEN
+
+    sparse[[5,150]] = 1.0
+    m[[5,150]] = 1.0
+    np.testing.assert_equal(sparse.map(),m)
+
+def test_ud_grade():
+    m = full_sky()
+    sparse = SparseHealpixMap.fromMap(m)
+    for nside in [4,8,32]:
+        np.testing.assert_allclose(sparse.ud_grade(nside).map(),
+                                   healpy.ud_grade(m,nside))
+
+def test_arithmetic():
+    m = full_sky()
+    a = SparseHealpixMap.fromMap(m)
+    b = 2*a - 1
+    np.testing.assert_allclose(b.values,2*a.values - 1)
+    c = a + SparseHealpixMap(NSIDE,[100,101,0],[1,1,1])
+    np.testing.assert_equal(c.pix,[100,101])
+    np.testing.assert_allclose(c.values,a[[100,101]] + 1)
+
+def test_fits():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir,'sparse.fits')
+        sparse = SparseHealpixMap.fromMap(full_sky())
+        sparse.write(filename,'MAGLIM')
+        other = SparseHealpixMap.read(filename,'MAGLIM')
+        assert other.nside == NSIDE
+        np.testing.assert_equal(other.pix,sparse.pix)
+        np.testing.assert_allclose(other.values,sparse.values,rtol=1e-6)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def write_likelihood(filename, lkdpix, value):
+    pix = np.arange(4*lkdpix,4*lkdpix+4)
+    header = dict(LKDNSIDE=NSIDE//2,LKDPIX=lkdpix,STELLAR=1.,NINSIDE=1,NANNULUS=1)
+    writeCompactHealpixMap(pix,dict(TS=value*np.ones(len(pix))),NSIDE,filename,
+                           distance_modulus_array=np.array([18.,19.]),
+                           header_dict=header)
+
+def test_merger_changed():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        infiles = [os.path.join(tmpdir,'likelihood_%i.npz'%i) for i in range(2)]
+        for i,f in enumerate(infiles): write_likelihood(f,i,1.0)
+        merger = LikelihoodMerger(os.path.join(tmpdir,'merge'))
+        assert merger.add(infiles) == 2
+        assert merger.add(infiles) == 0
+        assert not os.path.exists(infiles[0]+'.tmp')
+
+        # A rewritten file supersedes its earlier rows
+        write_likelihood(infiles[0],0,2.0)
+        os.utime(infiles[0],(0,0))
+        merger = LikelihoodMerger(os.path.join(tmpdir,'merge'))
+        assert merger.add(infiles) == 1
+        rows = merger._rows()
+        np.testing.assert_equal(np.sort(merger.arrays['PIX'][rows]),np.arange(8))
+        np.testing.assert_equal(merger.arrays['TS'][rows][merger.arrays['PIX'][rows] < 4],2.0)
+        assert len(merger.active) == 2
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_merge_mixed_columns():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # Only the second file has the INTERPOLATED column
+        infiles = [os.path.join(tmpdir,'likelihood_%i.fits'%i) for i in range(2)]
+        moduli = np.array([18.,19.])
+        for i,f in enumerate(infiles):
+            pix = np.arange(4*i,4*i+4)
+            data = dict(TS=(i+1)*np.ones((len(pix),2)))
+            if i: data['INTERPOLATED'] = np.ones((len(pix),2))
+            writeSparseHealpixMap(pix,data,NSIDE,f,distance_modulus_array=moduli)
+
+        merged = mergeSparseHealpixMaps(infiles)
+        np.testing.assert_equal(merged['INTERPOLATED'][:,0],[0]*4+[1]*4)
+        np.testing.assert_equal(merged['TS'][:,0],[1]*4+[2]*4)
+
+        outfile = os.path.join(tmpdir,'merged.fits')
+        mergeSparseHealpixMaps(infiles,outfile)
+        interp = SparseHealpixMap.read(outfile,'INTERPOLATED')
+        np.testing.assert_equal(interp.values,merged['INTERPOLATED'])
+
+        # The incremental merge, with the column in the first file only
+        infiles = [os.path.join(tmpdir,'likelihood_%i.npz'%i) for i in range(2)]
+        header = dict(LKDNSIDE=NSIDE//2,LKDPIX=0,STELLAR=1.,NINSIDE=1,NANNULUS=1)
+        writeCompactHealpixMap(np.arange(4),dict(TS=np.ones(4),INTERPOLATED=np.ones(4)),
+                               NSIDE,infiles[0],distance_modulus_array=moduli,
+                               header_dict=header)
+        write_likelihood(infiles[1],1,1.0)
+        merger = LikelihoodMerger(os.path.join(tmpdir,'merge'))
+        assert merger.add(infiles) == 2
+        np.testing.assert_equal(merger.arrays['INTERPOLATED'][:8],[1]*4+[0]*4)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_get_set()
+    test_ud_grade()
+    test_arithmetic()
+    test_fits()
+    test_merger_changed()
+    test_merge_mixed_columns()
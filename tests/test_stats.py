@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+Test the sample statistics.
+"""
+import numpy as np
+
+import ugali.utils.stats
+
+def ar1(phi, nwalkers=32, nsteps=20000):
+    """ Ensemble of AR(1) chains with tau = (1+phi)/(1-phi). """
+    np.random.seed(0)
+    noise = np.random.normal(size=(nwalkers,nsteps))
+    chain = np.zeros_like(noise)
+    for i in range(1,nsteps):
+        chain[:,i] = phi*chain[:,i-1] + noise[:,i]
+    return chain
+
+def test_autocorr_time():
+    phi = 0.9
+    chain = ar1(phi)
+    tau = ugali.utils.stats.autocorr_time(chain)
+    np.testing.assert_allclose(tau,(1+phi)/(1-phi),rtol=0.1)
+
+    # Stronger correlation leaves fewer effective samples
+    ess = [ugali.utils.stats.effective_sample_size(ar1(p)) for p in [0.,0.5,0.9]]
+    assert ess[0] > ess[1] > ess[2]
+
+def test_kde():
+    np.random.seed(0)
+    data = np.concatenate([np.random.normal(0,1,4000),np.random.normal(3,0.5,1000)])
+    samples = 1000
+    peak,density = ugali.utils.stats.kde(data,samples)
+    exact_peak,exact_density = ugali.utils.stats.kde(data,samples,exact=True)
+    step = (data.max()-data.min())/samples
+    assert abs(peak - exact_peak) <= 2*step
+    np.testing.assert_allclose(density,exact_density,rtol=1e-2)
+
+    grid,density = ugali.utils.stats.binned_kde(data)
+    np.testing.assert_allclose(np.trapz(density,grid),1.0,rtol=1e-2)
+
+if __name__ == "__main__":
+    test_autocorr_time()
+    test_kde()
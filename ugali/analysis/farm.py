@@ -17,6 +17,7 @@ import glob
 import numpy
 import numpy as np
 import healpy
+import pyfits
 
 import ugali.utils.config
 import ugali.utils.skymap
@@ -30,9 +31,16 @@ from ugali.utils.shell import mkdir
 
 class Farm:
 
-    def __init__(self, configfile):
+    def __init__(self, configfile, batch=None):
+        """
+        Parameters:
+          configfile : Configuration object or filename
+          batch      : Batch backend to submit through (default: 
+                       created from the queue in `submit`)
+        """
         self.configfile = configfile
         self.config = ugali.utils.config.Config(configfile)
+        self.batch = batch
         self._setup()
 
     def _setup(self):
@@ -57,6 +65,17 @@ class Farm:
         cmd = '%(script)s %(config)s %(outfile)s --hpx %(nside)i %(pix)i'%params
         return cmd
 
+    def command_pixels(self, outfile, configfile, pixels):
+        """
+        Generate the command for scanning a sequence of pixels in a
+        single process (with the observations prefetched).
+        """
+        params = dict(script=self.config['scan']['script'],
+                      config=configfile, outfile=outfile, 
+                      pixels=' '.join('%i'%p for p in pixels))
+        cmd = '%(script)s %(config)s %(outfile)s --pixels %(pixels)s'%params
+        return cmd
+
     # ADW: Should probably be in a utility
     def footprint(self, nside=None):
         """
@@ -73,34 +92,47 @@ class Farm:
         map = self.inFootprint(pix,nside)
         return map 
 
-    # ADW: Should probably be in a utility
     def inFootprint(self, pixels, nside=None):
         """
-        Open each valid filename for the set of pixels and determine the set 
-        of subpixels with valid data.
+        Determine the pixels with valid data (from the cached footprint index).
         """
-        if numpy.isscalar(pixels): pixels = numpy.array([pixels])
-        if nside is None: nside = self.nside_likelihood
-
-        inside = numpy.zeros( len(pixels), dtype='bool')
-        if not self.nside_catalog:
-            catalog_pix = [0]
-        else:
-            catalog_pix = superpixel(pixels,nside,self.nside_catalog)
-            catalog_pix = numpy.intersect1d(catalog_pix,self.catalog_pixels)
-
-        for filenames in self.filenames[catalog_pix]:
-            #logger.debug("Loading %s"%filenames['mask_1'])
-            subpix_1,val_1 = ugali.utils.skymap.readSparseHealpixMap(filenames['mask_1'],'MAGLIM',construct_map=False)
-            #logger.debug("Loading %s"%filenames['mask_2'])
-            subpix_2,val_2 = ugali.utils.skymap.readSparseHealpixMap(filenames['mask_2'],'MAGLIM',construct_map=False)
-            subpix = numpy.intersect1d(subpix_1,subpix_2)
-            superpix = numpy.unique(ugali.utils.skymap.superpixel(subpix,self.nside_pixel,nside))
-            inside |= numpy.in1d(pixels, superpix)
-            
-        return inside
+        return ugali.utils.skymap.inFootprint(self.config,pixels,nside)
         
-    def submit_all(self, coords=None, queue=None, debug=False):
+    def done(self, pixels):
+        """
+        Determine which pixels already have a valid likelihood
+        result. Without 'batch:cache' a pixel is done if its outfile
+        exists. With caching, the scan hash stored in the outfile must
+        also match the hash of the current config and input files. The
+        input files are only checksummed if their size or modification
+        time changed since the outfile was written.
+        """
+        from ugali.analysis.scan import scanHash, statHash, readScanHeader, configHash
+        from ugali.analysis.scan import loadChecksums, saveChecksums
+
+        coordsys = self.config['coords']['coordsys'].lower()
+        outfiles = [self.config.likefile%(p,coordsys) for p in pixels]
+        done = numpy.array([exists(f) for f in outfiles],dtype=bool)
+        if not self.config['batch'].get('cache',False):
+            return done
+
+        outdir = mkdir(self.config['output']['likedir'])
+        checksums = join(outdir,'checksums.json')
+        loadChecksums(checksums)
+        confighash = configHash(self.config)
+        for ii in numpy.nonzero(done)[0]:
+            header = readScanHeader(outfiles[ii])
+            if header.get('STATHASH') == statHash(self.config,pixels[ii],self.filenames,confighash):
+                continue
+            if header.get('SCANHASH') != scanHash(self.config,pixels[ii],self.filenames,confighash):
+                logger.debug("Stale result: %s"%outfiles[ii])
+                done[ii] = False
+        saveChecksums(checksums)
+        logger.info("%i of %i cached results are valid"%(done.sum(),
+                                                         numpy.sum([exists(f) for f in outfiles])))
+        return done
+
+    def submit_all(self, coords=None, queue=None, debug=False, scheduler=None):
         """
         Submit likelihood analyses on a set of coordinates. If
         coords is `None`, submit all coordinates in the footprint.
@@ -109,6 +141,10 @@ class Farm:
         coords : Array of target locations in Galactic coordinates. 
         queue  : Overwrite submit queue.
         debug  : Don't run.
+        scheduler : Add the jobs to this Scheduler instead of submitting
+
+        Returns:
+        jobs   : Names of the jobs added to the scheduler
         """
         if coords is None:
             pixels = numpy.arange(healpy.nside2npix(self.nside_likelihood))
@@ -135,7 +171,7 @@ class Farm:
             logger.warning("Ignoring pixels outside survey footprint:\n"+str(pixels[~inside]))
         if inside.sum() == 0:
             logger.warning("No pixels inside footprint.")
-            return
+            return []
 
         # Only write the configfile once
         outdir = mkdir(self.config['output']['likedir'])
@@ -143,17 +179,24 @@ class Farm:
         self.config.write(configfile)
 
         pixels = pixels[inside]
-        self.submit(pixels,queue=queue,debug=debug,configfile=configfile)
+        return self.submit(pixels,queue=queue,debug=debug,configfile=configfile,
+                           scheduler=scheduler)
 
-    def submit(self, pixels, queue=None, debug=False, configfile=None):
+    def submit(self, pixels, queue=None, debug=False, configfile=None, scheduler=None):
         """
-        Submit the likelihood job for the given pixel(s).
+        Submit the likelihood job for the given pixel(s). With a
+        `scheduler` (ugali.utils.scheduler), the jobs are added to it
+        along with their output files rather than submitted.
+
+        Returns:
+        jobs : Names of the jobs added to the scheduler
         """
         queue = self.config['batch']['cluster'] if queue is None else queue
-        local = (queue == 'local')
+        local = (queue in ['local','pool'])
 
         # Need to develop some way to take command line arguments...
-        self.batch = ugali.utils.batch.batchFactory(queue,**self.config['batch']['opts'])
+        if self.batch is None:
+            self.batch = ugali.utils.batch.batchFactory(queue,**self.config['batch']['opts'])
 
         if numpy.isscalar(pixels): pixels = numpy.array([pixels])
 
@@ -170,9 +213,35 @@ class Farm:
                 configfile = '%s/config_queue.py'%(outdir)
                 self.config.write(configfile)
                 
+        done = self.done(pixels)
+
+        chunk = self.config['batch']['chunk']
+        if chunk and not local and self.config['batch'].get('balance',False):
+            # Pack the remaining pixels into jobs of equal predicted
+            # runtime, longest jobs first
+            todo = numpy.nonzero(~done)[0]
+            njobs = int(numpy.ceil(len(todo)/float(chunk)))
+            groups = [todo[g] for g in CostModel(self.config).pack(pixels[todo],njobs)]
+            order = numpy.concatenate(groups) if groups else todo
+            pixels,done = pixels[order],done[order]
+            ends = numpy.cumsum([len(g) for g in groups]) - 1
+        elif chunk:
+            ends = numpy.append(numpy.arange(chunk-1,len(pixels),chunk),len(pixels)-1)
+        else:
+            ends = []
+        ends = set(ends)
+
         lon,lat = pix2ang(self.nside_likelihood,pixels)
         commands = []
-        chunk = self.config['batch']['chunk']
+        outfiles = []
+        prefetch = self.config['batch'].get('prefetch',False)
+
+        # Buffer submissions into job arrays with cached queue queries
+        manager = None
+        scheduled = []
+        if self.config['batch'].get('array',False) and not local and scheduler is None:
+            manager = ugali.utils.batch.Manager(self.batch,self.config['batch']['max_jobs'],
+                                                interval=self.config['batch'].get('interval',60))
         istart = 0
         logger.info('=== Submit Likelihood ===')
         for ii,pix in enumerate(pixels):
@@ -184,16 +253,17 @@ class Farm:
             jobname = self.config['batch']['jobname']
 
             # Submission command
-            sub = not os.path.exists(outfile)
+            sub = not done[ii]
             cmd = self.command(outfile,configfile,pix)
             commands.append([ii,cmd,lon[ii],lat[ii],sub])
+            if sub: outfiles.append(outfile)
             
             if local or chunk == 0:
                 # Not chunking
                 command = cmd
                 submit = sub
                 logfile = join(logdir,os.path.splitext(outbase)[0]+'.log')
-            elif (len(commands)%chunk==0) or (ii+1 == len(pixels)):
+            elif ii in ends:
                 # End of chunk, create submission script
                 commands = np.array(commands,dtype=object)
                 istart, iend = commands[0][0], commands[-1][0]
@@ -202,28 +272,51 @@ class Farm:
                 command = "sh %s"%subfile
 
                 submit = np.any(commands[:,-1])
-                if submit: self.write_script(subfile,commands)
+                if prefetch:
+                    # Scan the chunk in one process, prefetching inputs
+                    sel = commands[:,-1].astype(bool)
+                    pix = pixels[commands[:,0][sel].astype(int)]
+                    command = self.command_pixels(self.config.likefile,configfile,pix)
+                elif submit: 
+                    self.write_script(subfile,commands)
             else:
                 # Not end of chunk
                 continue
             commands=[]
+            outputs,outfiles = outfiles,[]
 
             # Actual job submission
             if not submit:
                 logger.info(self.skip)
                 continue
+            elif scheduler is not None:
+                name = '%s_%08i'%(jobname,ii)
+                scheduler.add(name,command,outputs=outputs,logfile=logfile)
+                scheduled.append(name)
+            elif manager is not None:
+                manager.submit(command,jobname,logfile,outputs=outputs)
             else:
-                while True:
-                    njobs = self.batch.njobs()
-                    if njobs < self.config['batch']['max_jobs']:
-                        break
-                    else:
-                        logger.info('%i jobs already in queue, waiting...'%(njobs))
-                        time.sleep(5*chunk)
-
+                self.throttle(5*chunk)
                 job = self.batch.submit(command,jobname,logfile)
                 logger.info("  "+job)
-                time.sleep(0.5)
+                if not local: time.sleep(0.5)
+
+        if manager is not None:
+            manager.flush(join(subdir,'array_%s.txt'%time.strftime('%Y%m%d_%H%M%S')))
+            if self.config['batch'].get('wait',False):
+                logger.info("Waiting for %i output files..."%len(manager.outputs))
+                manager.wait()
+
+        failed = self.batch.join()
+        if failed:
+            raise Exception("%i jobs failed"%len(failed))
+        return scheduled
+
+    def throttle(self, sleep):
+        """
+        Wait until there are fewer than 'max_jobs' jobs in the queue.
+        """
+        self.batch.throttle(self.config['batch']['max_jobs'],sleep)
 
     def write_script(self, filename, commands):
         info = 'echo "{0:=^60}";\n'
@@ -246,6 +339,123 @@ class Farm:
         script.write('exit $status;\n')
         script.close()
 
+class CostModel(object):
+    """
+    Predict the runtime of the likelihood scan of each pixel from the
+    number of stars in its ROI (runtime = a + b * nstars). The number
+    of stars is integrated from the stellar density maps written by
+    pixelize.pixelizeDensity (config['data']['density']). The
+    coefficients are fit to the runtimes (RUNTIME) and star counts
+    (NROI) recorded in existing likelihood files. Memory use scales
+    with the same star counts.
+    """
+    # Default coefficients: (s, s/star)
+    defaults = (30., 1e-3)
+
+    def __init__(self, config, nfiles=500):
+        """
+        Parameters:
+          config : Configuration object or filename
+          nfiles : Maximum number of likelihood files used for calibration
+        """
+        self.config = ugali.utils.config.Config(config)
+        self.nside_likelihood = self.config['coords']['nside_likelihood']
+        self._load_density()
+        self.coeff = self.calibrate(nfiles)
+
+    def _load_density(self):
+        """ Read the stellar density maps (stars/deg^2). """
+        self.nside_density = None
+        pix_array,density_array = [],[]
+        filenames = self.config.getFilenames()
+        for catalog_pix in filenames['pix'].compressed():
+            try: 
+                infile = self.config['data']['density']%catalog_pix
+            except (KeyError,TypeError):
+                break
+            if not exists(infile): continue
+            self.nside_density = pyfits.getheader(infile,'PIX_DATA')['NSIDE']
+            pix,density = ugali.utils.skymap.readSparseHealpixMap(infile,'DENSITY',construct_map=False)
+            pix_array.append(pix); density_array.append(density)
+
+        if not pix_array:
+            logger.warning("No stellar density maps found.")
+            self.density_pix = numpy.zeros(0,dtype=int)
+            self.density = numpy.zeros(0)
+            return
+        pix = numpy.concatenate(pix_array)
+        idx = numpy.argsort(pix)
+        self.density_pix = pix[idx]
+        self.density = numpy.concatenate(density_array)[idx]
+
+    def nstars(self, pixels):
+        """ Predicted number of stars in the ROI of each likelihood pixel. """
+        pixels = numpy.atleast_1d(pixels)
+        nstars = numpy.zeros(len(pixels))
+        if not len(self.density_pix): return nstars
+
+        area = healpy.nside2pixarea(self.nside_density,degrees=True)
+        radius = self.config['coords']['roi_radius']
+        for ii,pix in enumerate(pixels):
+            vec = healpy.pix2vec(self.nside_likelihood,pix)
+            disc = query_disc(self.nside_density,vec,radius)
+            idx = numpy.searchsorted(self.density_pix,disc).clip(0,len(self.density_pix)-1)
+            match = (self.density_pix[idx] == disc)
+            nstars[ii] = self.density[idx[match]].sum() * area
+        return nstars
+
+    def calibrate(self, nfiles=500):
+        """ Fit the runtime coefficients to existing likelihood files. """
+        from ugali.utils.skymap import readLikelihoodFile, likelihoodFiles
+
+        infiles = likelihoodFiles(self.config.likefile)
+        infiles = infiles[::max(len(infiles)//nfiles,1)]
+        nroi,runtime = [],[]
+        for infile in infiles:
+            if infile.endswith('.npz'):
+                header = readLikelihoodFile(infile)[2]
+            else:
+                header = pyfits.getheader(infile,'PIX_DATA')
+            if header.get('RUNTIME') and header.get('NROI') is not None:
+                nroi.append(header['NROI']); runtime.append(header['RUNTIME'])
+
+        if len(nroi) < 10:
+            logger.debug("Using default cost model.")
+            return self.defaults
+        b,a = numpy.polyfit(nroi,runtime,1)
+        if a < 0 or b <= 0:
+            logger.warning("Unphysical cost model fit; using defaults.")
+            return self.defaults
+        logger.info("Cost model: runtime = %.1f s + %.2g s/star (%i files)"%(a,b,len(nroi)))
+        return (a,b)
+
+    def runtime(self, pixels):
+        """ Predicted runtime (s) for each likelihood pixel. """
+        a,b = self.coeff
+        return a + b * self.nstars(pixels)
+
+    def pack(self, pixels, njobs):
+        """
+        Pack pixels into njobs jobs with roughly equal predicted
+        runtime (longest processing time first).
+
+        Returns:
+        groups : List of index arrays into pixels, longest job first
+        """
+        import heapq
+        njobs = max(min(njobs,len(pixels)),1)
+        runtime = self.runtime(pixels)
+        heap = [(0.,jj) for jj in range(njobs)]
+        groups = [[] for jj in range(njobs)]
+        for ii in numpy.argsort(runtime)[::-1]:
+            load,jj = heapq.heappop(heap)
+            groups[jj].append(ii)
+            heapq.heappush(heap,(load+runtime[ii],jj))
+
+        loads = numpy.array([runtime[g].sum() for g in groups])
+        logger.info("Packed %i pixels into %i jobs; predicted runtime %.0f-%.0f s"%(len(pixels),njobs,loads.min(),loads.max()))
+        return [numpy.array(groups[jj],dtype=int) for jj in numpy.argsort(loads)[::-1] if groups[jj]]
+
 if __name__ == "__main__":
     import ugali.utils.parser
     description = "Script for dispatching the likelihood scan to the queue."
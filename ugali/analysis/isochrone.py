@@ -68,6 +68,20 @@ def get_iso_dir():
         logger.warning(msg)
     return isodir
 
+# Parsed isochrone files keyed by (path, mtime, options); enabled in pool workers
+CACHE = None
+
+def genfromtxt(filename, **kwargs):
+    """
+    Read an isochrone file with np.genfromtxt, memoized when the
+    CACHE is enabled.
+    """
+    if CACHE is None: return np.genfromtxt(filename,**kwargs)
+    key = (os.path.abspath(filename),os.path.getmtime(filename),
+           repr(sorted(kwargs.items())))
+    if key not in CACHE: CACHE[key] = np.genfromtxt(filename,**kwargs)
+    return CACHE[key].copy()
+
 class Isochrone(Model):
     _params = odict([
         ('distance_modulus', Parameter(15.0, [10.0, 30.0]) ),
@@ -1094,7 +1108,7 @@ class PadovaIsochrone(Isochrone):
             logger.warning('did not recognize survey %s'%(survey))
 
         kwargs = dict(delimiter='\t',usecols=columns.keys(),dtype=columns.values())
-        data = np.genfromtxt(filename,**kwargs)
+        data = genfromtxt(filename,**kwargs)
 
         self.mass_init = data['mass_init']
         self.mass_act  = data['mass_act']
@@ -1185,7 +1199,7 @@ class Girardi2002(PadovaIsochrone):
             raise(e)
 
         kwargs = dict(delimiter='\t',usecols=columns.keys(),dtype=columns.values())
-        data = np.genfromtxt(filename,**kwargs)
+        data = genfromtxt(filename,**kwargs)
 
         self.mass_init = data['mass_init']
         self.mass_act  = data['mass_act']
@@ -1333,7 +1347,7 @@ class DotterIsochrone(PadovaIsochrone):
             raise(e)
 
         kwargs = dict(delimiter='',comments='#',usecols=columns.keys(),dtype=columns.values())
-        data = np.genfromtxt(filename,**kwargs)
+        data = genfromtxt(filename,**kwargs)
 
         # KCB: Not sure whether the mass in Dotter isochrone output
         # files is initial mass or current mass
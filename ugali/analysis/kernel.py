@@ -173,6 +173,70 @@ class EllipticalKernel(Kernel):
         radius = self.radius(lon,lat)
         return self.norm*self._pdf(radius)
 
+    def pdf_batch(self,lon,lat,**kwargs):
+        """
+        Evaluate the pdf for a set of parameter values at once.
+
+        Parameters:
+        -----------
+        lon, lat : coordinates to evaluate (deg)
+        kwargs   : parameter arrays of length n; missing parameters
+                   take their current values.
+
+        Returns:
+        --------
+        pdf : array with shape (n, len(lon))
+        """
+        kwargs = dict((self._mapping.get(k,k),np.atleast_1d(v)) for k,v in kwargs.items())
+        n = max([len(v) for v in kwargs.values()]+[1])
+        values = odict()
+        for name,param in self.params.items():
+            values[name] = np.asarray(kwargs.get(name,param.value),dtype=float)*np.ones(n)
+
+        # The normalization is integrated once for each distinct shape
+        kernel = copy.deepcopy(self)
+        shape = [k for k in values.keys() if k not in ('lon','lat','position_angle')]
+        norms = dict()
+        norm = np.empty(n)
+        for i,row in enumerate(zip(*[values[k] for k in shape])):
+            if row not in norms:
+                for k,v in zip(shape,row):
+                    if kernel.getp(k).value != v: kernel.setp(k,v)
+                norms[row] = kernel.norm
+            norm[i] = norms[row]
+
+        # Copy of the kernel holding a column of values for each
+        # parameter (and its aliases), so that the profile broadcasts.
+        view = copy.copy(self)
+        for name,value in values.items():
+            aliases = [k for k,v in self._mapping.items() if v == name]
+            for key in [name]+aliases:
+                view.__dict__[key] = value[:,np.newaxis]
+
+        radius = view._radius_batch(lon,lat)
+        return norm[:,np.newaxis]*view._pdf(radius)
+
+    def _radius_batch(self,lon,lat):
+        # Called on the broadcast copy built by `pdf_batch`
+        if self.proj is None or self.proj.lower()=='none':
+            return angsep(self.lon,self.lat,lon,lat)
+
+        projectors = [Projector(l,b,self.proj) for l,b in zip(self.lon.flat,self.lat.flat)]
+        if self.proj.lower() in ('ait','tan'):
+            # Rotate with the stacked rotation matrices
+            rotator = projectors[0].rotator
+            matrix = np.array([np.array(p.rotator.rotation_matrix) for p in projectors])
+            vec = np.einsum('nij,jm->inm',matrix,rotator.cartesian(lon,lat))
+            lon_rot = np.degrees(np.arctan2(vec[1],vec[0])) % 360.
+            lat_rot = np.degrees(np.arcsin(vec[2]))
+            x,y = projectors[0].sphere_to_image_func(lon_rot,lat_rot)
+        else:
+            x,y = map(np.array,zip(*[p.sphereToImage(lon,lat) for p in projectors]))
+
+        costh = np.cos(np.radians(self.theta))
+        sinth = np.sin(np.radians(self.theta))
+        return np.sqrt(((x*costh-y*sinth)/(1-self.e))**2 + (x*sinth+y*costh)**2)
+
     def sample_radius(self, n):
         """
         Sample the radial distribution (deg) from the 2D stellar density.
@@ -118,6 +118,112 @@ class LogLikelihood(object):
         self.sync_params()
         return self()
 
+    def value_batch(self, params, thetas):
+        """
+        Evaluate the log-likelihood for a set of parameter vectors
+        (e.g., an ensemble of MCMC walkers) at once. The spatial terms
+        are broadcast over the parameter sets and the color terms are
+        computed once for each distinct isochrone state.
+
+        Parameters:
+        -----------
+        params : names of the parameters
+        thetas : parameter values with shape (n, len(params))
+
+        Returns:
+        --------
+        loglike : array of length n (-inf for parameters that are out of
+                  bounds, outside the interior ROI, or unobservable)
+        """
+        thetas = np.atleast_2d(thetas).astype(float)
+        n = len(thetas)
+        loglike = -np.inf*np.ones(n)
+
+        if not hasattr(self.kernel,'pdf_batch'):
+            # Kernels without a batched pdf are evaluated one at a time
+            for i,theta in enumerate(thetas):
+                try: loglike[i] = self.value(**dict(zip(params,theta)))
+                except ValueError: pass
+            return loglike
+
+        self.sync_params()
+
+        # Sort the parameters by model and check their bounds
+        groups = odict([(key,odict()) for key in self.source.models.keys()])
+        sel = np.ones(n,dtype=bool)
+        for name,value in zip(params,thetas.T):
+            for key,model in self.source.models.items():
+                if name in model.params or name in model._mapping:
+                    groups[key][model._mapping.get(name,name)] = value
+                    bounds = model.getp(name).bounds
+                    if bounds is not None:
+                        sel &= (value >= bounds[0]) & (value <= bounds[1])
+                    break
+            else:
+                raise ValueError("Unrecognized parameter: %s"%name)
+
+        kernel = groups['kernel']
+        lon = kernel.get('lon',self.source.lon*np.ones(n))
+        lat = kernel.get('lat',self.source.lat*np.ones(n))
+        nside = self.config['coords']['nside_pixel']
+        sel &= np.in1d(ang2pix(nside,lon,lat),self.roi.pixels_interior)
+        richness = groups['richness'].get('richness',self.source.richness*np.ones(n))
+
+        # Color terms for each distinct isochrone state
+        isochrone = groups['isochrone']
+        states = zip(*isochrone.values()) if isochrone else n*[()]
+        color = odict()
+        if not isochrone:
+            color[()] = (self.observable_fraction,self.u_color)
+        else:
+            current = odict([(k,self.source.getp(k)) for k in isochrone.keys()])
+            for i in np.where(sel)[0]:
+                if states[i] in color: continue
+                self.source.set_params(**dict(zip(isochrone.keys(),states[i])))
+                try:
+                    distance_modulus = self.source.distance_modulus
+                    color[states[i]] = (self.calc_observable_fraction(distance_modulus),
+                                        self.calc_signal_color(distance_modulus))
+                except ValueError:
+                    color[states[i]] = None
+            # The synced quantities still belong to the current state
+            self.source.set_params(**current)
+            self.source.reset_sync()
+
+        # Blocks of parameter sets keep the broadcast arrays small
+        idx = np.where(sel)[0]
+        npix = len(self.roi.pixels_interior)
+        size = max(1,2**22//max(len(self.catalog.lon),npix,1))
+        for start in range(0,len(idx),size):
+            block = idx[start:start+size]
+            if kernel:
+                u_spatial,sparse = self.calc_signal_spatial_batch(
+                    **dict((k,v[block]) for k,v in kernel.items()))
+            else:
+                u_spatial = self.u_spatial[np.newaxis]
+                sparse = self.surface_intensity_sparse[np.newaxis]
+
+            keys = [states[i] for i in block]
+            for state in set(keys):
+                if color[state] is None: continue
+                observable_fraction,u_color = color[state]
+                jj = np.array([j for j,k in enumerate(keys) if k == state])
+                us = u_spatial[jj] if kernel else u_spatial
+                ss = sparse[jj] if kernel else sparse
+
+                u = us * u_color
+                f = self.roi.area_pixel * (ss*observable_fraction).sum(axis=1)
+                if self.spatial_only:
+                    u = us
+                    f = self.roi.area_pixel * (ss*(observable_fraction > 0)).sum(axis=1)
+
+                r = richness[block[jj]]
+                ru = r[:,np.newaxis] * u
+                p = ru/(ru + self.b)
+                loglike[block[jj]] = -1. * np.log(1.-p).sum(axis=1) - f*r
+
+        return loglike
+
     @property
     def nobs(self):
         """
@@ -329,6 +435,27 @@ class LogLikelihood(object):
         u_spatial = self.surface_intensity_object
         return u_spatial
 
+    def calc_signal_spatial_batch(self, **kwargs):
+        """
+        Spatial signal for a set of kernel parameter values (arrays of
+        length n). Returns the object-level and pixel-level surface
+        intensities with one row per parameter set.
+        """
+        pix_lon,pix_lat = self.roi.pixels_interior.lon,self.roi.pixels_interior.lat
+        nside = self.config['coords']['nside_pixel']
+        n = max([len(np.atleast_1d(v)) for v in kwargs.values()]+[1])
+        get = lambda k: np.asarray(kwargs.get(k,getattr(self.kernel,k)),dtype=float)*np.ones(n)
+
+        surface_intensity_sparse = self.kernel.pdf_batch(pix_lon,pix_lat,**kwargs)
+        lon,lat,extension = get('lon'),get('lat'),get('extension')
+        for i in np.where(extension < 2*np.degrees(healpy.max_pixrad(nside)))[0]:
+            idx = self.roi.indexInterior(lon[i],lat[i])
+            surface_intensity_sparse[i] = 0
+            surface_intensity_sparse[i,idx] = 1.0/self.roi.area_pixel
+
+        surface_intensity_object = self.kernel.pdf_batch(self.catalog.lon,self.catalog.lat,**kwargs)
+        return surface_intensity_object, surface_intensity_sparse
+
     ############################################################################
     # Methods for fitting and working with the likelihood
     ############################################################################
@@ -12,10 +12,18 @@ Another simple solution is to create a plain method linked to a static method.
 http://stackoverflow.com/questions/21111106/cant-pickle-static-method-multiprocessing-python
 
 We choose the second option here.
+
+Alternatively, with 'mcmc:shared' each worker process holds its own
+likelihood (inherited when the pool forks, or built once from the
+configuration and source model) and only the parameter vectors and
+log-probabilities are passed between processes.
 """
 
 import os
 import sys
+import struct
+import inspect
+import multiprocessing
 from collections import OrderedDict as odict
 
 import numpy
@@ -54,6 +62,13 @@ class MCMC(object):
         self.nwalkers = self.config['mcmc'].get('nwalkers',50)
         self.nburn = self.config['mcmc'].get('nburn',10)
         self.alpha = self.config['mcmc'].get('alpha',0.10)
+        self.vectorize = self.config['mcmc'].get('vectorize',False)
+        self.shared = self.config['mcmc'].get('shared',False)
+        self.autocorr_interval = self.config['mcmc'].get('autocorr_interval',None)
+        self.autocorr_factor = self.config['mcmc'].get('autocorr_factor',50)
+        self.autocorr_tol = self.config['mcmc'].get('autocorr_tol',0.01)
+        self.tau = None
+        self.pool = None
 
         self.loglike = loglike
         self.source = self.loglike.source
@@ -124,6 +139,55 @@ class MCMC(object):
         np.seterr(**err)
         return lnprior
 
+    def lnprob_batch(self, thetas):
+        """ Logarithm of the posterior for an ensemble of walkers """
+        thetas = np.atleast_2d(thetas)
+        lnprior = np.array([self.lnprior(theta) for theta in thetas])
+        lnlike = -np.inf*np.ones(len(thetas))
+        sel = np.isfinite(lnprior)
+        if sel.any():
+            lnlike[sel] = self.loglike.value_batch(self.params,thetas[sel])
+        return lnprior + lnlike
+
+    def create_sampler(self, nwalkers, ndim):
+        """ Create the ensemble sampler """
+        if self.shared and self.nthreads > 1:
+            logger.info("Evaluating the walkers in %i worker processes..."%self.nthreads)
+            self.pool = SharedPool(self,self.nthreads)
+            return emcee.EnsembleSampler(nwalkers,ndim,self.lnprob_batch,pool=self.pool)
+
+        if not self.vectorize:
+            return emcee.EnsembleSampler(nwalkers,ndim,lnprob,threads=self.nthreads)
+
+        logger.info("Evaluating the walkers in batches...")
+        if 'vectorize' in inspect.getargspec(emcee.EnsembleSampler.__init__).args:
+            return emcee.EnsembleSampler(nwalkers,ndim,self.lnprob_batch,vectorize=True)
+        else:
+            # Older emcee hands the whole ensemble to `pool.map`
+            pool = BatchPool(self.lnprob_batch)
+            return emcee.EnsembleSampler(nwalkers,ndim,self.lnprob_batch,pool=pool)
+
+    def converged(self, chain):
+        """
+        Check that the chain, shape (nwalkers,nsteps,nparams), is longer
+        than autocorr_factor times the autocorrelation time of every
+        parameter and that the estimate has stabilized since the last
+        check. Only the steps after the burn-in are used.
+        """
+        steps = chain.shape[1] - self.nburn
+        if steps <= 0: return False
+        last = self.tau
+        self.tau = np.array([ugali.utils.stats.autocorr_time(chain[:,self.nburn:,i]) 
+                             for i in range(chain.shape[-1])])
+        msg = "Autocorrelation time after %i steps (post burn-in):\n  "%steps
+        msg += ', '.join('%s: %.1f'%(k,v) for k,v in zip(self.params,self.tau))
+        logger.info(msg)
+
+        if last is None: return False
+        longer = np.all(self.autocorr_factor*self.tau < steps)
+        stable = np.all(np.abs(last - self.tau)/self.tau < self.autocorr_tol)
+        return bool(longer and stable)
+
     def run(self, params=None, outfile=None):
         # Initailize the likelihood to maximal value
         mle =self.get_mle()
@@ -145,25 +209,35 @@ class MCMC(object):
         
         logger.info("Running MCMC chain...")
         p0 = self.get_ball(params,nwalkers)
-        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,lnprob,threads=nthreads)
+        self.sampler = self.create_sampler(nwalkers,ndim)
+        self.tau = None
         #self.sampler.run_mcmc(p0,nsamples)
 
         # Chain is shape (nwalkers,nsteps,nparams)
         # Samples is shape (nwalkers*nsteps,nparams):
-        for i,result in enumerate(self.sampler.sample(p0,iterations=nsamples)):
-            steps = i+1
-            if steps%10 == 0: logger.info("%i steps ..."%steps)
-            self.chain = self.sampler.chain
-            if (i==0) or (steps%self.nchunk==0):
-                samples = self.chain.reshape(-1,len(self.params),order='F')
-                self.samples = Samples(samples.T,names=self.params)
-                if outfile is not None: 
-                    logger.info("Writing %i steps to %s..."%(steps,outfile))
-                    self.write_samples(outfile)
-
-        samples = self.chain.reshape(-1,len(self.params),order='F')
-        self.samples = Samples(samples.T,names=self.params)
-        if outfile is not None: self.write_samples(outfile)
+        # Steps are appended to the output as the chain grows
+        written = steps = 0
+        try:
+            for i,result in enumerate(self.sampler.sample(p0,iterations=nsamples)):
+                steps = i+1
+                if steps%10 == 0: logger.info("%i steps ..."%steps)
+                self.chain = self.sampler.chain[:,:steps]
+                if outfile is not None and ((i==0) or (steps%self.nchunk==0)):
+                    logger.info("Writing steps %i-%i to %s..."%(written+1,steps,outfile))
+                    self.write_samples(outfile,self.chain_samples(written),append=written>0)
+                    written = steps
+                if self.autocorr_interval and (steps%self.autocorr_interval==0):
+                    if self.converged(self.chain):
+                        logger.info("Chain converged after %i steps."%steps)
+                        break
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+
+        self.samples = self.chain_samples()
+        if outfile is not None and steps > written: 
+            self.write_samples(outfile,self.chain_samples(written),append=written>0)
 
     def estimate(self,param,burn=None,clip=10.0,alpha=0.32):
         # FIXME: Need to add age and metallicity to composite isochrone
@@ -224,6 +298,19 @@ class MCMC(object):
         bf = prior/posterior
         return ugali.utils.stats.interval(bf)
 
+    def autocorr(self,burn=None):
+        """ Autocorrelation time and effective sample size of each parameter """
+        tau,ess = dict(),dict()
+        for name in self.params:
+            if name not in self.samples.names: continue
+            data = self.samples.get(name,burn=burn)[:,0]
+            if len(data) < self.nwalkers or len(data)%self.nwalkers: continue
+            # Samples are ordered walker-first within each step
+            chain = data.reshape(-1,self.nwalkers).T
+            tau[name] = float(ugali.utils.stats.autocorr_time(chain))
+            ess[name] = float(ugali.utils.stats.effective_sample_size(chain,tau[name]))
+        return tau,ess
+
     def get_results(self,**kwargs):
         import astropy.coordinates
         kwargs = dict(alpha=self.alpha,burn=self.nburn*self.nwalkers)
@@ -234,6 +321,11 @@ class MCMC(object):
         ts = 2*self.loglike.value(**params)
         results['ts'] = ugali.utils.stats.interval(ts,np.nan,np.nan)
 
+        # Autocorrelation time (steps) and effective sample size
+        tau,ess = self.autocorr(burn=kwargs['burn'])
+        results['autocorr_time'] = tau
+        results['ess'] = ess
+
         lon,lat = estimate['lon'][0],estimate['lat'][0]
         #coord = astropy.coordinates.SkyCoord(lon,lat,frame='galactic',unit='deg')
 
@@ -340,8 +432,18 @@ class MCMC(object):
         output['results'] = results
         return output
         
-    def write_samples(self,filename):
-        np.save(filename,self.samples)
+    def chain_samples(self, start=0):
+        """ Samples from the chain steps after `start` """
+        samples = self.chain[:,start:].reshape(-1,len(self.params),order='F')
+        return Samples(samples.T,names=self.params)
+
+    def write_samples(self,filename,samples=None,append=False):
+        """
+        Write samples to an .npy file; with `append` the samples are
+        added to the end of the existing file.
+        """
+        if samples is None: samples = self.samples
+        write_npy(filename,samples,append=append)
 
     def load_samples(self,filename):
         self.samples = Samples(filename)
@@ -365,6 +467,113 @@ class MCMC(object):
         self.source.load(filename,section)
 
 
+class BatchPool(object):
+    """
+    Stand-in for a pool that evaluates all positions passed to `map`
+    with a single call to a batched log-probability.
+    """
+    def __init__(self, lnprob):
+        self.lnprob = lnprob
+
+    def map(self, func, thetas):
+        return list(self.lnprob(np.array(list(thetas))))
+
+# MCMC instance held by each worker of the SharedPool
+_mcmc = None
+
+def _init_worker(config, source, params):
+    """ Set up the likelihood once per worker process. """
+    global _mcmc
+    if _mcmc is None:
+        # Not inherited from the parent (spawned worker)
+        src = ugali.analysis.source.Source()
+        src.load(source)
+        _mcmc = MCMC(config,createLoglike(config,src))
+    _mcmc.params = params
+
+def _lnprob_worker(thetas):
+    """ Log-probabilities of a chunk of walkers in a worker process. """
+    if _mcmc.vectorize:
+        return _mcmc.lnprob_batch(thetas)
+
+    lnprob = -np.inf*np.ones(len(thetas))
+    for i,theta in enumerate(thetas):
+        lnprior = _mcmc.lnprior(theta)
+        if np.isfinite(lnprior):
+            lnprob[i] = lnprior + _mcmc.lnlike(theta)
+    return lnprob
+
+class SharedPool(object):
+    """
+    Pool of worker processes that are initialized once with the
+    likelihood. The workers are forked after the MCMC instance is
+    registered, so the ROI, catalog, and mask arrays are shared with
+    the parent rather than pickled. Each call to `map` splits the
+    positions into one chunk per worker; the function passed by emcee
+    is not sent to the workers.
+    """
+    def __init__(self, mcmc, nproc):
+        global _mcmc
+        _mcmc = mcmc
+        self.nproc = nproc
+        initargs = (mcmc.config,mcmc.source.todict(),mcmc.params)
+        self.pool = multiprocessing.Pool(nproc,_init_worker,initargs)
+
+    def map(self, func, thetas):
+        thetas = np.array(list(thetas))
+        chunks = np.array_split(thetas,min(self.nproc,len(thetas)))
+        return list(np.concatenate(self.pool.map(_lnprob_worker,chunks)))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def _npy_header(dtype, nrows, size=None):
+    """
+    Version 1.0 .npy header for a 1D array. By default the header is
+    padded so that the row count can grow without changing its size.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%i,), }"
+    header = header%(np.lib.format.dtype_to_descr(dtype),nrows)
+    preamble = np.lib.format.magic(1,0)
+    if size is None:
+        size = 64*int(np.ceil((len(preamble)+2+len(header)+1+32)/64.))
+    npad = size - len(preamble) - 2 - len(header) - 1
+    if npad < 0:
+        raise ValueError("Header does not fit in %i bytes"%size)
+    header += ' '*npad + '\n'
+    return preamble + struct.pack('<H',len(header)) + header
+
+def write_npy(filename, data, append=False):
+    """
+    Write a 1D (record) array to an .npy file. With `append`, the rows
+    are written after those of an existing file and the row count in
+    its header is updated in place, so only the new rows are written.
+    """
+    data = np.ascontiguousarray(data)
+    if not append or not os.path.exists(filename):
+        out = open(filename,'wb')
+        out.write(_npy_header(data.dtype,len(data)))
+        data.tofile(out)
+        out.close()
+        return
+
+    out = open(filename,'r+b')
+    np.lib.format.read_magic(out)
+    shape,fortran,dtype = np.lib.format.read_array_header_1_0(out)
+    offset = out.tell()
+    if dtype != data.dtype or len(shape) != 1:
+        out.close()
+        msg = "Can't append %s to %s with %s"%(data.dtype,filename,dtype)
+        raise ValueError(msg)
+    # Overwrite anything past the last complete row
+    out.seek(offset + shape[0]*dtype.itemsize)
+    data.tofile(out)
+    out.truncate()
+    out.seek(0)
+    out.write(_npy_header(dtype,shape[0]+len(data),offset))
+    out.close()
+
 #class Samples(np.ndarray):
 class Samples(np.recarray):
     """
@@ -376,10 +585,10 @@ class Samples(np.recarray):
     _alpha = 0.10
     _nbins = 300
 
-    def __new__(cls, input, names=None):
-        # Load the array from file
+    def __new__(cls, input, names=None, mmap_mode='r'):
+        # Load the array from file (memory mapped by default)
         if not isinstance(input,np.ndarray):
-            obj = np.load(input).view(cls)
+            obj = np.load(input,mmap_mode=mmap_mode).view(cls)
         else:
             obj = np.asarray(input).view(cls)
             
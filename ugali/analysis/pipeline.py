@@ -3,6 +3,8 @@
 Base functionality for pipeline scripts
 """
 
+import os,sys
+
 import ugali.utils.batch
 #from ugali.utils.batch import factory as batchFactory
 
@@ -20,6 +22,8 @@ class Pipeline(object):
     def __init__(self, description=__doc__, components=[]):
         self.description = description
         self.components = components
+        # Script name (e.g., 'run_03' for 'run_03.0_likelihood.py')
+        self.name = os.path.basename(sys.argv[0]).split('.')[0]
         self._setup_parser()
 
     def _setup_parser(self):
@@ -31,6 +35,8 @@ class Pipeline(object):
         self.parser.add_run(choices=self.components) 
         self.parser.add_verbose()
         self.parser.add_version()
+        self.parser.add_argument('--dryrun',action='store_true',
+                                 help='Estimate the resources of each component without running')
 
     def parse_args(self):
         self.opts = self.parser.parse_args()
@@ -38,14 +44,28 @@ class Pipeline(object):
             self.opts.run = self.components
 
         self.config = Config(self.opts.config)        
-        self.batch = ugali.utils.batch.batchFactory(self.opts.queue)
+        opts = self.config.get('batch',{}).get('opts',{})
+        self.batch = ugali.utils.batch.batchFactory(self.opts.queue,**opts)
 
     def run(self):
         logger.warning("Doing nothing...")
         return
 
+    def dryrun(self):
+        from ugali.analysis.resources import ResourceEstimator
+        estimator = ResourceEstimator(self.config)
+        return estimator.report(self.opts.run,self.name)
+
     def execute(self):
+        if self.opts.dryrun:
+            return self.dryrun()
         ret = self.run()
+        # Wait for the jobs submitted through the pipeline batch that
+        # run in this process (a Farm with its own batch joins it)
+        failed = self.batch.join()
+        if failed:
+            logger.error("%i jobs failed."%len(failed))
+            sys.exit(1)
         logger.info("Done.")
         return ret
 
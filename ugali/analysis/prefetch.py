@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Load the observations for a sequence of ROIs on a background thread.
+
+While the likelihood of one ROI is being evaluated, the catalog and
+mask of the next ROI are read and decoded so that computation and
+file I/O overlap. Catalog files shared between consecutive ROIs are
+only read once.
+"""
+
+import threading
+import Queue
+
+from ugali.analysis.loglike import Observation, createROI, createMask
+from ugali.observation.catalog import Catalog
+from ugali.utils.config import Config
+from ugali.utils.logger import logger
+
+class ObservationLoader(object):
+    """
+    Iterate over the observations (roi, catalog, mask) for a set of
+    coordinates. Observations are read ahead of time by a background
+    thread and passed through a bounded queue.
+
+    Usage:
+    loader = ObservationLoader(config,coords)
+    for lon,lat,observation in loader:
+        ...
+    """
+
+    def __init__(self, config, coords, size=1):
+        """
+        Parameters:
+          config : Configuration object or filename
+          coords : Sequence of (lon, lat) coordinates
+          size   : Number of observations to read ahead
+        """
+        self.config = Config(config)
+        self.coords = [(float(lon),float(lat)) for lon,lat in coords]
+        self.filenames = self.config.getFilenames()
+        self.queue = Queue.Queue(maxsize=max(size,1))
+        # Catalog files read by the previous ROI
+        self.cache = dict()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None: return
+            yield item
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _run(self):
+        for lon,lat in self.coords:
+            try:
+                observation = self.load(lon,lat)
+            except Exception as e:
+                # Pass the exception along to the consumer
+                logger.warning("Failed to load (%.2f, %.2f): %s"%(lon,lat,e))
+                observation = e
+            self.queue.put((lon,lat,observation))
+        self.queue.put(None)
+
+    def load(self, lon, lat):
+        """
+        Read the observation for a single ROI, reusing the catalog
+        files that overlap with the previous ROI.
+        """
+        roi = createROI(self.config,lon,lat)
+
+        infiles = list(self.filenames['catalog'][roi.getCatalogPixels()])
+        # Only keep the catalog files needed by this ROI
+        for key in self.cache.keys():
+            if key not in infiles: del self.cache[key]
+
+        catalog = Catalog(self.config,roi=roi,cache=self.cache)
+        mask = createMask(self.config,roi)
+        return Observation(roi=roi,mask=mask,catalog=catalog)
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+"""
+Estimate the resources needed by the pipeline stages before running them.
+
+The estimates are built from the catalog file headers, the survey
+footprint (mask coverage), and the configuration; no catalog or mask
+data is read. Runtimes come from the likelihood cost model
+(ugali.analysis.farm.CostModel), which is calibrated against existing
+likelihood files when they are available.
+
+Estimates are registered per pipeline script and component, e.g.
+('run_03','scan'), since the same component name can mean different
+things in different scripts. A dry run does not write any files.
+
+Usage:
+estimator = ResourceEstimator(config)
+estimator.report(['scan','merge'],pipeline='run_03')
+"""
+import os
+import glob
+from collections import OrderedDict as odict
+
+import numpy
+import healpy
+import pyfits
+
+from ugali.utils.config import Config
+from ugali.utils.logger import logger
+import ugali.utils.batch
+
+class ResourceEstimator(object):
+    """
+    Predict star counts, array sizes, memory, and runtime of the
+    pipeline components.
+    """
+    # Bytes held per catalog object (columns and derived arrays)
+    catalog_bytes = 20 * 8
+    # Bytes held per ROI pixel (mask, kernel, and index arrays)
+    roi_bytes = 8 * 8
+    # Number of (nstars, nbins) temporaries built by Isochrone.pdf
+    pdf_arrays = 10
+    # Default mass_steps of LogLikelihood.calc_signal_color
+    pdf_mass_steps = 10000
+    # Interpreter and module overhead
+    base_memory = 250 * 1024**2
+    # Padding applied to the recommended requests
+    memory_factor = 1.5
+    runtime_factor = 1.5
+
+    def __init__(self, config):
+        self.config = Config(config)
+        self.nside_catalog    = self.config['coords']['nside_catalog']
+        self.nside_likelihood = self.config['coords']['nside_likelihood']
+        self.nside_pixel      = self.config['coords']['nside_pixel']
+        self.nmoduli = len(self.config['scan']['distance_modulus_array'])
+        # Loaded when first needed
+        self.catalog_pix = None
+        self._cost = None
+
+    @property
+    def cost(self):
+        from ugali.analysis.farm import CostModel
+        if self._cost is None: self._cost = CostModel(self.config)
+        return self._cost
+
+    def _load_catalog_density(self):
+        """ Mean stellar density (stars/deg^2) of each catalog pixel from the file headers. """
+        filenames = self.config.getFilenames()
+        exists = ~filenames.mask['catalog']
+        nobjs = [pyfits.getheader(f,1)['NAXIS2'] for f in filenames['catalog'].data[exists]]
+        if self.nside_catalog:
+            self.catalog_pix = numpy.asarray(filenames['pix'].data[exists],dtype=int)
+            area = healpy.nside2pixarea(self.nside_catalog,degrees=True)
+            self.catalog_density = numpy.array(nobjs,dtype=float)/area
+        else:
+            # A single all-sky catalog (catalog pixel 0)
+            self.catalog_pix = numpy.zeros(1 if nobjs else 0,dtype=int)
+            area = 4*numpy.pi*numpy.degrees(1)**2
+            self.catalog_density = numpy.array([sum(nobjs)],dtype=float)[:len(self.catalog_pix)]/area
+        idx = numpy.argsort(self.catalog_pix)
+        self.catalog_pix = self.catalog_pix[idx]
+        self.catalog_density = self.catalog_density[idx]
+        logger.info("Read %i catalog headers (%i objects)."%(len(nobjs),sum(nobjs)))
+
+    def _tables(self, filenames):
+        """ Number of rows and bytes per row of each FITS table (from the headers). """
+        headers = [pyfits.getheader(f,1) for f in filenames]
+        nrows = numpy.array([h['NAXIS2'] for h in headers],dtype=float)
+        rowsize = numpy.array([h['NAXIS1'] for h in headers],dtype=float)
+        return nrows, rowsize
+
+    def _catalogs(self):
+        filenames = self.config.getFilenames()
+        return filenames['catalog'].compressed()
+
+    def pixels(self):
+        """ Likelihood pixels inside the survey footprint (built in memory). """
+        from ugali.utils.skymap import footprintIndex
+        return footprintIndex(self.config,self.nside_likelihood,write=False)
+
+    def nstars(self, pixels, radius=None):
+        """ Predicted number of stars within radius of each likelihood pixel. """
+        if radius is None: radius = self.config['coords']['roi_radius']
+        pixels = numpy.atleast_1d(pixels)
+        if len(self.cost.density_pix) and radius == self.config['coords']['roi_radius']:
+            return self.cost.nstars(pixels)
+
+        nstars = numpy.zeros(len(pixels))
+        if self.catalog_pix is None: self._load_catalog_density()
+        if not len(self.catalog_pix): return nstars
+        if self.nside_catalog:
+            vec = healpy.pix2vec(self.nside_likelihood,pixels)
+            catalog_pix = healpy.vec2pix(self.nside_catalog,*vec)
+        else:
+            catalog_pix = numpy.zeros(len(pixels),dtype=int)
+        idx = numpy.searchsorted(self.catalog_pix,catalog_pix).clip(0,len(self.catalog_pix)-1)
+        match = (self.catalog_pix[idx] == catalog_pix)
+        nstars[match] = self.catalog_density[idx[match]] * numpy.pi * radius**2
+        return nstars
+
+    def roi_npix(self, radius=None):
+        """ Number of nside_pixel pixels in an ROI. """
+        if radius is None: radius = self.config['coords']['roi_radius']
+        return int(numpy.pi * radius**2 / healpy.nside2pixarea(self.nside_pixel,degrees=True))
+
+    def target_npix(self):
+        """ Number of nside_pixel pixels in a likelihood pixel. """
+        return (self.nside_pixel//self.nside_likelihood)**2
+
+    def pdf_bins(self):
+        """ Maximum number of occupied isochrone bins used by Isochrone.pdf. """
+        delta_mag = self.config['likelihood']['delta_mag']
+        nmag = (self.config['mag']['max'] - self.config['mag']['min'])/delta_mag
+        return int(min(self.pdf_mass_steps, nmag**2))
+
+    def arrays(self, nstars):
+        """ Sizes (bytes) of the dense arrays held while fitting one ROI. """
+        arrays = odict()
+        arrays['catalog'] = nstars * self.catalog_bytes
+        arrays['roi'] = self.roi_npix() * self.roi_bytes
+        arrays['u_color'] = self.nmoduli * nstars * 8
+        arrays['Isochrone.pdf'] = self.pdf_arrays * nstars * self.pdf_bins() * 8
+        arrays['results'] = 7 * self.nmoduli * self.target_npix() * 8
+        return arrays
+
+    def pixelize(self):
+        """ Estimate the pixelization of the raw catalog files (run_02 'pixelize'). """
+        rawfiles = sorted(glob.glob(os.path.join(self.config['data']['dirname'],'*.fits')))
+        nrows,rowsize = self._tables(rawfiles)
+        # GLON, GLAT, and two pixel columns are added to each row
+        outsize = nrows * (rowsize + 24)
+
+        est = odict()
+        est['njobs'] = 1
+        est['nstars'] = (numpy.median(nrows),nrows.max()) if len(nrows) else (0,0)
+        est['roi_npix'] = 0
+        # One raw file and its extended copy are held at a time
+        est['arrays'] = odict([('raw',(nrows*rowsize).max() if len(nrows) else 0),
+                               ('table',outsize.max() if len(nrows) else 0)])
+        est['memory'] = self.base_memory + sum(est['arrays'].values())
+        est['runtime'] = 2e-6 * nrows.sum() + 0.1 * len(rawfiles)
+        est['cpu'] = est['runtime']
+        est['output'] = outsize.sum()
+        return est
+
+    def density(self, nside=2**9):
+        """ Estimate the stellar density maps (run_02 'density'). """
+        nrows,rowsize = self._tables(self._catalogs())
+        npix = (nside//self.nside_catalog)**2 if self.nside_catalog else healpy.nside2npix(nside)
+
+        est = odict()
+        est['njobs'] = 1
+        est['nstars'] = (numpy.median(nrows),nrows.max()) if len(nrows) else (0,0)
+        est['roi_npix'] = 0
+        est['arrays'] = odict([('catalog',(nrows*rowsize).max() if len(nrows) else 0),
+                               ('pixels',3 * nrows.max() * 8 if len(nrows) else 0)])
+        est['memory'] = self.base_memory + sum(est['arrays'].values())
+        est['runtime'] = 1e-6 * nrows.sum() + 0.1 * len(nrows)
+        est['cpu'] = est['runtime']
+        est['output'] = len(nrows) * npix * (8+4)
+        return est
+
+    def maglims(self):
+        """ Estimate the magnitude limit maps in both bands (run_02 'maglims'). """
+        nrows,rowsize = self._tables(self._catalogs())
+        nside_mask = self.config['coords']['nside_mask']
+        npix = (self.nside_pixel//self.nside_catalog)**2 if self.nside_catalog \
+            else healpy.nside2npix(self.nside_pixel)
+
+        est = odict()
+        est['njobs'] = 1
+        est['nstars'] = (numpy.median(nrows),nrows.max()) if len(nrows) else (0,0)
+        est['roi_npix'] = 0
+        est['arrays'] = odict([('catalog',(nrows*rowsize).max() if len(nrows) else 0),
+                               ('pixels',3 * nrows.max() * 8 if len(nrows) else 0),
+                               ('maglims',healpy.nside2npix(nside_mask) * 8)])
+        est['memory'] = self.base_memory + sum(est['arrays'].values())
+        # Each catalog file is read and sorted once per band
+        est['runtime'] = 2 * (2e-6 * nrows.sum() + 0.1 * len(nrows))
+        est['cpu'] = est['runtime']
+        est['output'] = 2 * len(nrows) * npix * (4+4)
+        return est
+
+    def scan(self, pixels=None):
+        """ Estimate the likelihood scan (run_03 'scan'). """
+        if pixels is None: pixels = self.pixels()
+        nstars = self.nstars(pixels)
+        runtime = self.cost.runtime(pixels)
+        arrays = self.arrays(nstars.max() if len(nstars) else 0)
+        memory = self.base_memory + sum(arrays.values())
+
+        chunk = self.config['batch']['chunk'] or 1
+        nproc = self.config['scan'].get('nproc',1) or 1
+        njobs = int(numpy.ceil(len(pixels)/float(chunk)))
+        jobtime = [runtime[i:i+chunk].sum()/nproc for i in range(0,len(pixels),chunk)]
+
+        est = odict()
+        est['njobs'] = njobs
+        est['nstars'] = (numpy.median(nstars),nstars.max()) if len(nstars) else (0,0)
+        est['roi_npix'] = self.roi_npix()
+        est['arrays'] = arrays
+        # Every worker holds its own ROI
+        est['memory'] = memory * nproc
+        est['runtime'] = max(jobtime) if jobtime else 0
+        est['cpu'] = runtime.sum()
+        est['output'] = len(pixels) * self.target_npix() * (7*self.nmoduli+1) * 4
+        return est
+
+    def merge(self, pixels=None):
+        """ Estimate the merge of the likelihood files (run_03 'merge'). """
+        if pixels is None: pixels = self.pixels()
+        nrows = len(pixels) * self.target_npix()
+        size = nrows * (7*self.nmoduli+1) * 4
+
+        est = odict()
+        est['njobs'] = 1
+        est['nstars'] = (0,0)
+        est['roi_npix'] = 0
+        est['arrays'] = odict([('merged',size)])
+        # The incremental merge keeps the output on disk
+        if self.config['output'].get('mergedir'):
+            est['memory'] = self.base_memory + size/len(pixels) if len(pixels) else self.base_memory
+        else:
+            est['memory'] = self.base_memory + 2*size
+        est['runtime'] = 1e-6 * nrows * self.nmoduli + 0.05 * len(pixels)
+        est['cpu'] = est['runtime']
+        est['output'] = size
+        return est
+
+    def label(self):
+        """ Estimate the full-sky maps built by the peak finder (run_04 'label'). """
+        npix = healpy.nside2npix(self.nside_pixel)
+        arrays = odict()
+        arrays['ts_map'] = npix * self.nmoduli * 8
+        arrays['labels'] = npix * self.nmoduli * 8
+
+        est = odict()
+        est['njobs'] = 1
+        est['nstars'] = (0,0)
+        est['roi_npix'] = 0
+        est['arrays'] = arrays
+        est['memory'] = self.base_memory + 2*sum(arrays.values())
+        est['runtime'] = 2e-8 * npix * self.nmoduli
+        est['cpu'] = est['runtime']
+        est['output'] = 0
+        return est
+
+    def objects(self, pixels=None):
+        """ Estimate the characterization of the labelled objects (run_04 'objects'). """
+        if pixels is None: pixels = self.pixels()
+        nentries = len(pixels) * self.target_npix() * self.nmoduli
+        arrays = odict()
+        arrays['labels'] = nentries * 8
+        arrays['values'] = nentries * 8
+        arrays['rev'] = 2 * nentries * 8
+
+        est = odict()
+        est['njobs'] = 1
+        est['nstars'] = (0,0)
+        est['roi_npix'] = 0
+        est['arrays'] = arrays
+        est['memory'] = self.base_memory + 2*sum(arrays.values())
+        est['runtime'] = 1e-7 * nentries * numpy.log2(max(nentries,2))
+        est['cpu'] = est['runtime']
+        est['output'] = 0
+        return est
+
+    def mcmc(self, ntargets=None):
+        """ Estimate the MCMC followup of the candidates (run_05 'mcmc'). """
+        if ntargets is None:
+            try: ntargets = pyfits.getheader(self.config.candfile,1)['NAXIS2']
+            except (IOError,KeyError): ntargets = 1
+        radius = self.config['coords']['roi_radius']
+        pixels = self.pixels()
+        nstars = self.nstars(pixels,radius).max() if len(pixels) else 0
+
+        nwalkers = self.config['mcmc']['nwalkers']
+        nsamples = self.config['mcmc']['nsamples']
+        nthreads = self.config['mcmc'].get('nthreads',1) or 1
+        nparams = len(self.config['mcmc']['params'])
+        arrays = self.arrays(nstars)
+        # The distance modulus is a fit parameter; one color pdf at a time
+        arrays['u_color'] = nstars * 8
+        arrays['results'] = 0
+        arrays['chain'] = nwalkers * nsamples * (nparams+1) * 8
+
+        # The scan cost per star covers every (modulus, target) fit
+        a,b = self.cost.coeff
+        evaltime = b * nstars / (self.nmoduli * self.target_npix())
+
+        est = odict()
+        est['njobs'] = ntargets
+        est['nstars'] = (nstars,nstars)
+        est['roi_npix'] = self.roi_npix()
+        est['arrays'] = arrays
+        est['memory'] = self.base_memory + sum(arrays.values())
+        est['runtime'] = a + nwalkers * nsamples * evaltime / nthreads
+        est['cpu'] = ntargets * (a + nwalkers * nsamples * evaltime)
+        est['output'] = ntargets * arrays['chain']
+        return est
+
+    def simulate(self, njobs=None):
+        """ Estimate the simulated satellite fits (run_06 'simulate'). """
+        if njobs is None: njobs = self.config['simulate']['njobs']
+        size = self.config['simulate']['size']
+        pixels = self.pixels()
+        nstars = self.nstars(pixels).max() if len(pixels) else 0
+        arrays = self.arrays(nstars)
+        arrays['u_color'] = nstars * 8
+        arrays['results'] = 7 * self.target_npix() * 8
+
+        # Each simulation sets up an ROI and fits a single target
+        # pixel and distance modulus
+        a,b = self.cost.coeff
+        fittime = a + b * nstars / (self.nmoduli * self.target_npix())
+
+        est = odict()
+        est['njobs'] = njobs
+        est['nstars'] = (nstars,nstars)
+        est['roi_npix'] = self.roi_npix()
+        est['arrays'] = arrays
+        est['memory'] = self.base_memory + sum(arrays.values())
+        est['runtime'] = size * fittime
+        est['cpu'] = njobs * est['runtime']
+        # Simulated and fitted parameters (~20 columns)
+        est['output'] = njobs * size * 20 * 8
+        return est
+
+    # Components with an estimate, keyed by (pipeline, component)
+    components = odict([
+        (('run_02','pixelize'), pixelize),
+        (('run_02','density'), density),
+        (('run_02','maglims'), maglims),
+        (('run_03','scan'), scan),
+        (('run_03','merge'), merge),
+        (('run_04','label'), label),
+        (('run_04','objects'), objects),
+        (('run_05','mcmc'), mcmc),
+        (('run_06','simulate'), simulate),
+    ])
+
+    def estimate(self, components, pipeline=None):
+        """ 
+        Estimates for each of the requested components of a pipeline
+        script (e.g., 'run_03'). Without a pipeline, components are
+        matched by name alone.
+        """
+        estimates = odict()
+        for name in components:
+            keys = [k for k in self.components if k[1] == name 
+                    and (pipeline is None or k[0] == pipeline)]
+            if not keys:
+                logger.info("No resource estimate for '%s' in %s."%(name,pipeline))
+                continue
+            for key in keys:
+                estimates[name] = self.components[key](self)
+        return estimates
+
+    def recommend(self, est):
+        """ Recommended batch request for a component estimate. """
+        rec = odict()
+        rec['memory'] = int(numpy.ceil(self.memory_factor * est['memory'] / 1024.**2))
+        rec['walltime'] = self.runtime_factor * est['runtime']
+        rec['queue'] = None
+        for queue in ugali.utils.batch.QUEUES['lsf']:
+            limit = ugali.utils.batch.RUNLIMITS.get(queue)
+            if limit is None: continue
+            hours,minutes = map(int,limit.split(':'))
+            if 3600*hours + 60*minutes >= rec['walltime']:
+                rec['queue'] = queue
+                break
+        return rec
+
+    def report(self, components, pipeline=None):
+        """ Log a summary table of the estimates and recommended requests. """
+        estimates = self.estimate(components,pipeline)
+        if not estimates: return estimates
+        header = '%-8s %6s %10s %10s %9s %10s %10s %10s %10s'%(
+            'STAGE','NJOBS','NSTARS','MAXSTARS','ROI_NPIX','MEMORY','RUNTIME','CPU','OUTPUT')
+        lines = [header, '-'*len(header)]
+        for name,est in estimates.items():
+            lines.append('%-8s %6i %10i %10i %9i %10s %10s %10s %10s'%(
+                name,est['njobs'],est['nstars'][0],est['nstars'][1],est['roi_npix'],
+                sizestr(est['memory']),timestr(est['runtime']),
+                timestr(est['cpu']),sizestr(est['output'])))
+        lines.append('')
+        for name,est in estimates.items():
+            largest = max(est['arrays'].items(),key=lambda x: x[1])
+            rec = self.recommend(est)
+            lines.append("%s: largest array %s (%s); request %i MB, %s walltime, queue %s"%(
+                name,largest[0],sizestr(largest[1]),rec['memory'],
+                timestr(rec['walltime']),rec['queue']))
+        logger.info('Resource estimates:\n'+'\n'.join(lines))
+        return estimates
+
+def sizestr(nbytes):
+    """ Human-readable size. """
+    for unit in ['B','KB','MB','GB']:
+        if abs(nbytes) < 1024.: return '%.1f %s'%(nbytes,unit)
+        nbytes /= 1024.
+    return '%.1f TB'%nbytes
+
+def timestr(seconds):
+    """ Format seconds as H:MM:SS. """
+    seconds = int(numpy.ceil(seconds))
+    return '%i:%02i:%02i'%(seconds//3600,(seconds%3600)//60,seconds%60)
+
+if __name__ == "__main__":
+    import ugali.utils.parser
+    description = "Estimate the resources needed by the pipeline components."
+    parser = ugali.utils.parser.Parser(description=description)
+    parser.add_config()
+    parser.add_argument('-p','--pipeline',default=None,
+                        help="Pipeline script of the components (e.g., 'run_03')")
+    parser.add_argument('-r','--run',default=[],action='append',
+                        help="Component to estimate")
+    parser.add_verbose()
+    opts = parser.parse_args()
+
+    estimator = ResourceEstimator(opts.config)
+    components = [k[1] for k in estimator.components
+                  if opts.pipeline is None or k[0] == opts.pipeline]
+    estimator.report(opts.run or components,opts.pipeline)
@@ -10,6 +10,11 @@ Classes:
 
 import os
 import sys
+import time
+import json
+import hashlib
+import multiprocessing
+import multiprocessing.sharedctypes
 from collections import OrderedDict as odict
 
 import numpy
@@ -25,7 +30,7 @@ from ugali.utils.parabola import Parabola
 
 from ugali.utils.config import Config
 from ugali.utils.logger import logger
-from ugali.utils.healpix import superpixel, subpixel, pix2ang, ang2pix
+from ugali.utils.healpix import superpixel, subpixel, pix2ang, ang2pix, query_disc
 
 ############################################################
 
@@ -72,11 +77,198 @@ def createGridSearch(config,lon,lat):
     src = createSource(config,'scan',lon=lon,lat=lat)
     loglike=LogLikelihood(config,obs,src)
     return GridSearch(config,loglike)
-    
+
+def checkpointFile(outfile, suffix='checkpoint'):
+    """
+    Checkpoint filename for a likelihood output. Checkpoints are kept
+    in a 'checkpoint' subdirectory so that they are never picked up
+    as likelihood files (i.e., by the merge).
+    """
+    dirname,basename = os.path.split(outfile)
+    dirname = os.path.join(dirname,'checkpoint')
+    if not os.path.exists(dirname): 
+        try: os.makedirs(dirname)
+        except OSError: pass # Created by a concurrent job
+    return os.path.join(dirname,'%s_%s.npz'%(os.path.splitext(basename)[0],suffix))
+
+def scanPixels(config, pixels, outfile, debug=False):
+    """
+    Run the grid search over a sequence of likelihood pixels in a
+    single process. The observation for the next pixel is read on a 
+    background thread while the current pixel is being scanned.
+
+    Parameters:
+    config  : Configuration object or filename
+    pixels  : Likelihood pixels (at 'nside_likelihood') to scan
+    outfile : Output filename template filled with (pix, coordsys)
+    debug   : Setup, but do not run
+
+    Returns:
+    status  : Number of pixels that failed
+    """
+    from ugali.analysis.prefetch import ObservationLoader
+
+    config = Config(config)
+    nside = config['coords']['nside_likelihood']
+    coordsys = config['coords']['coordsys'].lower()
+    pixels = np.atleast_1d(pixels)
+    lon,lat = pix2ang(nside,pixels)
+
+    # The source (and its isochrone) is shared between pixels
+    src = createSource(config,'scan',lon=lon[0],lat=lat[0])
+    size = config['scan'].get('prefetch',1)
+    loader = ObservationLoader(config,zip(lon,lat),size=size)
+
+    status = 0
+    for i,(pix,(_lon,_lat,obs)) in enumerate(zip(pixels,loader)):
+        logger.info('=== (%i/%i) pixel=%i nside=%i; (lon, lat) = (%.2f, %.2f) ==='%(i+1,len(pixels),pix,nside,_lon,_lat))
+        if isinstance(obs,Exception):
+            logger.error(str(obs))
+            status += 1
+            continue
+        src.set_params(lon=_lon,lat=_lat)
+        grid = GridSearch(config,LogLikelihood(config,obs,src))
+        filename = outfile%(pix,coordsys)
+        if config['scan'].get('checkpoint',False):
+            grid.set_checkpoint(checkpointFile(filename))
+        if debug: continue
+        grid.search()
+        logger.info("Writing %s..."%filename)
+        grid.write(filename)
+        grid.clear_checkpoint()
+    return status
+
+############################################################
+
+# Config sections that determine the result of the likelihood scan
+SCAN_SECTIONS = ['coords','catalog','mask','color','mag','isochrone',
+                 'kernel','likelihood','scan']
+# Scan options that do not change the result
+SCAN_IGNORE = ['script','nproc','prefetch','checkpoint','checkpoint_interval']
+
+# Memoized checksums keyed by (path, size, mtime)
+_CHECKSUMS = dict()
+
+def fileChecksum(filename, blocksize=2**20):
+    """
+    MD5 checksum of a file, memoized by path, size, and modification time.
+    """
+    stat = os.stat(filename)
+    key = (filename, stat.st_size, stat.st_mtime)
+    if key not in _CHECKSUMS:
+        md5 = hashlib.md5()
+        reader = open(filename,'rb')
+        for block in iter(lambda: reader.read(blocksize), ''):
+            md5.update(block)
+        reader.close()
+        _CHECKSUMS[key] = md5.hexdigest()
+    return _CHECKSUMS[key]
+
+def loadChecksums(filename):
+    """ Load memoized file checksums. """
+    if not os.path.exists(filename): return
+    for path,size,mtime,md5 in json.load(open(filename)):
+        _CHECKSUMS[(path,size,mtime)] = md5
+
+def saveChecksums(filename):
+    """ Save memoized file checksums. """
+    out = open(filename,'w')
+    json.dump([list(k)+[v] for k,v in _CHECKSUMS.items()],out)
+    out.close()
+
+def _plain(value):
+    """ Convert numpy values and containers to plain (JSON) types. """
+    if isinstance(value,dict): 
+        return dict((str(k),_plain(v)) for k,v in value.items())
+    if isinstance(value,(list,tuple,np.ndarray)): 
+        return [_plain(v) for v in value]
+    if isinstance(value,np.generic): 
+        return value.item()
+    return value
+
+def configHash(config):
+    """
+    Hash of the config options that determine the likelihood scan.
+    """
+    params = dict((k,config.get(k)) for k in SCAN_SECTIONS)
+    params['scan'] = dict((k,v) for k,v in (params['scan'] or {}).items() 
+                          if k not in SCAN_IGNORE)
+    return hashlib.md5(json.dumps(_plain(params),sort_keys=True)).hexdigest()
+
+def scanInputs(config, pix, filenames=None):
+    """
+    Catalog and mask files that can enter the ROI of a likelihood pixel.
+    """
+    if filenames is None: filenames = config.getFilenames()
+    nside = config['coords']['nside_likelihood']
+    nside_catalog = config['coords']['nside_catalog']
+
+    if not nside_catalog:
+        catalog_pix = [0]
+    else:
+        vec = healpy.pix2vec(nside,pix)
+        radius = config['coords']['roi_radius'] + np.degrees(healpy.max_pixrad(nside))
+        catalog_pix = query_disc(nside_catalog,vec,radius,inclusive=True)
+        catalog_pix = np.intersect1d(catalog_pix,filenames['pix'].compressed())
+    return [f for row in filenames[catalog_pix].data 
+            for f in (row['catalog'],row['mask_1'],row['mask_2'])]
+
+def scanHash(config, pix, filenames=None, confighash=None):
+    """
+    Stable hash identifying the likelihood scan of a pixel. Combines
+    the relevant config options with the checksums of the input files.
+
+    Parameters:
+    config     : Configuration object
+    pix        : Likelihood pixel (at 'nside_likelihood')
+    filenames  : Precomputed config.getFilenames()
+    confighash : Precomputed configHash(config)
+
+    Returns:
+    hash       : Hexadecimal digest
+    """
+    if confighash is None: confighash = configHash(config)
+    md5 = hashlib.md5(confighash)
+    for f in scanInputs(config,pix,filenames):
+        md5.update(os.path.basename(f)+fileChecksum(f))
+    return md5.hexdigest()
+
+def statHash(config, pix, filenames=None, confighash=None):
+    """
+    Quick hash of the likelihood scan of a pixel from the path, size,
+    and modification time of the input files (no file contents are
+    read). Used to skip the content hash when no input has changed.
+    """
+    if confighash is None: confighash = configHash(config)
+    md5 = hashlib.md5(confighash)
+    for f in scanInputs(config,pix,filenames):
+        stat = os.stat(f)
+        md5.update('%s %i %r'%(f,stat.st_size,stat.st_mtime))
+    return md5.hexdigest()
+
+def readScanHeader(filename):
+    """
+    Read the header of a likelihood file.
+    """
+    if filename.endswith('.npz'):
+        reader = np.load(filename)
+        header = dict(reader['HEADER_STR']) if 'HEADER_STR' in reader.files else {}
+        reader.close()
+        return header
+    return pyfits.getheader(filename,'PIX_DATA')
+
+def readScanHash(filename):
+    """
+    Read the scan hash from a likelihood file (None if absent).
+    """
+    return readScanHeader(filename).get('SCANHASH')
 
 ############################################################
 
 class GridSearch:
+    # Names of the '<name>_sparse_array' results
+    _results = ['log_likelihood','richness','richness_lower','richness_upper',
+                'richness_upper_limit','stellar_mass','fraction_observable']
 
     #def __init__(self, config, roi, mask, catalog, isochrone, kernel):
     #def __init__(self, config, observation, source):
@@ -98,6 +290,7 @@ class GridSearch:
 
         self.stellar_mass_conversion = self.loglike.source.stellar_mass()
         self.distance_modulus_array = np.asarray(self.config['scan']['distance_modulus_array'])
+        self.checkpoint = None
 
     def precompute(self, distance_modulus_array=None):
         """
@@ -137,117 +330,307 @@ class GridSearch:
         self.u_color_array = numpy.array(self.u_color_array)
 
                 
-    def search(self, coords=None, distance_modulus=None, tolerance=1.e-2):
+    def _allocate(self, nmoduli, npixels, shared=False):
+        """
+        Allocate the result arrays. Shared arrays are backed by
+        process-shared memory so that forked workers can fill them.
+        """
+        for name in self._results:
+            if shared:
+                buf = multiprocessing.sharedctypes.RawArray('d',nmoduli*npixels)
+                array = numpy.frombuffer(buf,dtype=float).reshape(nmoduli,npixels)
+            else:
+                array = numpy.zeros([nmoduli, npixels])
+            setattr(self,'%s_sparse_array'%name,array)
+        # Cells filled by interpolation (adaptive search only)
+        self.interpolated_sparse_array = None
+        # Cells that have been fit
+        self.completed = numpy.zeros([nmoduli, npixels],dtype=bool)
+        self._start = time.time()
+        self._resume()
+
+    def search(self, coords=None, distance_modulus=None, tolerance=1.e-2, nproc=None):
         """
         Organize a grid search over ROI target pixels and distance moduli in distance_modulus_array
         coords: (lon,lat)
         distance_modulus: scalar
+        nproc: number of processes (default: config['scan']['nproc'])
         """
+        if coords is None and distance_modulus is None \
+                and self.config['scan'].get('adaptive',False):
+            return self.search_adaptive(nproc=nproc)
+
+        if nproc is None: nproc = self.config['scan'].get('nproc',1)
+        nproc = max(int(nproc or 1),1)
+
         nmoduli = len(self.distance_modulus_array)
         npixels    = len(self.roi.pixels_target)
-        self.log_likelihood_sparse_array       = numpy.zeros([nmoduli, npixels])
-        self.richness_sparse_array             = numpy.zeros([nmoduli, npixels])
-        self.richness_lower_sparse_array       = numpy.zeros([nmoduli, npixels])
-        self.richness_upper_sparse_array       = numpy.zeros([nmoduli, npixels])
-        self.richness_upper_limit_sparse_array = numpy.zeros([nmoduli, npixels])
-        self.stellar_mass_sparse_array         = numpy.zeros([nmoduli, npixels])
-        self.fraction_observable_sparse_array  = numpy.zeros([nmoduli, npixels])
+        self._allocate(nmoduli, npixels, shared=(nproc > 1))
 
         # Specific pixel/distance_modulus
-        coord_idx, distance_modulus_idx = None, None
+        moduli = numpy.arange(nmoduli)
+        pixels = numpy.arange(npixels)
         if coords is not None:
             # Match to nearest grid coordinate index
             coord_idx = self.roi.indexTarget(coords[0],coords[1])
+            pixels = pixels[pixels == coord_idx]
         if distance_modulus is not None:
             # Match to nearest distance modulus index
             distance_modulus_idx=np.fabs(self.distance_modulus_array-distance_modulus).argmin()
+            moduli = moduli[moduli == distance_modulus_idx]
 
-        lon, lat = self.roi.pixels_target.lon, self.roi.pixels_target.lat
-            
         logger.info('Looping over distance moduli in grid search ...')
-        for ii, distance_modulus in enumerate(self.distance_modulus_array):
+        self._evaluate([(ii,pixels) for ii in moduli], nproc)
+        for ii in moduli: self._log_maximum(ii)
+        self.runtime = time.time() - self._start
+
+    def search_adaptive(self, stride=None, threshold=None, nproc=None):
+        """
+        Coarse-to-fine grid search over distance modulus. All target
+        pixels are fit at every 'stride' entry of distance_modulus_array
+        (always including the last). The full grid is then evaluated
+        only between the neighbours of coarse local maxima with
+        TS > threshold. The remaining cells are linearly interpolated
+        between the coarse moduli and flagged in interpolated_sparse_array.
+
+        stride: step of the coarse grid (default: config['scan']['adaptive_stride'])
+        threshold: TS for refinement (default: config['scan']['adaptive_threshold'])
+        nproc: number of processes (default: config['scan']['nproc'])
+        """
+        if stride is None: stride = self.config['scan'].get('adaptive_stride',4)
+        if threshold is None: threshold = self.config['scan'].get('adaptive_threshold',4.)
+        if nproc is None: nproc = self.config['scan'].get('nproc',1)
+        nproc = max(int(nproc or 1),1)
+        stride = max(int(stride),1)
 
-            # Specific pixel
-            if distance_modulus_idx is not None:
-                if ii != distance_modulus_idx: continue
+        nmoduli = len(self.distance_modulus_array)
+        npixels    = len(self.roi.pixels_target)
+        self._allocate(nmoduli, npixels, shared=(nproc > 1))
+        pixels = numpy.arange(npixels)
+        evaluated = numpy.zeros([nmoduli, npixels],dtype=bool)
+
+        coarse = numpy.unique(numpy.append(numpy.arange(0,nmoduli,stride),nmoduli-1))
+        logger.info('Coarse grid search over %i of %i distance moduli ...'%(len(coarse),nmoduli))
+        self._evaluate([(ii,pixels) for ii in coarse], nproc)
+        evaluated[coarse] = True
+
+        # Local maxima of the coarse TS profile of each pixel
+        ts = 2. * self.log_likelihood_sparse_array[coarse]
+        peak = (ts > threshold)
+        peak[1:]  &= (ts[1:] >= ts[:-1])
+        peak[:-1] &= (ts[:-1] >= ts[1:])
+
+        # Refine out to the neighbouring coarse moduli
+        refine = numpy.zeros_like(evaluated)
+        for k in range(len(coarse)):
+            lo = coarse[max(k-1,0)]
+            hi = coarse[min(k+1,len(coarse)-1)]
+            refine[lo:hi+1,peak[k]] = True
+        refine &= ~evaluated
+
+        logger.info('Refining %i of %i cells ...'%(refine.sum(),refine.size))
+        tasks = [(ii,pixels[refine[ii]]) for ii in numpy.nonzero(refine.any(axis=1))[0]]
+        self._evaluate(tasks, nproc)
+        evaluated |= refine
+
+        # Interpolate the remaining cells between coarse moduli
+        moduli = self.distance_modulus_array
+        idx = numpy.arange(nmoduli)
+        hi = coarse[numpy.searchsorted(coarse,idx,side='left')]
+        lo = coarse[numpy.searchsorted(coarse,idx,side='right')-1]
+        delta = numpy.where(hi > lo, moduli[hi] - moduli[lo], 1.)
+        weight = ((moduli[idx] - moduli[lo])/delta)[:,numpy.newaxis]
+
+        interpolated = ~evaluated
+        for name in self._results:
+            array = getattr(self,'%s_sparse_array'%name)
+            values = (1.-weight)*array[lo] + weight*array[hi]
+            array[interpolated] = values[interpolated]
+        self.interpolated_sparse_array = interpolated
+
+        for ii in range(nmoduli): self._log_maximum(ii)
+        self.runtime = time.time() - self._start
+
+    def _evaluate(self, tasks, nproc=1):
+        """
+        Fit a list of (distance modulus index, pixel indices) tasks,
+        skipping cells that have already been completed.
+        """
+        tasks = [(ii,pixels[~self.completed[ii][pixels]]) for ii,pixels in tasks]
+        tasks = [(ii,pixels) for ii,pixels in tasks if len(pixels)]
+
+        if nproc > 1 and multiprocessing.current_process().daemon:
+            # Daemonic workers (e.g., the 'pool' batch) cannot fork
+            logger.warning("Running in a daemonic process; ignoring nproc=%i."%nproc)
+            nproc = 1
+
+        if nproc > 1: 
+            return self._evaluate_parallel(tasks, nproc)
 
+        nmoduli = len(self.distance_modulus_array)
+        for ii,pixels in tasks:
+            distance_modulus = self.distance_modulus_array[ii]
             logger.info('  (%-2i/%i) Distance Modulus=%.1f ...'%(ii+1,nmoduli,distance_modulus))
 
             # Set distance_modulus once to save time
             self.loglike.set_params(distance_modulus=distance_modulus)
 
-            for jj in range(0, npixels):
-                # Specific pixel
-                if coord_idx is not None:
-                    if jj != coord_idx: continue
-
-                # Set kernel location
-                self.loglike.set_params(lon=lon[jj],lat=lat[jj])
-                # Doesn't re-sync distance_modulus each time
-                self.loglike.sync_params()
-                                         
-                args = (jj+1, npixels, self.loglike.source.lon, self.loglike.source.lat)
-                message = '    (%-3i/%i) Candidate at (%.2f, %.2f) ... '%(args)
-
-                self.log_likelihood_sparse_array[ii][jj], self.richness_sparse_array[ii][jj], parabola = self.loglike.fit_richness()
-                self.stellar_mass_sparse_array[ii][jj] = self.stellar_mass_conversion * self.richness_sparse_array[ii][jj]
-                self.fraction_observable_sparse_array[ii][jj] = self.loglike.f
-                if self.config['scan']['full_pdf']:
-                    #n_pdf_points = 100
-                    #richness_range = parabola.profileUpperLimit(delta=25.) - self.richness_sparse_array[ii][jj]
-                    #richness = numpy.linspace(max(0., self.richness_sparse_array[ii][jj] - richness_range),
-                    #                          self.richness_sparse_array[ii][jj] + richness_range,
-                    #                          n_pdf_points)
-                    #if richness[0] > 0.:
-                    #    richness = numpy.insert(richness, 0, 0.)
-                    #    n_pdf_points += 1
-                    # 
-                    #log_likelihood = numpy.zeros(n_pdf_points)
-                    #for kk in range(0, n_pdf_points):
-                    #    log_likelihood[kk] = self.loglike.value(richness=richness[kk])
-                    #parabola = ugali.utils.parabola.Parabola(richness, 2.*log_likelihood)
-                    #self.richness_lower_sparse_array[ii][jj], self.richness_upper_sparse_array[ii][jj] = parabola.confidenceInterval(0.6827)
-                    self.richness_lower_sparse_array[ii][jj], self.richness_upper_sparse_array[ii][jj] = self.loglike.richness_interval(0.6827)
-                    
-                    self.richness_upper_limit_sparse_array[ii][jj] = parabola.bayesianUpperLimit(0.95)
-
-                    args = (
-                        2. * self.log_likelihood_sparse_array[ii][jj],
-                        self.stellar_mass_conversion*self.richness_sparse_array[ii][jj],
-                        self.stellar_mass_conversion*self.richness_lower_sparse_array[ii][jj],
-                        self.stellar_mass_conversion*self.richness_upper_sparse_array[ii][jj],
-                        self.stellar_mass_conversion*self.richness_upper_limit_sparse_array[ii][jj]
-                    )
-                    message += 'TS=%.1f, Stellar Mass=%.1f (%.1f -- %.1f @ 0.68 CL, < %.1f @ 0.95 CL)'%(args)
-                else:
-                    args = (
-                        2. * self.log_likelihood_sparse_array[ii][jj], 
-                        self.stellar_mass_conversion * self.richness_sparse_array[ii][jj],
-                        self.fraction_observable_sparse_array[ii][jj]
-                    )
-                    message += 'TS=%.1f, Stellar Mass=%.1f, Fraction=%.2g'%(args)
-                logger.debug( message )
-                
-                #if coords is not None and distance_modulus is not None:
-                #    results = [self.richness_sparse_array[ii][jj],
-                #               self.log_likelihood_sparse_array[ii][jj],
-                #               self.richness_lower_sparse_array[ii][jj],
-                #               self.richness_upper_sparse_array[ii][jj],
-                #               self.richness_upper_limit_sparse_array[ii][jj],
-                #               richness, log_likelihood, self.loglike.p, self.loglike.f]
-                #    return results
-
-            jj_max = self.log_likelihood_sparse_array[ii].argmax()
+            for jj in pixels:
+                self._fit_pixel(ii,jj)
+                self.completed[ii][jj] = True
+                self._checkpoint()
+        self._checkpoint(force=True)
+
+    def _evaluate_parallel(self, tasks, nproc):
+        """
+        Distribute (distance modulus, pixel chunk) tasks to a pool of
+        forked processes. The observation, source, and precomputed
+        arrays are inherited by the workers rather than pickled, and
+        results are written directly into the shared output arrays.
+        The per-pixel computation is identical to the serial search.
+        """
+        global _GRID
+        # Split each modulus into enough chunks to occupy the pool
+        nchunks = int(numpy.ceil(nproc/float(max(len(tasks),1))))
+        tasks = [(ii,chunk) for ii,pixels in tasks 
+                 for chunk in numpy.array_split(pixels,max(min(nchunks,len(pixels)),1))]
+
+        logger.info('  Running %i tasks on %i processes ...'%(len(tasks),nproc))
+        _GRID = self
+        pool = multiprocessing.Pool(nproc)
+        try:
+            for ii,pixels in pool.imap_unordered(_search_task,tasks):
+                logger.debug('  Finished %i pixels at Distance Modulus=%.1f'%(len(pixels),self.distance_modulus_array[ii]))
+                self.completed[ii][pixels] = True
+                self._checkpoint()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _GRID = None
+        self._checkpoint(force=True)
+
+    def set_checkpoint(self, filename, interval=None):
+        """
+        Periodically save the partial results of the search to
+        'filename'. If the file already exists, the search resumes
+        from it and skips the completed cells.
+
+        filename: checkpoint file (numpy .npz format)
+        interval: seconds between checkpoints (default: config['scan']['checkpoint_interval'])
+        """
+        if interval is None: 
+            interval = self.config['scan'].get('checkpoint_interval',600)
+        self.checkpoint = filename
+        self.checkpoint_interval = interval
+        self._checkpoint_time = time.time()
+
+    def clear_checkpoint(self):
+        """ Remove the checkpoint file (i.e., after writing the output). """
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            logger.debug("Removing %s..."%self.checkpoint)
+            os.remove(self.checkpoint)
+
+    def _checkpoint(self, force=False):
+        if self.checkpoint is None: return
+        if not force and (time.time()-self._checkpoint_time) < self.checkpoint_interval:
+            return
+
+        logger.info("Writing checkpoint %s..."%self.checkpoint)
+        data = dict([(name,getattr(self,'%s_sparse_array'%name)) for name in self._results])
+        data['completed'] = self.completed
+        data['distance_modulus'] = self.distance_modulus_array
+        data['pixels'] = numpy.asarray(self.roi.pixels_target)
+        # Write to a temporary file so that the checkpoint is always valid
+        tmpfile = self.checkpoint + '.tmp'
+        with open(tmpfile,'wb') as out:
+            numpy.savez_compressed(out,**data)
+        os.rename(tmpfile,self.checkpoint)
+        self._checkpoint_time = time.time()
+
+    def _resume(self):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint): return
+
+        logger.info("Resuming from checkpoint %s..."%self.checkpoint)
+        data = numpy.load(self.checkpoint)
+        if not numpy.array_equal(data['distance_modulus'],self.distance_modulus_array) \
+                or not numpy.array_equal(data['pixels'],self.roi.pixels_target):
+            logger.warning("Checkpoint does not match search grid; ignoring...")
+            return
+        for name in self._results:
+            # Fill in place to preserve shared arrays
+            getattr(self,'%s_sparse_array'%name)[:] = data[name]
+        self.completed[:] = data['completed']
+        logger.info("  %i of %i cells completed"%(self.completed.sum(),self.completed.size))
+
+    def _fit_pixel(self, ii, jj):
+        """
+        Fit the richness at distance modulus index ii and target
+        pixel index jj. Assumes the distance modulus is already set.
+        """
+        npixels = len(self.roi.pixels_target)
+        lon, lat = self.roi.pixels_target.lon, self.roi.pixels_target.lat
+
+        # Set kernel location
+        self.loglike.set_params(lon=lon[jj],lat=lat[jj])
+        # Doesn't re-sync distance_modulus each time
+        self.loglike.sync_params()
+                                 
+        args = (jj+1, npixels, self.loglike.source.lon, self.loglike.source.lat)
+        message = '    (%-3i/%i) Candidate at (%.2f, %.2f) ... '%(args)
+
+        self.log_likelihood_sparse_array[ii][jj], self.richness_sparse_array[ii][jj], parabola = self.loglike.fit_richness()
+        self.stellar_mass_sparse_array[ii][jj] = self.stellar_mass_conversion * self.richness_sparse_array[ii][jj]
+        self.fraction_observable_sparse_array[ii][jj] = self.loglike.f
+        if self.config['scan']['full_pdf']:
+            #n_pdf_points = 100
+            #richness_range = parabola.profileUpperLimit(delta=25.) - self.richness_sparse_array[ii][jj]
+            #richness = numpy.linspace(max(0., self.richness_sparse_array[ii][jj] - richness_range),
+            #                          self.richness_sparse_array[ii][jj] + richness_range,
+            #                          n_pdf_points)
+            #if richness[0] > 0.:
+            #    richness = numpy.insert(richness, 0, 0.)
+            #    n_pdf_points += 1
+            # 
+            #log_likelihood = numpy.zeros(n_pdf_points)
+            #for kk in range(0, n_pdf_points):
+            #    log_likelihood[kk] = self.loglike.value(richness=richness[kk])
+            #parabola = ugali.utils.parabola.Parabola(richness, 2.*log_likelihood)
+            #self.richness_lower_sparse_array[ii][jj], self.richness_upper_sparse_array[ii][jj] = parabola.confidenceInterval(0.6827)
+            self.richness_lower_sparse_array[ii][jj], self.richness_upper_sparse_array[ii][jj] = self.loglike.richness_interval(0.6827)
+            
+            self.richness_upper_limit_sparse_array[ii][jj] = parabola.bayesianUpperLimit(0.95)
+
+            args = (
+                2. * self.log_likelihood_sparse_array[ii][jj],
+                self.stellar_mass_conversion*self.richness_sparse_array[ii][jj],
+                self.stellar_mass_conversion*self.richness_lower_sparse_array[ii][jj],
+                self.stellar_mass_conversion*self.richness_upper_sparse_array[ii][jj],
+                self.stellar_mass_conversion*self.richness_upper_limit_sparse_array[ii][jj]
+            )
+            message += 'TS=%.1f, Stellar Mass=%.1f (%.1f -- %.1f @ 0.68 CL, < %.1f @ 0.95 CL)'%(args)
+        else:
             args = (
-                jj_max+1, npixels, lon[jj_max], lat[jj_max],
-                2. * self.log_likelihood_sparse_array[ii][jj_max], 
-                self.stellar_mass_conversion * self.richness_sparse_array[ii][jj_max]
+                2. * self.log_likelihood_sparse_array[ii][jj], 
+                self.stellar_mass_conversion * self.richness_sparse_array[ii][jj],
+                self.fraction_observable_sparse_array[ii][jj]
             )
-            message = '  (%-3i/%i) Maximum at (%.2f, %.2f) ... TS=%.1f, Stellar Mass=%.1f'%(args)
-            logger.info( message )
-            #outfile = 'srcmdl_%i.yaml'%ii
-            #print "Writing %s..."%outfile
-            #self.loglike.source.write(outfile)
+            message += 'TS=%.1f, Stellar Mass=%.1f, Fraction=%.2g'%(args)
+        logger.debug( message )
+
+    def _log_maximum(self, ii):
+        npixels = len(self.roi.pixels_target)
+        lon, lat = self.roi.pixels_target.lon, self.roi.pixels_target.lat
+        jj_max = self.log_likelihood_sparse_array[ii].argmax()
+        args = (
+            jj_max+1, npixels, lon[jj_max], lat[jj_max],
+            2. * self.log_likelihood_sparse_array[ii][jj_max], 
+            self.stellar_mass_conversion * self.richness_sparse_array[ii][jj_max]
+        )
+        message = '  (%-3i/%i) Maximum at (%.2f, %.2f) ... TS=%.1f, Stellar Mass=%.1f'%(args)
+        logger.info( message )
             
     def mle(self):
         a = self.log_likelihood_sparse_array
@@ -318,7 +701,13 @@ class GridSearch:
     def write(self, outfile):
         """
         Save the likelihood fitting results as a sparse HEALPix map.
+
+        outfile: output filename (FITS, or compact binary if '.npz')
         """
+        nside_likelihood = self.config['coords']['nside_likelihood']
+        nside_pixel = self.config['coords']['nside_pixel']
+        lkdpix = ang2pix(nside_likelihood,self.roi.lon,self.roi.lat)
+
         # Full data output (too large for survey)
         if self.config['scan']['full_pdf']:
             data_dict = {'LOG_LIKELIHOOD': self.log_likelihood_sparse_array.transpose(),
@@ -333,29 +722,65 @@ class GridSearch:
                          'RICHNESS': self.richness_sparse_array.transpose(),
                          'FRACTION_OBSERVABLE': self.fraction_observable_sparse_array.transpose()}
 
+        # Flag the cells interpolated by the adaptive search
+        if getattr(self,'interpolated_sparse_array',None) is not None:
+            data_dict['INTERPOLATED'] = self.interpolated_sparse_array.transpose().astype(float)
+
         # Stellar Mass can be calculated from STELLAR * RICHNESS
+        lon,lat = self.loglike.catalog_roi.lon,self.loglike.catalog_roi.lat
         header_dict = {
             'STELLAR' : round(self.stellar_mass_conversion,8),
-            'LKDNSIDE': self.config['coords']['nside_likelihood'],
-            'LKDPIX'  : ang2pix(self.config['coords']['nside_likelihood'],self.roi.lon,self.roi.lat),
-            'NROI'    : self.roi.inROI(self.loglike.catalog_roi.lon,self.loglike.catalog_roi.lat).sum(), 
-            'NANNULUS': self.roi.inAnnulus(self.loglike.catalog_roi.lon,self.loglike.catalog_roi.lat).sum(), 
-            'NINSIDE' : self.roi.inInterior(self.loglike.catalog_roi.lon,self.loglike.catalog_roi.lat).sum(), 
-            'NTARGET' : self.roi.inTarget(self.loglike.catalog_roi.lon,self.loglike.catalog_roi.lat).sum(), 
+            'LKDNSIDE': nside_likelihood,
+            'LKDPIX'  : lkdpix,
+            'NROI'    : self.roi.inROI(lon,lat).sum(), 
+            'NANNULUS': self.roi.inAnnulus(lon,lat).sum(), 
+            'NINSIDE' : self.roi.inInterior(lon,lat).sum(), 
+            'NTARGET' : self.roi.inTarget(lon,lat).sum(), 
+            # Search time (s)
+            'RUNTIME' : round(getattr(self,'runtime',0.),2),
         }
 
+        # The scan hash is only needed to validate cached results
+        if self.config.get('batch',{}).get('cache',False):
+            # Reuse the input checksums computed by the farm
+            likedir = self.config['output']['likedir']
+            loadChecksums(os.path.join(likedir,'checksums.json'))
+            header_dict['SCANHASH'] = scanHash(self.config,lkdpix)
+            header_dict['STATHASH'] = statHash(self.config,lkdpix)
+
         # In case there is only a single distance modulus
         if len(self.distance_modulus_array) == 1:
             for key in data_dict:
                 data_dict[key] = data_dict[key].flatten()
 
-        ugali.utils.skymap.writeSparseHealpixMap(self.roi.pixels_target,
-                                                 data_dict,
-                                                 self.config['coords']['nside_pixel'],
-                                                 outfile,
-                                                 distance_modulus_array=self.distance_modulus_array,
-                                                 coordsys='NULL', ordering='NULL',
-                                                 header_dict=header_dict)
+        # Compact binary output
+        if outfile.endswith('.npz'): 
+            writer = ugali.utils.skymap.writeCompactHealpixMap
+        else:
+            writer = ugali.utils.skymap.writeSparseHealpixMap
+
+        writer(self.roi.pixels_target,
+               data_dict,
+               nside_pixel,
+               outfile,
+               distance_modulus_array=self.distance_modulus_array,
+               header_dict=header_dict)
+
+############################################################
+
+# GridSearch inherited by forked worker processes
+_GRID = None
+
+def _search_task(args):
+    """
+    Worker for the parallel grid search; fits a chunk of target
+    pixels at a single distance modulus.
+    """
+    ii, pixels = args
+    _GRID.loglike.set_params(distance_modulus=_GRID.distance_modulus_array[ii])
+    for jj in pixels:
+        _GRID._fit_pixel(ii,jj)
+    return ii, pixels
 
 ############################################################
     
@@ -367,17 +792,26 @@ if __name__ == "__main__":
     parser.add_argument('outfile',metavar='outfile.fits',help='Output fits file.')
     parser.add_debug()
     parser.add_verbose()
-    parser.add_coords(required=True,radius=False)
+    parser.add_coords(required=False,radius=False)
+    parser.add_argument('--pixels',nargs='+',type=int,default=None,
+                        help="Likelihood pixels to scan in sequence (outfile is a filename template).")
     opts = parser.parse_args()
 
-    if len(opts.coords) != 1: 
+    if opts.pixels is not None:
+        status = scanPixels(opts.config,opts.pixels,opts.outfile,debug=opts.debug)
+        sys.exit(status > 0)
+
+    if opts.coords is None or len(opts.coords) != 1: 
         raise Exception('Must specify exactly one coordinate.')
     lon,lat,radius = opts.coords[0]
 
     grid = createGridSearch(opts.config,lon,lat)
+    if grid.config['scan'].get('checkpoint',False):
+        grid.set_checkpoint(checkpointFile(opts.outfile))
     if not opts.debug:
         result = grid.search()
         grid.write(opts.outfile)
+        grid.clear_checkpoint()
 
 
     ##print opts.coords
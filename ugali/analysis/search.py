@@ -13,7 +13,6 @@ import pyfits
 import numpy as np
 import numpy
 import numpy.lib.recfunctions as recfuncs
-import scipy.ndimage as ndimage
 
 import ugali.candidate.associate
 import ugali.utils.skymap
@@ -22,6 +21,7 @@ from ugali.utils.shell import mkdir, which
 from ugali.utils.logger import logger
 from ugali.utils.binning import reverseHistogram
 from ugali.utils.projector import Projector, gal2cel, dec2hms, dec2dms, mod2dist
+from ugali.utils.projector import aitoffSphereToImage, aitoffImageToSphere
 from ugali.utils.healpix import pix2ang, ang2pix
 
 class CandidateSearch(object):
@@ -56,17 +56,62 @@ class CandidateSearch(object):
 
     def loadLikelihood(self,filename=None):
         if filename is None: filename = self.mergefile
-        f = pyfits.open(self.mergefile)
+        if self.config['search'].get('stream',False):
+            return self.streamLikelihood(filename)
+        f = pyfits.open(filename)
         self.pixels = f[1].data['PIX']
         self.values = 2*f[1].data['LOG_LIKELIHOOD']
         self.distances = f[2].data['DISTANCE_MODULUS']
         self.richness = f[1].data['RICHNESS']
 
+    def streamLikelihood(self,filename=None,nrows=2**18):
+        """
+        Read the merged likelihood in chunks of nrows, keeping only the
+        pixels above threshold (at any distance modulus) and their
+        neighbours. Memory scales with the number of candidate pixels.
+        """
+        if filename is None: filename = self.mergefile
+        f = pyfits.open(filename,memmap=True)
+        data = f[1].data
+        ntotal = f[1].header['NAXIS2']
+        self.distances = numpy.array(f[2].data['DISTANCE_MODULUS'])
+
+        # Pixels above threshold
+        seeds = [numpy.zeros(0,dtype=int)]
+        for start in range(0,ntotal,nrows):
+            chunk = data[start:start+nrows]
+            ts = 2*chunk.field('LOG_LIKELIHOOD').reshape(len(chunk),-1)
+            select = (ts > self.threshold).any(axis=1)
+            seeds.append(numpy.array(chunk.field('PIX')[select],dtype=int))
+        seeds = numpy.concatenate(seeds)
+        neighbours = healpy.get_all_neighbours(self.nside,seeds).ravel() if len(seeds) else seeds
+        keep = numpy.unique(numpy.concatenate([seeds,neighbours]))
+        keep = keep[keep >= 0]
+
+        pixels,values,richness = [],[],[]
+        for start in range(0,ntotal,nrows):
+            chunk = data[start:start+nrows]
+            pix = chunk.field('PIX')
+            if len(keep):
+                idx = numpy.searchsorted(keep,pix).clip(0,len(keep)-1)
+                select = (keep[idx] == pix)
+            else:
+                select = numpy.zeros(len(pix),dtype=bool)
+            pixels.append(numpy.array(pix[select]))
+            values.append(2*chunk.field('LOG_LIKELIHOOD')[select])
+            richness.append(numpy.array(chunk.field('RICHNESS')[select]))
+        f.close()
+
+        self.pixels = numpy.concatenate(pixels)
+        self.values = numpy.concatenate(values)
+        self.richness = numpy.concatenate(richness)
+        logger.info("Kept %i of %i pixels (%i above threshold)."%(len(self.pixels),ntotal,len(seeds)))
+
     def loadROI(self,filename=None):
         if filename is None: filename = self.roifile
-        self.ninterior = ugali.utils.skymap.readSparseHealpixMap(filename,'NINSIDE')
-        self.nannulus = ugali.utils.skymap.readSparseHealpixMap(filename,'NANNULUS')
-        self.stellar = ugali.utils.skymap.readSparseHealpixMap(filename,'STELLAR')
+        self.ninterior = ugali.utils.skymap.SparseHealpixMap.read(filename,'NINSIDE')
+        self.nannulus = ugali.utils.skymap.SparseHealpixMap.read(filename,'NANNULUS')
+        self.stellar = ugali.utils.skymap.SparseHealpixMap.read(filename,'STELLAR')
 
     def createLabels2D(self):
         """ 2D labeling at zmax """
@@ -134,10 +179,16 @@ class CandidateSearch(object):
         hdu.writeto(filename,clobber=True)
 
     @staticmethod
-    def labelHealpix(pixels, values, nside, threshold=0, xsize=1000):
+    def labelHealpix(pixels, values, nside, threshold=0, xsize=None):
         """
-        Label contiguous regions of a (sparse) HEALPix map. Works by mapping 
-        HEALPix array to a Mollweide projection and applying scipy.ndimage.label
+        Label contiguous regions of a (sparse) HEALPix map. The pixels
+        above threshold are dilated by one step (to their HEALPix
+        neighbours from healpy.get_all_neighbours, in the same and
+        adjacent distance slices), the connected components of the
+        dilated set are found, and the labels are trimmed back to the
+        pixels above threshold. As with the former binary dilation of
+        the Mollweide image, regions separated by a one-pixel gap
+        share a label. No projection or dense raster is built.
      
         Assumes non-nested HEALPix map.
         
@@ -146,47 +197,57 @@ class CandidateSearch(object):
         values    : (Sparse) HEALPix array of data values
         nside     : HEALPix dimensionality
         threshold : Threshold value for object detection
-        xsize     : Size of Mollweide projection
+        xsize     : Unused (size of the former Mollweide projection)
         
         Returns:
         labels, nlabels
         """
-        proj = healpy.projector.MollweideProj(xsize=xsize)
-        vec = healpy.pix2vec(nside,pixels)
-        xy = proj.vec2xy(vec)
-        ij = proj.xy2ij(xy)
-        xx,yy = proj.ij2xy()
-     
-        # Convert to Mollweide
-        searchims = []
-        if values.ndim < 2: iterate = [values]
-        else:               iterate = values.T
-        for i,value in enumerate(iterate):
-            logger.debug("Labeling slice %i...")
-            searchim = numpy.zeros(xx.shape,dtype=bool)
-            select = (value > threshold)
-            yidx = ij[0][select]; xidx = ij[1][select]
-            searchim[yidx,xidx] |= True
-            searchims.append( searchim )
-        searchims = numpy.array(searchims)
-
-        # Full binary structure
-        s = ndimage.generate_binary_structure(searchims.ndim,searchims.ndim)
-     
-        ### # Dilate in the z-direction
-        logger.info("  Dilating image...")
-        searchims = ndimage.binary_dilation(searchims,s,1)
-        
-        # Do the labeling
-        logger.info("  Labeling image...")
-        labels,nlabels = ndimage.label(searchims,structure=s)
+        import scipy.sparse
+        import scipy.sparse.csgraph
 
-        # Convert back to healpix
-        pix_labels = labels[:,ij[0],ij[1]].T
-        pix_labels = pix_labels.reshape(values.shape)
-        pix_labels *= (values > threshold) # re-trim
-
-        return pix_labels, nlabels
+        pixels = numpy.asarray(pixels)
+        shape = values.shape
+        values = values.reshape(len(pixels),-1)
+        nz = values.shape[1]
+
+        # Above-threshold entries (spatial index, distance index)
+        idx,zidx = numpy.nonzero(values > threshold)
+        labels = numpy.zeros(values.shape,dtype=int)
+        if len(idx) == 0: return labels.reshape(shape), 0
+
+        def neighbours(pix, z):
+            # Keys (pix*nz + z) of each entry and its neighbours (-1 if none)
+            upix,inv = numpy.unique(pix,return_inverse=True)
+            npix = numpy.vstack([upix,healpy.get_all_neighbours(nside,upix)])[:,inv]
+            keys = []
+            for dz in [-1,0,1]:
+                zz = z + dz
+                key = npix*nz + zz
+                key[(npix < 0) | (zz < 0) | (zz >= nz)] = -1
+                keys.append(key)
+            return numpy.vstack(keys)
+
+        # Dilate the above-threshold entries by one step
+        seeds = pixels[idx]*nz + zidx
+        nodes = numpy.unique(neighbours(pixels[idx],zidx))
+        nodes = nodes[nodes >= 0]
+        nnodes = len(nodes)
+
+        # Link the dilated entries to their dilated neighbours
+        logger.info("  Labeling %i pixels..."%len(idx))
+        keys = neighbours(nodes//nz,nodes%nz)
+        pos = numpy.searchsorted(nodes,keys).clip(0,nnodes-1)
+        found = (nodes[pos] == keys) & (keys >= 0)
+        heads = numpy.nonzero(found)[1]
+        tails = pos[found]
+
+        graph = scipy.sparse.coo_matrix((numpy.ones(len(heads),dtype=bool),(heads,tails)),
+                                        shape=(nnodes,nnodes))
+        nlabels,components = scipy.sparse.csgraph.connected_components(graph,directed=False)
+        # Trim back to the above-threshold entries
+        labels[idx,zidx] = components[numpy.searchsorted(nodes,seeds)] + 1
+
+        return labels.reshape(shape), nlabels
 
     @staticmethod
     def findObjects(pixels, values, nside, zvalues, rev, good):
@@ -224,55 +285,60 @@ class CandidateSearch(object):
                                   ('Z_BARY','f4'),
                                   ('CUT','i2'),])
         objs['CUT'][:] = 0
-     
-        shape = values.shape
-        ncol = shape[1]
-        for i in range(0,ngood):
-            logger.debug("i=%i",i)
-            # This code could use some cleanup...
-            indices=rev[rev[good[i]]:rev[good[i]+1]]
-            npix = len(indices)
-            idx = indices // ncol # This is the spatial index
-            zidx = indices % ncol  # This is the distance index
-     
-            pix = pixels[idx] # This is the healpix pixel
-            xval,yval = pix2ang(nside, pix)
-            zval = zvalues[zidx]
-            
-            objs[i]['LABEL'] = good[i]
-            objs[i]['NPIX'] = npix
-            logger.debug("LABEL=%i"%objs[i]['LABEL'])
-            logger.debug("NPIX=%i"%objs[i]['NPIX'])
-     
-            island = values[idx,zidx]
-            idxmax = island.argmax()
-            xval_max,yval_max,zval_max = xval[idxmax],yval[idxmax],zval[idxmax]
-     
-            objs[i]['VAL_MAX'] = island[idxmax]
-            objs[i]['IDX_MAX']  = idx[idxmax]
-            objs[i]['ZIDX_MAX']  = zidx[idxmax]
-            objs[i]['PIX_MAX']   = pix[idxmax]
-            objs[i]['X_MAX']  = xval_max
-            objs[i]['Y_MAX']  = yval_max
-            objs[i]['Z_MAX']  = zval_max
-
-            proj = Projector(xval_max,yval_max)
-            xpix,ypix = proj.sphereToImage(xval,yval)
-
-            # Projected centroid
-            x_cent,y_cent,zval_cent = numpy.average([xpix,ypix,zval],axis=1)
-            xval_cent, yval_cent = proj.imageToSphere(x_cent,y_cent)
-            objs[i]['X_CENT'] = xval_cent
-            objs[i]['Y_CENT'] = yval_cent
-            objs[i]['Z_CENT'] = zval_cent
-
-            # Projected barycenter
-            weights=[island,island,island]
-            x_bary,y_bary,zval_bary = numpy.average([xpix,ypix,zval],weights=weights,axis=1)
-            xval_bary,yval_bary = proj.imageToSphere(x_bary, y_bary)
-            objs[i]['X_BARY'] = xval_bary
-            objs[i]['Y_BARY'] = yval_bary
-            objs[i]['Z_BARY'] = zval_bary
+        if ngood == 0: return objs
+
+        # Entries of all objects, grouped by object (from the reverse indices)
+        good = numpy.asarray(good)
+        start,stop = rev[good],rev[good+1]
+        npix = stop - start
+        group = numpy.repeat(numpy.arange(ngood),npix)
+        first = numpy.cumsum(npix) - npix
+        indices = rev[numpy.arange(len(group)) - first[group] + start[group]]
+
+        ncol = values.shape[1]
+        idx = indices // ncol # This is the spatial index
+        zidx = indices % ncol  # This is the distance index
+        pix = pixels[idx] # This is the healpix pixel
+        xval,yval = pix2ang(nside, pix)
+        zval = zvalues[zidx]
+        island = values[idx,zidx]
+
+        # Maximum of each object (first entry for ties)
+        order = numpy.lexsort((-numpy.arange(len(group)),island,group))
+        imax = order[first + npix - 1]
+
+        objs['LABEL'] = good
+        objs['NPIX'] = npix
+        objs['VAL_MAX'] = island[imax]
+        objs['IDX_MAX'] = idx[imax]
+        objs['ZIDX_MAX'] = zidx[imax]
+        objs['PIX_MAX'] = pix[imax]
+        objs['X_MAX'] = xval[imax]
+        objs['Y_MAX'] = yval[imax]
+        objs['Z_MAX'] = zval[imax]
+
+        # Project each entry about the maximum of its object
+        rotators = [Projector(x,y).rotator for x,y in zip(xval[imax],yval[imax])]
+        matrix = numpy.array([numpy.array(r.rotation_matrix) for r in rotators])
+        inverse = numpy.array([numpy.array(r.inverted_rotation_matrix) for r in rotators])
+        def rotate(m, lon, lat):
+            vec = numpy.einsum('nij,jn->in',m,rotators[0].cartesian(lon,lat))
+            return numpy.degrees(numpy.arctan2(vec[1],vec[0])) % 360., numpy.degrees(numpy.arcsin(vec[2]))
+        xpix,ypix = aitoffSphereToImage(*rotate(matrix[group],xval,yval))
+
+        # Projected centroid
+        counts = npix.astype(float)
+        x_cent = numpy.bincount(group,xpix,ngood)/counts
+        y_cent = numpy.bincount(group,ypix,ngood)/counts
+        objs['X_CENT'],objs['Y_CENT'] = rotate(inverse,*aitoffImageToSphere(x_cent,y_cent))
+        objs['Z_CENT'] = numpy.bincount(group,zval,ngood)/counts
+
+        # Projected barycenter
+        weights = numpy.bincount(group,island,ngood)
+        x_bary = numpy.bincount(group,island*xpix,ngood)/weights
+        y_bary = numpy.bincount(group,island*ypix,ngood)/weights
+        objs['X_BARY'],objs['Y_BARY'] = rotate(inverse,*aitoffImageToSphere(x_bary,y_bary))
+        objs['Z_BARY'] = numpy.bincount(group,island*zval,ngood)/weights
      
         return objs
 
@@ -308,7 +374,7 @@ class CandidateSearch(object):
         #nannulus = ugali.utils.skymap.readSparseHealpixMap(self.roifile,'NANNULUS')
         #stellar = ugali.utils.skymap.readSparseHealpixMap(self.roifile,'STELLAR')
 
-        nside = healpy.npix2nside(len(self.nannulus))
+        nside = self.nannulus.nside
         pix = ang2pix(nside,glon,glat)
 
         richness = self.richness[objects['IDX_MAX'],objects['ZIDX_MAX']]
@@ -366,9 +432,7 @@ class CandidateSearch(object):
         names.fill('')
         for i,refs in enumerate(self.config['search']['catalogs']):
             i += 1
-            catalog = ugali.candidate.associate.SourceCatalog()
-            for ref in refs:
-                catalog += ugali.candidate.associate.catalogFactory(ref)
+            catalog = ugali.candidate.associate.CompiledCatalog(refs)
      
             # String length (should be greater than longest name)
             length = len(max(catalog['name'],key=len)) + 1
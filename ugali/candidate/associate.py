@@ -14,6 +14,8 @@ import ugali.utils.projector
 from ugali.utils.projector import gal2cel, cel2gal
 import ugali.utils.idl
 from ugali.utils.healpix import ang2pix
+from ugali.utils.shell import get_ugali_dir
+from ugali.utils.logger import logger
 
 #class Catalog(numpy.recarray):
 # 
@@ -411,16 +413,144 @@ def catalogFactory(name, **kwargs):
     catalogs = odict(inspect.getmembers(sys.modules[__name__], fn))
 
     if name not in catalogs.keys():
-        msg = "%s not found in catalogs:\n %s"%(name,kernels.keys())
+        msg = "%s not found in catalogs:\n %s"%(name,catalogs.keys())
         logger.error(msg)
         msg = "Unrecognized catalog: %s"%name
         raise Exception(msg)
 
     return catalogs[name](**kwargs)
 
+############################################################
+
+# Compiled reference catalogs
+CATALOGFILE = 'reference_catalogs.pkl'
+_COMPILED = dict()
+
+def catalogNames():
+    """ Names of the reference catalogs. """
+    fn = lambda member: inspect.isclass(member) and member.__module__==__name__ \
+        and issubclass(member,SourceCatalog) and member not in (SourceCatalog,CompiledCatalog)
+    return [name for name,member in inspect.getmembers(sys.modules[__name__], fn)]
+
+def _catalogFingerprint():
+    """ Latest modification time of the catalog sources and parsers. """
+    mtimes = [os.path.getmtime(abspath(__file__))]
+    for root,dirs,files in os.walk(SourceCatalog.DATADIR):
+        mtimes += [os.path.getmtime(join(root,f)) for f in files]
+    return max(mtimes)
+
+def _unitVectors(glon, glat):
+    return ugali.utils.projector.SphericalRotator(0,0).cartesian(glon,glat).T
+
+def _buildTrees(compiled):
+    """ Build the cKDTree of the unit vectors of each compiled catalog. """
+    from scipy.spatial import cKDTree
+    for entry in compiled['catalogs'].values():
+        if 'tree' in entry: continue
+        vec = _unitVectors(entry['data']['glon'],entry['data']['glat'])
+        entry['tree'] = cKDTree(vec) if len(vec) else None
+    return compiled
+
+def compileCatalogs(filename=None, names=None):
+    """
+    Parse the reference catalogs once and write their data to a single
+    binary file. The trees are rebuilt on loading, since cKDTree can
+    not be pickled with all versions of scipy.
+    """
+    import cPickle
+    if filename is None: filename = join(get_ugali_dir(),CATALOGFILE)
+    if names is None: names = catalogNames()
+
+    compiled = odict(fingerprint=_catalogFingerprint(),catalogs=odict())
+    for name in names:
+        try:
+            catalog = catalogFactory(name)
+        except Exception as e:
+            logger.warning("Skipping catalog %s: %s"%(name,e))
+            continue
+        compiled['catalogs'][name] = dict(data=catalog.data)
+
+    logger.info("Writing %s..."%filename)
+    tmpfile = '%s.%i.tmp'%(filename,os.getpid())
+    try:
+        out = open(tmpfile,'wb')
+        cPickle.dump(compiled,out,cPickle.HIGHEST_PROTOCOL)
+        out.close()
+        os.rename(tmpfile,filename)
+    except (IOError,OSError,TypeError,cPickle.PicklingError) as e:
+        logger.warning("Failed to write %s: %s"%(filename,e))
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+    _COMPILED[filename] = _buildTrees(compiled)
+    return compiled
+
+def loadCatalogs(filename=None):
+    """
+    Load the compiled reference catalogs. The catalogs are recompiled
+    when the catalog files (or their parsers) have changed.
+    """
+    import cPickle
+    if filename is None: filename = join(get_ugali_dir(),CATALOGFILE)
+    compiled = _COMPILED.get(filename)
+    if compiled is None and os.path.exists(filename):
+        try:
+            compiled = cPickle.load(open(filename,'rb'))
+        except Exception as e:
+            logger.warning("Failed to read %s: %s"%(filename,e))
+    if compiled is None or compiled.get('fingerprint') != _catalogFingerprint():
+        compiled = compileCatalogs(filename)
+    _COMPILED[filename] = _buildTrees(compiled)
+    return compiled
+
+class CompiledCatalog(SourceCatalog):
+    """
+    Union of reference catalogs loaded from the compiled catalog file.
+    Matching is a batch query of the prebuilt tree of each catalog.
+    """
+    def __init__(self, names, filename=None):
+        if isinstance(names,basestring): names = [names]
+        compiled = loadCatalogs(filename)
+        missing = [n for n in names if n not in compiled['catalogs']]
+        if missing:
+            raise Exception("Catalogs not compiled: %s"%missing)
+        self.names = list(names)
+        self.entries = [compiled['catalogs'][n] for n in names]
+        self.data = numpy.concatenate([e['data'] for e in self.entries])
+
+    def match(self,lon,lat,coord='gal',tol=0.1,nnearest=1):
+        if nnearest != 1 or len(self.data) == 0:
+            return super(CompiledCatalog,self).match(lon,lat,coord,tol,nnearest)
+        if coord.lower() == 'cel':
+            glon, glat = cel2gal(lon,lat)
+        else:
+            glon,glat = numpy.asarray(lon), numpy.asarray(lat)
+        vec = _unitVectors(numpy.ravel(glon),numpy.ravel(glat))
+
+        # Nearest neighbour over all the catalogs
+        chord = numpy.inf*numpy.ones(len(vec))
+        idx2 = numpy.zeros(len(vec),dtype=int)
+        offset = 0
+        for entry in self.entries:
+            if entry['tree'] is not None:
+                d,i = entry['tree'].query(vec)
+                closer = d < chord
+                chord[closer] = d[closer]
+                idx2[closer] = i[closer] + offset
+            offset += len(entry['data'])
+
+        idx1 = numpy.arange(len(vec))
+        ds = ugali.utils.projector.angsep(numpy.ravel(glon),numpy.ravel(glat),
+                                          self['glon'][idx2],self['glat'][idx2])
+        if tol is not None:
+            msk = ds < tol
+            idx1,idx2,ds = idx1[msk],idx2[msk],ds[msk]
+        return idx1,idx2,ds
+
 if __name__ == "__main__":
     import argparse
-    description = "python script"
+    description = "Compile the reference catalogs."
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('args',nargs=argparse.REMAINDER)
-    opts = parser.parse_args(); args = opts.args
+    parser.add_argument('-o','--outfile',default=None,
+                        help="Compiled catalog file (default: $UGALIDIR/%s)"%CATALOGFILE)
+    parser.add_argument('names',nargs='*',help="Catalogs to compile (default: all)")
+    opts = parser.parse_args()
+    compileCatalogs(opts.outfile,opts.names or None)
@@ -20,7 +20,7 @@ from ugali.utils.logger import logger
 
 class Catalog:
 
-    def __init__(self, config, roi=None, data=None):
+    def __init__(self, config, roi=None, data=None, cache=None):
         """
         Class to store information about detected objects.
 
@@ -31,12 +31,13 @@ class Catalog:
             config: Config object
             roi[None] : Region of Interest to load catalog data for
             data[None]: pyfits table data (fitsrec) object.
+            cache[None]: dictionary of previously read catalog files
         """
         #self = config.merge(config_merge) # Maybe you would want to update parameters??
         self.config = Config(config)
 
         if data is None:
-            self._parse(roi)
+            self._parse(roi,cache)
         else:
             self.data = data
 
@@ -108,7 +109,7 @@ class Catalog:
         hdu = pyfits.BinTableHDU(self.data)
         hdu.writeto(outfile, clobber=True)
 
-    def _parse(self, roi=None):
+    def _parse(self, roi=None, cache=None):
         """
         Helper function to parse a catalog file and return a pyfits table.
 
@@ -123,7 +124,7 @@ class Catalog:
             raise Exception("No catalog file found")
         elif roi is not None:
             pixels = roi.getCatalogPixels()
-            self.data = readCatalogData(filenames['catalog'][pixels])
+            self.data = readCatalogData(filenames['catalog'][pixels],cache)
         elif len(filenames['catalog'].compressed()) == 1:
             file_type = filenames[0].split('.')[-1].strip().lower()
             if file_type == 'csv':
@@ -264,12 +265,22 @@ def precomputeCoordinates(infile, outfile):
 
 ############################################################
 
-def readCatalogData(infiles):
-    """ Read a set of catalog FITS files into a single recarray. """
+def readCatalogData(infiles, cache=None):
+    """ 
+    Read a set of catalog FITS files into a single recarray. 
+
+    If a `cache` dictionary is supplied, files that are already
+    present are taken from it and newly read files are added to it.
+    """
     if isinstance(infiles,basestring): infiles = [infiles]
     data, len_data = [],[]
     for f in infiles:
-        data.append(pyfits.open(f)[1].data)
+        if cache is not None and f in cache:
+            logger.debug("Using cached %s"%f)
+            data.append(cache[f])
+        else:
+            data.append(pyfits.open(f)[1].data)
+            if cache is not None: cache[f] = data[-1]
         len_data.append(len(data[-1]))
 
     cumulative_len_array = numpy.cumsum(len_data)
@@ -664,8 +664,8 @@ class MaskBand:
         Infile is a sparse HEALPix map fits file.
         """
         self.roi = roi
-        mask = ugali.utils.skymap.readSparseHealpixMaps(infiles, field='MAGLIM')
-        self.nside = healpy.npix2nside(len(mask))
+        mask = ugali.utils.skymap.SparseHealpixMap.read(infiles, field='MAGLIM')
+        self.nside = mask.nside
         # Sparse maps of pixels in various ROI regions
         self.mask_roi_sparse = mask[self.roi.pixels] 
 
@@ -13,23 +13,79 @@ import ugali.utils.skymap
 description="Run the likelihood search."
 components = ['scan','merge','tar','plot']
 
+def chain(self):
+    """
+    Run the scan, merge, and search (run_04 'label' and 'objects') as
+    dependent jobs through the scheduler. Lost or failed jobs are
+    retried, and each step starts once the previous one has finished.
+    """
+    from ugali.utils.scheduler import Scheduler
+    import ugali.utils.batch
+
+    queue = self.opts.queue or self.config['batch']['cluster']
+    batch = ugali.utils.batch.batchFactory(queue,**self.config['batch']['opts'])
+    logdir = mkdir(join(self.config['output']['likedir'],'log'))
+    scheduler = Scheduler(batch,statusdir=mkdir(join(logdir,'status')),
+                          max_jobs=self.config['batch']['max_jobs'])
+
+    farm = Farm(self.config,batch=batch)
+    scan = farm.submit_all(coords=self.opts.coords,queue=queue,scheduler=scheduler)
+
+    # The merged results are stale if any pixels are (re)scanned
+    force = bool(scan) or self.opts.force
+    script = os.path.abspath(__file__)
+    cmd = 'python %s %s -r merge'%(script,self.opts.config)
+    outputs = [self.config.mergefile,self.config.roifile]
+    scheduler.add('merge',cmd+' --force'*force,depends=scan,
+                  outputs=[] if force else outputs,logfile=join(logdir,'merge.log'))
+
+    script = join(os.path.dirname(script),'run_04.0_peak_finder.py')
+    cmd = 'python %s %s -r label -r objects'%(script,self.opts.config)
+    outputs = [self.config.labelfile,self.config.objectfile]
+    scheduler.add('search',cmd+' --force'*force,depends=['merge'],
+                  outputs=[] if force else outputs,logfile=join(logdir,'search.log'))
+
+    if self.opts.debug: 
+        for job in scheduler.jobs.values(): logger.info("  "+job.command)
+        return
+    return scheduler.run()
+
 def run(self):
+    if self.opts.chain:
+        logger.info("Running 'scan', 'merge', and 'search' as a chain...")
+        return chain(self)
+
     if 'scan' in self.opts.run:
         logger.info("Running 'scan'...")
-        farm = Farm(self.config)
+        # With an explicit queue, submit through the pipeline batch so
+        # that its jobs are joined by the pipeline
+        batch = self.batch if self.opts.queue else None
+        farm = Farm(self.config,batch=batch)
         farm.submit_all(coords=self.opts.coords,queue=self.opts.queue,debug=self.opts.debug)
 
     if 'merge' in self.opts.run:
         logger.info("Running 'merge'...")
         mergefile = self.config.mergefile
         roifile = self.config.roifile
-        if (exists(mergefile) or exists(roifile)) and not self.opts.force:
+        mergedir = self.config['output'].get('mergedir')
+        if mergedir:
+            # Incremental merge; only new or changed files are read
+            mergedir = join(self.config['output']['likedir'],mergedir)
+            infiles = ugali.utils.skymap.likelihoodFiles(self.config.likefile)
+            merger = ugali.utils.skymap.LikelihoodMerger(mergedir,size=0)
+            nfiles = merger.add(infiles)
+            logger.info("  Merged %i new or changed files (%i total)"%(nfiles,len(merger.merged)))
+            merger.write(mergefile,roifile)
+        elif (exists(mergefile) or exists(roifile)) and not self.opts.force:
             logger.info("  Found %s; skipping..."%mergefile)
             logger.info("  Found %s; skipping..."%roifile)
         else:
-            filenames = self.config.likefile.split('_%')[0]+'_*'
-            infiles = sorted(glob.glob(filenames))
-            ugali.utils.skymap.mergeLikelihoodFiles(infiles,mergefile,roifile)
+            infiles = ugali.utils.skymap.likelihoodFiles(self.config.likefile)
+            buffer_size = self.config['output'].get('merge_buffer',64) * 1024**2
+            nproc = self.config['output'].get('merge_nproc',1)
+            partition = self.config['output'].get('merge_partition',1000)
+            ugali.utils.skymap.mergeLikelihoodFiles(infiles,mergefile,roifile,buffer_size,
+                                                    nproc,partition)
 
     if 'tar' in self.opts.run:
         logger.info("Running 'tar'...")
@@ -61,5 +117,7 @@ def run(self):
 Pipeline.run = run
 pipeline = Pipeline(description,components)
 pipeline.parser.add_coords(radius=True,targets=True)
+pipeline.parser.add_argument('--chain',action='store_true',
+                             help="Run scan, merge, and search as dependent jobs.")
 pipeline.parse_args()
 pipeline.execute()
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
+import os,sys
 import subprocess, subprocess as sub
 import getpass
+import time
+import shlex
+import traceback
+import multiprocessing
 from collections import OrderedDict as odict
 from itertools import chain
 import copy
@@ -9,6 +14,7 @@ from ugali.utils.logger import logger
 
 CLUSTERS = odict([
     ('local',['local']),
+    ('pool',['pool']),
     ('lsf',['lsf','slac','kipac']),
     ('slurm',['slurm','midway','kicp']),
     ('condor',['condor','fnal']),
@@ -16,6 +22,7 @@ CLUSTERS = odict([
 
 QUEUES = odict([
     ('local',[]),
+    ('pool',[]),
     ('lsf',['express','short','medium','long','xlong','xxl','kipac-ibq','bulletmpi']),
     ('slurm',[]),
     ('condor',['local','vanilla','universe','grid']),
@@ -42,6 +49,8 @@ def factory(queue,**kwargs):
 
     if name in CLUSTERS['local']+QUEUES['local']:
         batch = Local(**kwargs)
+    elif name in CLUSTERS['pool']+QUEUES['pool']:
+        batch = Pool(**kwargs)
     elif name in CLUSTERS['lsf']+QUEUES['lsf']:
         batch = LSF(**kwargs)
     elif name in CLUSTERS['slurm']+QUEUES['slurm']:
@@ -69,6 +78,8 @@ class Batch(object):
         self.default_opts.update(**kwargs)
         self.submit_cmd = "submit %(opts)s %(command)s"
         self.jobs_cmd = "jobs"
+        self.names_cmd = None
+        self.kill_cmd = None
 
     def jobs(self):
         out = self.popen(self.jobs_cmd)
@@ -80,6 +91,22 @@ class Batch(object):
         jobs = self.jobs()
         return len(jobs.strip().split('\n'))-1 if jobs else 0
 
+    def jobnames(self):
+        """
+        Names of the user's jobs in the batch queue.
+        """
+        if self.names_cmd is None: return set()
+        out = self.popen(self.names_cmd)
+        stdout = out.communicate()[0]
+        return set(l.strip() for l in stdout.split('\n') if l.strip())
+
+    def kill(self, jobname):
+        """
+        Kill the user's jobs with the given name.
+        """
+        if self.kill_cmd is None: return
+        return self.call(self.kill_cmd%dict(jobname=jobname))
+
     def popen(self, command):
         return sub.Popen(command,shell=True,
                          stdin=sub.PIPE,stdout=sub.PIPE,stderr=sub.PIPE)
@@ -106,6 +133,60 @@ class Batch(object):
         self.call(cmd)
         return cmd
 
+    def submit_array(self, commands, jobname=None, logfiles=None, arrayfile=None, **opts):
+        """
+        Submit a list of commands as a job array. Backends without
+        array support submit one job per command.
+
+        Returns:
+        cmds : List of submission commands
+        """
+        if logfiles is None: logfiles = [None]*len(commands)
+        return [self.submit(c,jobname,l,**opts) for c,l in zip(commands,logfiles)]
+
+    def write_array(self, arrayfile, commands, logfiles=None, index='INDEX'):
+        """
+        Write the commands of a job array to 'arrayfile' (one per line)
+        along with a driver script that executes the line selected by
+        the environment variable 'index'.
+
+        Returns:
+        driver : Filename of the driver script
+        """
+        if logfiles is None: logfiles = [None]*len(commands)
+        out = open(arrayfile,'w')
+        for cmd,log in zip(commands,logfiles):
+            if log: cmd = '%s > %s 2>&1'%(cmd,log)
+            out.write(cmd+'\n')
+        out.close()
+
+        driver = os.path.splitext(arrayfile)[0]+'.sh'
+        out = open(driver,'w')
+        out.write('#!/bin/sh\n')
+        out.write('cmd=$(sed -n "${%s}p" %s)\n'%(index,arrayfile))
+        out.write('eval "$cmd"\n')
+        out.close()
+        return driver
+
+    def throttle(self, max_jobs, sleep=10):
+        """
+        Block until fewer than max_jobs jobs are in the queue.
+        """
+        while True:
+            njobs = self.njobs()
+            if njobs < max_jobs:
+                break
+            else:
+                logger.info('%i jobs already in queue, waiting...'%(njobs))
+                time.sleep(sleep)
+
+    def join(self):
+        """
+        Wait for the submitted jobs to finish (only for backends that
+        run the jobs in this process).
+        """
+        return []
+
 class Local(Batch):
     def __init__(self,**kwargs):
         super(Local,self).__init__(**kwargs)
@@ -116,6 +197,253 @@ class Local(Batch):
         if opts.get('logfile'): return ' | tee %(logfile)s'%opts
         return ''
 
+def _init_worker():
+    """
+    Enable the per-process caches of parsed config and isochrone
+    files, so that they are read once per worker rather than once
+    per job.
+    """
+    import ugali.utils.config
+    import ugali.analysis.isochrone
+    ugali.utils.config.CACHE = dict()
+    ugali.analysis.isochrone.CACHE = dict()
+
+def _run_job(command, logfile=None):
+    """
+    Execute a command inside a pool worker. Python scripts are run
+    in-process with runpy (reusing the modules already imported by
+    the worker); anything else goes through the shell. Output is
+    redirected to the logfile.
+
+    Returns:
+    status : Exit status of the command
+    """
+    import runpy
+
+    if logfile:
+        sys.stdout.flush(); sys.stderr.flush()
+        saved = [os.dup(1), os.dup(2)]
+        log = open(logfile,'a')
+        os.dup2(log.fileno(),1); os.dup2(log.fileno(),2)
+    argv0 = sys.argv
+    try:
+        argv = shlex.split(command)
+        if argv and argv[0].startswith('python') and len(argv) > 1: 
+            argv = argv[1:]
+        shell = any(c in command for c in '|;&<>$`')
+        if shell or not argv or not argv[0].endswith('.py'):
+            return sub.call(command,shell=True)
+
+        sys.argv = argv
+        try:
+            runpy.run_path(argv[0],run_name='__main__')
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code,int) else int(e.code is not None)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        return status
+    finally:
+        sys.argv = argv0
+        if logfile:
+            sys.stdout.flush(); sys.stderr.flush()
+            os.dup2(saved[0],1); os.dup2(saved[1],2)
+            os.close(saved[0]); os.close(saved[1])
+            log.close()
+
+class Pool(Batch):
+    """
+    Execute jobs in a persistent pool of local worker processes.
+
+    Python scripts run inside the (warm) workers, so the interpreter
+    start-up, module imports, and parsing of the config and isochrone
+    files are paid once per worker rather than once per job. The number of workers is the CPU count, limited by
+    the memory budget ('memory' / 'job_memory', in MB) if given.
+    """
+    _defaults = odict([
+        ('processes', None),
+        ('memory', None),
+        ('job_memory', None),
+    ])
+
+    def __init__(self, **kwargs):
+        super(Pool,self).__init__(**kwargs)
+        self.jobs_cmd = "echo 0"
+        self.submit_cmd = "%(command)s %(opts)s"
+        self.processes = self.nprocesses()
+        self.pool = None
+        self.pending = []
+        self.failed = []
+
+    def nprocesses(self):
+        opts = self.default_opts
+        nproc = opts.get('processes') or multiprocessing.cpu_count()
+        if opts.get('memory') and opts.get('job_memory'):
+            nproc = min(nproc,int(opts['memory']//opts['job_memory']))
+        return max(nproc,1)
+
+    def parse_options(self,**opts):
+        if opts.get('logfile'): return '> %(logfile)s'%opts
+        return ''
+
+    def jobs(self):
+        self.pending = [j for j in self.pending if not j[1].ready()]
+        return self.pending
+
+    def njobs(self):
+        return len(self.jobs())
+
+    def jobnames(self):
+        return set(j[2] for j in self.jobs() if j[2] is not None)
+
+    def submit(self, command, jobname=None, logfile=None, **opts):
+        if self.pool is None:
+            logger.info("Starting pool of %i processes..."%self.processes)
+            self.pool = multiprocessing.Pool(self.processes,_init_worker)
+
+        def callback(status, command=command):
+            if status: 
+                logger.warning("Job failed (%s): %s"%(status,command))
+                self.failed.append(command)
+
+        job = self.pool.apply_async(_run_job,(command,logfile),callback=callback)
+        self.pending.append((command,job,jobname))
+        return self.batch(command, jobname, logfile, **opts)
+
+    def throttle(self, max_jobs, sleep=None):
+        """
+        Block until any pending job completes if max_jobs are queued.
+        """
+        max_jobs = max(max_jobs,self.processes)
+        while self.njobs() >= max_jobs:
+            time.sleep(0.1)
+
+    def join(self):
+        """
+        Wait for all jobs to finish and shut down the pool.
+
+        Returns:
+        failed : Commands that returned a non-zero status
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.pending = []
+        failed,self.failed = self.failed,[]
+        for command in failed:
+            logger.error("Failed: %s"%command)
+        return failed
+
+class Manager(object):
+    """
+    Submission manager that wraps a batch backend. Submissions are
+    buffered and sent as job arrays, the queue state is queried at
+    most once per 'interval', and completion can be detected by
+    watching the output files instead of polling the queue.
+
+    Usage:
+    manager = Manager(batch,max_jobs=250,interval=60)
+    manager.submit(cmd,jobname,logfile,outputs=[outfile])
+    manager.flush(arrayfile)
+    manager.wait()
+    """
+    def __init__(self, batch, max_jobs=None, interval=60, array=True):
+        """
+        Parameters:
+          batch    : Batch backend
+          max_jobs : Maximum number of jobs in the queue
+          interval : Minimum time between queue queries [s]
+          array    : Submit buffered commands as job arrays
+        """
+        self.batch = batch
+        self.max_jobs = max_jobs
+        self.interval = interval
+        self.array = array
+
+        self.buffer = []
+        self.outputs = []
+        self._njobs = 0
+        self._queried = None
+
+    def njobs(self):
+        """
+        Number of jobs in the queue, from a cached query plus the jobs
+        submitted since.
+        """
+        now = time.time()
+        if self._queried is None or (now - self._queried) >= self.interval:
+            self._njobs = self.batch.njobs()
+            self._queried = now
+        return self._njobs
+
+    def throttle(self, njobs=1):
+        """
+        Wait until there is room in the queue for njobs jobs. Returns
+        the number of jobs that can be submitted.
+        """
+        if self.max_jobs is None: return njobs
+        while True:
+            room = self.max_jobs - self.njobs()
+            if room > 0: return min(room,njobs)
+            logger.info('%i jobs already in queue, waiting...'%(self._njobs))
+            time.sleep(max(self.interval - (time.time()-self._queried),0))
+
+    def submit(self, command, jobname=None, logfile=None, outputs=[]):
+        """ Buffer a command for submission. """
+        self.buffer.append((command,jobname,logfile))
+        self.outputs.extend(outputs)
+
+    def flush(self, arrayfile=None, **opts):
+        """
+        Submit the buffered commands, as job arrays if possible. With
+        max_jobs set, the commands are split into arrays that fit in
+        the queue.
+
+        Returns:
+        cmds : List of submission commands
+        """
+        cmds = []
+        buf,self.buffer = self.buffer,[]
+        nsub = 0
+        while buf:
+            n = self.throttle(len(buf))
+            chunk,buf = buf[:n],buf[n:]
+            commands,jobnames,logfiles = map(list,zip(*chunk))
+            if self.array and arrayfile:
+                base,ext = os.path.splitext(arrayfile)
+                filename = '%s_%i%s'%(base,nsub,ext)
+                cmds += self.batch.submit_array(commands,jobnames[0],logfiles,filename,**opts)
+            else:
+                cmds += [self.batch.submit(c,j,l,**opts) for c,j,l in chunk]
+            nsub += 1
+            self._njobs += len(chunk)
+        for cmd in cmds: logger.info("  "+cmd)
+        return cmds
+
+    def done(self):
+        """ Check whether all watched output files exist. """
+        return all(os.path.exists(f) for f in self.outputs)
+
+    def wait(self, timeout=None):
+        """
+        Wait until all watched output files exist (or the queue is
+        empty when no outputs are watched).
+
+        Returns:
+        done : True if completed before the timeout
+        """
+        start = time.time()
+        while True:
+            if self.outputs:
+                if self.done(): return True
+            elif self.njobs() == 0: 
+                return True
+            if timeout is not None and (time.time()-start) > timeout:
+                return False
+            time.sleep(self.interval)
+
 class LSF(Batch):
     _defaults = odict([
         ('R','"scratch > 1 && rhel60"'),
@@ -132,6 +460,8 @@ class LSF(Batch):
         super(LSF,self).__init__(**kwargs)
 
         self.jobs_cmd = "bjobs -u %s"%self.username
+        self.names_cmd = 'bjobs -u %s -noheader -o "job_name"'%self.username
+        self.kill_cmd = "bkill -u %s -J %%(jobname)s"%self.username
         self.submit_cmd = "bsub %(opts)s %(command)s"
 
     def runlimit(self, queue=None):
@@ -142,6 +472,18 @@ class LSF(Batch):
         
     q2w = runlimit
 
+    def submit_array(self, commands, jobname=None, logfiles=None, arrayfile=None, **opts):
+        """
+        Submit the commands as a single LSF job array (indexed by
+        LSB_JOBINDEX). The array log goes to '<arrayfile>.%I.log'.
+        """
+        if arrayfile is None or len(commands) < 2:
+            return super(LSF,self).submit_array(commands,jobname,logfiles,**opts)
+        driver = self.write_array(arrayfile,commands,logfiles,index='LSB_JOBINDEX')
+        jobname = '"%s[1-%i]"'%(jobname or 'array',len(commands))
+        logfile = os.path.splitext(arrayfile)[0]+'.%I.log'
+        return [self.submit('sh %s'%driver,jobname,logfile,**opts)]
+
     def parse_options(self, **opts):
         options = odict(self.default_opts)
         options.update(opts)
@@ -158,13 +500,31 @@ class Slurm(Batch):
         ('mem',10000)
     ])
 
+    _mapping = odict([
+        ('jobname','job-name'),
+        ('logfile','output')
+    ])
+
     def __init__(self, **kwargs):
         super(Slurm,self).__init__(**kwargs)
         logger.warning('Slurm cluster is untested')
 
         self.jobs_cmd = "squeue -u %s"%self.username
+        self.names_cmd = "squeue -u %s -h -o %%j"%self.username
+        self.kill_cmd = "scancel -u %s -n %%(jobname)s"%self.username
         self.submit_cmd = "sbatch %(opts)s %(command)s"
 
+    def submit_array(self, commands, jobname=None, logfiles=None, arrayfile=None, **opts):
+        """
+        Submit the commands as a single Slurm job array (indexed by
+        SLURM_ARRAY_TASK_ID). The array log goes to '<arrayfile>.%a.log'.
+        """
+        if arrayfile is None or len(commands) < 2:
+            return super(Slurm,self).submit_array(commands,jobname,logfiles,**opts)
+        driver = self.write_array(arrayfile,commands,logfiles,index='SLURM_ARRAY_TASK_ID')
+        opts.update(array='1-%i'%len(commands),output=os.path.splitext(arrayfile)[0]+'.%a.log')
+        return [self.submit(driver,jobname,**opts)]
+
     def parse_options(self, **opts):
         options = odict(self.default_opts)
         options.update(opts)
@@ -177,6 +537,8 @@ class Condor(Batch):
         logger.warning('Condor cluster is untested')
         
         self.jobs_cmd = 'condor_q -u %s'%self.username
+        self.names_cmd = 'condor_q -u %s -af JobBatchName'%self.username
+        self.kill_cmd = "condor_rm -constraint 'JobBatchName==\"%(jobname)s\"'"
         self.submit_cmd = "csub %(opts)s %(command)s"
 
 if __name__ == "__main__":
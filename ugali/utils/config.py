@@ -15,6 +15,9 @@ import ugali.utils.config # To recognize own type
 try: import yaml
 except ImportError: logger.warning("YAML not found")
 
+# Parsed config files keyed by (path, mtime); enabled in pool workers
+CACHE = None
+
 class Config(dict):
     """
     Configuration object
@@ -53,6 +56,10 @@ class Config(dict):
     def _load(self, input):
         if isinstance(input, basestring):
             self.filename = input
+            key = None
+            if CACHE is not None:
+                key = (os.path.abspath(input), os.path.getmtime(input))
+                if key in CACHE: return copy.deepcopy(CACHE[key])
             ext = os.path.splitext(input)[1]
             if ext == '.py':
                 # ADW: This is dangerous and terrible!!!
@@ -64,6 +71,7 @@ class Config(dict):
                 params = yaml.load(open(input))
             else:
                 raise Exception('Unrecognized config format: %s'%ext)
+            if key is not None: CACHE[key] = copy.deepcopy(params)
         elif isinstance(input, Config):
             # This is the copy constructor...
             self.filename = input.filename
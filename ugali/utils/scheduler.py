@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+Dependency-aware scheduling of batch jobs.
+
+Jobs are submitted through a batch backend (ugali.utils.batch) as soon
+as the jobs they depend on have finished. Each command is wrapped so
+that its exit status is written to a status file, which is how job
+completion is detected on any backend. A job that leaves the batch
+queue without writing its status file (e.g., killed for exceeding its
+walltime or memory, or lost with its node), or that exceeds its
+timeout, is counted as failed; a timed-out job is killed before it is
+retried. Failed jobs are retried with exponential backoff; jobs whose
+outputs already exist are not run.
+
+Usage:
+scheduler = Scheduler(batch,statusdir='log')
+scheduler.add('scan','scan.py ...',outputs=['scan.fits'])
+scheduler.add('merge','merge.py ...',depends=['scan'])
+scheduler.run()
+"""
+import os
+from os.path import join, exists
+import time
+import pipes
+from collections import OrderedDict as odict
+
+from ugali.utils.logger import logger
+
+# Job states
+WAITING   = 'waiting'
+SUBMITTED = 'submitted'
+RETRY     = 'retry'
+DONE      = 'done'
+FAILED    = 'failed'
+CANCELLED = 'cancelled'
+
+class Job(object):
+    """
+    A single command with its outputs and dependencies.
+    """
+    def __init__(self, name, command, outputs=[], depends=[], retries=None,
+                 timeout=None, logfile=None, **opts):
+        """
+        Parameters:
+          name    : Unique job name
+          command : Shell command
+          outputs : Files that must exist for the job to be done
+          depends : Names of jobs that must be done first
+          retries : Number of retries (default: scheduler value)
+          timeout : Maximum time from submission to completion [s]
+                    (default: scheduler value)
+          logfile : Log file for the batch submission
+          opts    : Extra options passed to batch.submit
+        """
+        self.name = name
+        self.command = command
+        self.outputs = list(outputs)
+        self.depends = list(depends)
+        self.retries = retries
+        self.timeout = timeout
+        self.logfile = logfile
+        self.opts = opts
+
+        self.state = WAITING
+        self.attempts = 0
+        self.status = None
+        self.not_before = 0
+        self.submitted = None
+
+    def __str__(self):
+        return "%s (%s)"%(self.name,self.state)
+
+    @property
+    def complete(self):
+        return self.state in (DONE,FAILED,CANCELLED)
+
+    def outputs_exist(self):
+        return bool(self.outputs) and all(exists(f) for f in self.outputs)
+
+class Scheduler(object):
+    """
+    Track the state of a set of jobs and submit them in dependency order.
+    """
+    def __init__(self, batch, statusdir='.', retries=2, backoff=60.,
+                 poll=30., max_jobs=None, timeout=None, grace=120.):
+        """
+        Parameters:
+          batch     : Batch backend (ugali.utils.batch)
+          statusdir : Directory for the job status files
+          retries   : Default number of retries for failed jobs
+          backoff   : Delay before the first retry (doubled each time) [s]
+          poll      : Time between checks of running jobs [s]
+          max_jobs  : Maximum number of jobs submitted at once
+          timeout   : Default job timeout [s] (None for no timeout)
+          grace     : Time after submission before a job missing from
+                      the batch queue is considered lost [s]
+        """
+        self.batch = batch
+        self.statusdir = statusdir
+        self.retries = retries
+        self.backoff = backoff
+        self.poll = poll
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.grace = grace
+        self.jobs = odict()
+
+        if not exists(statusdir): os.makedirs(statusdir)
+
+    def add(self, name, command=None, **kwargs):
+        """
+        Add a job (either a Job object or the arguments to create one).
+        """
+        job = name if isinstance(name,Job) else Job(name,command,**kwargs)
+        if job.name in self.jobs:
+            raise Exception("Duplicate job name: %s"%job.name)
+        if job.retries is None: job.retries = self.retries
+        if job.timeout is None: job.timeout = self.timeout
+        self.jobs[job.name] = job
+        return job
+
+    def statusfile(self, job):
+        return join(self.statusdir,'%s.status'%job.name)
+
+    def wrap(self, job):
+        """
+        Wrap the job command to record its exit status.
+        """
+        script = '%s; echo $? > %s'%(job.command,self.statusfile(job))
+        return 'sh -c %s'%pipes.quote(script)
+
+    def submit(self, job):
+        statusfile = self.statusfile(job)
+        if exists(statusfile): os.remove(statusfile)
+        job.attempts += 1
+        job.state = SUBMITTED
+        job.status = None
+        job.submitted = time.time()
+        logger.info("Submitting %s (attempt %i)..."%(job.name,job.attempts))
+        self.batch.submit(self.wrap(job),job.name,job.logfile,**job.opts)
+
+    def queued(self):
+        """
+        Names of our jobs in the batch queue (None if unknown).
+        """
+        try:
+            return self.batch.jobnames()
+        except Exception as e:
+            # Assume the jobs are there if the queue can't be queried
+            logger.warning("Failed to query the batch queue: %s"%e)
+            return None
+
+    def kill(self, job):
+        try:
+            self.batch.kill(job.name)
+        except Exception as e:
+            logger.warning("Failed to kill %s: %s"%(job.name,e))
+
+    def check(self, job, queued=True):
+        """
+        Update the state of a submitted job from its status file. A job
+        without a status file is lost if it has left the batch queue
+        (`queued` is False) after the grace period, or if it has
+        exceeded its timeout (in which case it is killed).
+        """
+        statusfile = self.statusfile(job)
+        if not exists(statusfile): 
+            elapsed = time.time() - job.submitted
+            if not queued and elapsed >= self.grace:
+                logger.warning("%s is no longer in the batch queue."%job.name)
+            elif job.timeout is not None and elapsed >= job.timeout:
+                logger.warning("%s timed out after %g s."%(job.name,elapsed))
+                self.kill(job)
+            else:
+                return
+            self.fail(job)
+            return
+        try:
+            job.status = int(open(statusfile).read().strip())
+        except ValueError:
+            # Status file is still being written
+            return
+
+        if job.status == 0 and (not job.outputs or job.outputs_exist()):
+            logger.info("Finished %s."%job.name)
+            job.state = DONE
+        else:
+            self.fail(job)
+
+    def fail(self, job):
+        """
+        Schedule a retry of a failed job, or mark it as failed.
+        """
+        if job.attempts <= job.retries:
+            delay = self.backoff * 2**(job.attempts-1)
+            logger.warning("%s failed (status=%s); retrying in %g s..."%(job.name,job.status,delay))
+            job.state = RETRY
+            job.not_before = time.time() + delay
+        else:
+            logger.error("%s failed (status=%s)."%(job.name,job.status))
+            job.state = FAILED
+
+    def ready(self, job):
+        """
+        Check whether a waiting job can be submitted. Jobs with a
+        failed dependency are cancelled.
+        """
+        for name in job.depends:
+            dep = self.jobs[name]
+            if dep.state in (FAILED,CANCELLED):
+                logger.warning("Cancelling %s (%s %s)."%(job.name,name,dep.state))
+                job.state = CANCELLED
+                return False
+            if dep.state != DONE:
+                return False
+        if job.state == RETRY:
+            return time.time() >= job.not_before
+        return True
+
+    def step(self):
+        """
+        Check the running jobs and submit those that are ready.
+
+        Returns:
+        progress : True if any job changed state
+        """
+        progress = False
+        submitted = [job for job in self.jobs.values() if job.state == SUBMITTED]
+        # Query the queue before reading the status files; a job writes
+        # its status file before it leaves the queue
+        queued = self.queued() if submitted else None
+        for job in submitted:
+            self.check(job,queued is None or job.name in queued)
+            progress |= (job.state != SUBMITTED)
+
+        for job in self.jobs.values():
+            if job.state not in (WAITING,RETRY): continue
+            if job.state == WAITING and job.outputs_exist():
+                logger.info("Outputs of %s exist; skipping..."%job.name)
+                job.state = DONE
+                progress = True
+                continue
+            if self.max_jobs is not None and self.nsubmitted() >= self.max_jobs:
+                break
+            state = job.state
+            if self.ready(job):
+                self.submit(job)
+            progress |= (job.state != state)
+        return progress
+
+    def nsubmitted(self):
+        return sum(job.state == SUBMITTED for job in self.jobs.values())
+
+    def run(self):
+        """
+        Run until every job is done, failed, or cancelled.
+
+        Returns:
+        states : Dictionary of job name to final state
+        """
+        for job in self.jobs.values():
+            for name in job.depends:
+                if name not in self.jobs:
+                    raise Exception("Unknown dependency of %s: %s"%(job.name,name))
+
+        while not all(job.complete for job in self.jobs.values()):
+            if self.step(): continue
+            if not any(job.state in (SUBMITTED,RETRY) for job in self.jobs.values()):
+                # Nothing can make progress (circular dependencies)
+                for job in self.jobs.values():
+                    if not job.complete:
+                        logger.error("Cancelling %s (unresolved dependencies)."%job.name)
+                        job.state = CANCELLED
+                break
+            time.sleep(self.poll)
+        self.batch.join()
+
+        states = odict([(job.name,job.state) for job in self.jobs.values()])
+        nfailed = sum(s != DONE for s in states.values())
+        if nfailed: logger.warning("%i of %i jobs not done."%(nfailed,len(states)))
+        return states
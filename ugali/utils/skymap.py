@@ -2,9 +2,12 @@
 Tools for making maps of the sky with healpix.
 """
 
+import os
 import sys
 import re
 import gc
+import glob
+import json
 
 import numpy
 import healpy
@@ -32,39 +35,112 @@ def surveyPixel(lon, lat, nside_pix, nside_subpix = None):
             subpix_array.append(subpix)
         return pix, numpy.array(subpix_array)
 
-def inFootprint(config, pixels, nside=None):
+# Footprint indices loaded and checked in this process (keyed by filename)
+_FOOTPRINT = dict()
+
+def _maskFilenames(config, filenames):
+    """ Filenames for the catalog pixels with existing files. """
+    if not config['coords']['nside_catalog']: return filenames.data
+    return filenames[filenames['pix'].compressed()].data
+
+def _footprintFingerprint(config, filenames):
+    """ Names, sizes, and modification times of the mask files. """
+    import os
+    fingerprint = []
+    for fnames in _maskFilenames(config,filenames):
+        for f in (fnames['mask_1'],fnames['mask_2']):
+            stat = os.stat(f)
+            fingerprint.append([f,stat.st_size,stat.st_mtime])
+    return json.dumps(fingerprint)
+
+def _buildFootprintIndex(config, filenames):
+    """ Read the mask files to find the covered pixels at nside_pixel. """
+    nside_pixel = config['coords']['nside_pixel']
+    subpix_array = []
+    for fnames in _maskFilenames(config,filenames):
+        logger.debug("Loading %s"%fnames['mask_1'])
+        subpix_1,val_1 = readSparseHealpixMap(fnames['mask_1'],'MAGLIM',construct_map=False)
+        logger.debug("Loading %s"%fnames['mask_2'])
+        subpix_2,val_2 = readSparseHealpixMap(fnames['mask_2'],'MAGLIM',construct_map=False)
+        subpix_array.append(numpy.intersect1d(subpix_1,subpix_2))
+    index = dict()
+    subpix = numpy.concatenate(subpix_array) if subpix_array else numpy.zeros(0,dtype=int)
+    index['NSIDE_%i'%nside_pixel] = numpy.unique(subpix)
+    for key in ['nside_catalog','nside_mask','nside_likelihood']:
+        nside = config['coords'].get(key)
+        if not nside or nside > nside_pixel: continue
+        index['NSIDE_%i'%nside] = numpy.unique(superpixel(index['NSIDE_%i'%nside_pixel],nside_pixel,nside))
+    return index
+
+def _writeFootprintIndex(filename, index):
+    """ Write the index through a temporary file (safe for concurrent jobs). """
+    import os
+    try:
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname): os.makedirs(dirname)
+        tmpfile = '%s.%i.tmp'%(filename,os.getpid())
+        out = open(tmpfile,'wb')
+        numpy.savez(out,**index)
+        out.close()
+        os.rename(tmpfile,filename)
+    except (IOError,OSError) as e:
+        logger.warning("Could not write footprint index: %s"%e)
+
+def footprintIndex(config, nside=None, filename=None, write=True):
     """
-    Open each valid filename for the set of pixels and determine the set 
-    of subpixels with valid data.
+    Sorted array of the pixels at resolution nside that contain valid
+    data in both mask files. The index is built from the mask files
+    once, persisted to 'filename' (default: config['mask']['footprint_index'],
+    or 'footprint_index.npz' in the likelihood directory), and rebuilt 
+    only when the mask files change. The mask files are checked once
+    per process. With write=False, an index that is missing or out of
+    date is only built in memory.
     """
-    config = Config(config)
-    nside_catalog    = config['coords']['nside_catalog']
-    nside_likelihood = config['coords']['nside_likelihood']
-    nside_pixel      = config['coords']['nside_pixel']
+    import os
+    if not isinstance(config,Config): config = Config(config)
+    nside_pixel = config['coords']['nside_pixel']
+    if nside is None: nside = config['coords']['nside_likelihood']
+    if nside > nside_pixel:
+        raise Exception('Requested nside=%i is greater than pixel_nside'%nside)
+    if filename is None:
+        filename = config['mask'].get('footprint_index')
+    if filename is None:
+        filename = os.path.join(config['output']['likedir'],'footprint_index.npz')
 
-    if numpy.isscalar(pixels): pixels = numpy.array([pixels])
-    if nside is None: nside = nside_likelihood
+    index = _FOOTPRINT.get(filename)
+    if index is None:
+        filenames = config.getFilenames()
+        fingerprint = _footprintFingerprint(config,filenames)
+        if os.path.exists(filename):
+            reader = numpy.load(filename)
+            index = dict([(k,reader[k]) for k in reader.files])
+            reader.close()
+        if index is None or str(index.get('FINGERPRINT')) != fingerprint:
+            logger.info("Building footprint index %s..."%filename)
+            index = _buildFootprintIndex(config,filenames)
+            index['FINGERPRINT'] = numpy.array(fingerprint)
+            if write: _writeFootprintIndex(filename,index)
+        _FOOTPRINT[filename] = index
 
-    filenames = config.getFilenames()
-    catalog_pixels = filenames['pix'].compressed()
+    key = 'NSIDE_%i'%nside
+    if key not in index:
+        index[key] = numpy.unique(superpixel(index['NSIDE_%i'%nside_pixel],nside_pixel,nside))
+        if write: _writeFootprintIndex(filename,index)
+    return index[key]
 
-    inside = numpy.zeros(len(pixels), dtype=bool)
-    if not nside_catalog:
-        catalog_pix = [0]
-    else:
-        catalog_pix = superpixel(pixels,nside,nside_catalog)
-        catalog_pix = numpy.intersect1d(catalog_pix,catalog_pixels)
+def inFootprint(config, pixels, nside=None):
+    """
+    Determine which pixels contain valid data in both mask files
+    (using the cached footprint index).
+    """
+    if numpy.isscalar(pixels): pixels = numpy.array([pixels])
+    pixels = numpy.asarray(pixels)
 
-    for fnames in filenames[catalog_pix]:
-        logger.debug("Loading %s"%filenames['mask_1'])
-        subpix_1,val_1 = ugali.utils.skymap.readSparseHealpixMap(fnames['mask_1'],'MAGLIM',construct_map=False)
-        logger.debug("Loading %s"%fnames['mask_2'])
-        subpix_2,val_2 = ugali.utils.skymap.readSparseHealpixMap(fnames['mask_2'],'MAGLIM',construct_map=False)
-        subpix = numpy.intersect1d(subpix_1,subpix_2)
-        superpix = numpy.unique(superpixel(subpix,nside_pixel,nside))
-        inside |= numpy.in1d(pixels, superpix)
-        
-    return inside
+    covered = footprintIndex(config,nside)
+    if len(covered) == 0: 
+        return numpy.zeros(len(pixels),dtype=bool)
+    idx = numpy.searchsorted(covered,pixels).clip(0,len(covered)-1)
+    return covered[idx] == pixels
 
 def footprint(config, nside=None):
     """
@@ -148,7 +224,9 @@ def writeSparseHealpixMap(pix, data_dict, nside, outfile,
         hdu_distance_modulus.name = 'DISTANCE_MODULUS'
         hdul.append(hdu_distance_modulus)
 
-    hdul.writeto(outfile, clobber = True)
+    # Write to a temporary file so that readers never see a partial file
+    hdul.writeto(outfile+'.tmp', clobber = True)
+    os.rename(outfile+'.tmp', outfile)
     
 ############################################################
 
@@ -226,91 +304,736 @@ def readSparseHealpixMaps(infiles, field, extension='PIX_DATA', default_value=he
 
 ############################################################
 
+class SparseHealpixMap(object):
+    """
+    HEALPix map (RING ordering) that only stores the covered pixels.
+
+    The pixel indices are kept sorted with the values in the same order
+    (the first dimension of the values matches the pixels). A boolean
+    coverage map at nside_coverage records which coarse pixels contain
+    data, so lookups outside the footprint are rejected without a search.
+
+    Usage:
+    m = SparseHealpixMap.read(infiles,'MAGLIM')
+    maglim = m[roi.pixels]
+    low = m.ud_grade(64)
+    """
+    def __init__(self, nside, pix=None, values=None, 
+                 default_value=healpy.UNSEEN, nside_coverage=32):
+        self.nside = nside
+        self.default_value = default_value
+        self.nside_coverage = min(nside_coverage,nside)
+
+        if pix is None: pix = numpy.zeros(0,dtype='i8')
+        pix = numpy.atleast_1d(numpy.asarray(pix,dtype='i8'))
+        if values is None: values = numpy.zeros(len(pix))
+        values = numpy.asarray(values)
+        if values.ndim == 0: values = numpy.repeat(values,len(pix))
+        if len(values) != len(pix):
+            raise ValueError("Number of values (%i) does not match number of pixels (%i)"%(len(values),len(pix)))
+        self.pix, self.values = self._unique(pix,values)
+        self._coverage = None
+
+    def __repr__(self):
+        return "%s(nside=%i, npix=%i)"%(self.__class__.__name__,self.nside,len(self.pix))
+
+    @staticmethod
+    def _unique(pix, values):
+        """ Sort the pixels; for duplicates, the last value wins. """
+        if len(pix) < 2 or numpy.all(pix[1:] > pix[:-1]):
+            return pix, values
+        order = numpy.argsort(pix,kind='mergesort')
+        pix,values = pix[order],values[order]
+        last = numpy.append(pix[1:] != pix[:-1],True)
+        return pix[last], values[last]
+
+    @staticmethod
+    def _ratio(nside_in, nside_out):
+        """ Number of nside_in pixels per nside_out pixel (or inverse). """
+        return (max(nside_in,nside_out)//min(nside_in,nside_out))**2
+
+    @classmethod
+    def _degrade(cls, pix, nside_in, nside_out):
+        """ Index of the nside_out pixel containing each nside_in pixel. """
+        if nside_in == nside_out: return pix
+        nest = healpy.ring2nest(nside_in,pix)
+        return healpy.nest2ring(nside_out,nest//cls._ratio(nside_in,nside_out))
+
+    @property
+    def npix(self):
+        return healpy.nside2npix(self.nside)
+
+    @property
+    def coverage(self):
+        """ Boolean map of the covered pixels at nside_coverage. """
+        if self._coverage is None:
+            self._coverage = numpy.zeros(healpy.nside2npix(self.nside_coverage),dtype=bool)
+            self._coverage[self._degrade(self.pix,self.nside,self.nside_coverage)] = True
+        return self._coverage
+
+    def __getitem__(self, pix):
+        scalar = numpy.isscalar(pix)
+        pix = numpy.asarray(pix,dtype='i8')
+        shape = pix.shape
+        pix = pix.ravel()
+        dtype = numpy.result_type(self.values.dtype,numpy.asarray(self.default_value).dtype)
+        out = numpy.empty((len(pix),)+self.values.shape[1:],dtype=dtype)
+        out.fill(self.default_value)
+        if len(self.pix) and len(pix):
+            sel = numpy.nonzero(self.coverage[self._degrade(pix,self.nside,self.nside_coverage)])[0]
+            idx = numpy.searchsorted(self.pix,pix[sel]).clip(0,len(self.pix)-1)
+            found = (self.pix[idx] == pix[sel])
+            out[sel[found]] = self.values[idx[found]]
+        return out[0] if scalar else out.reshape(shape+self.values.shape[1:])
+
+    def __setitem__(self, pix, value):
+        pix = numpy.atleast_1d(numpy.asarray(pix,dtype='i8'))
+        values = numpy.empty((len(pix),)+self.values.shape[1:],dtype=self.values.dtype)
+        values[...] = value
+        self.pix,self.values = self._unique(numpy.concatenate([self.pix,pix]),
+                                            numpy.concatenate([self.values,values]))
+        self._coverage = None
+
+    def copy(self):
+        return self.__class__(self.nside,self.pix.copy(),self.values.copy(),
+                              self.default_value,self.nside_coverage)
+
+    def map(self):
+        """ 
+        Full-sky array; vector maps are returned with shape (n, npix)
+        like readSparseHealpixMap.
+        """
+        out = numpy.empty((self.npix,)+self.values.shape[1:])
+        out.fill(self.default_value)
+        out[self.pix] = self.values
+        return out.T if out.ndim > 1 else out
+
+    @classmethod
+    def fromMap(cls, m, default_value=healpy.UNSEEN, **kwargs):
+        """ Sparse map from a full-sky array (vector maps with shape (n, npix)). """
+        m = numpy.asarray(m)
+        values = m.T if m.ndim > 1 else m
+        nside = healpy.npix2nside(len(values))
+        seen = values != default_value
+        if seen.ndim > 1: seen = seen.any(axis=1)
+        pix = numpy.nonzero(seen)[0]
+        return cls(nside,pix,values[pix],default_value,**kwargs)
+
+    def ud_grade(self, nside_out, pess=False):
+        """
+        Change the resolution of the map. Degrading averages the covered
+        sub-pixels (pess: only keep pixels that are fully covered);
+        upgrading copies each value to its sub-pixels.
+        """
+        if nside_out == self.nside or not len(self.pix):
+            out = self.copy()
+            out.nside = nside_out
+            out.nside_coverage = min(self.nside_coverage,nside_out)
+            return out
+        nest = healpy.ring2nest(self.nside,self.pix)
+        ratio = self._ratio(self.nside,nside_out)
+        if nside_out > self.nside:
+            sub = (nest[:,numpy.newaxis]*ratio + numpy.arange(ratio)).ravel()
+            pix = healpy.nest2ring(nside_out,sub)
+            values = numpy.repeat(self.values,ratio,axis=0)
+        else:
+            coarse = nest//ratio
+            order = numpy.argsort(coarse,kind='mergesort')
+            coarse = coarse[order]
+            start = numpy.nonzero(numpy.append(True,coarse[1:] != coarse[:-1]))[0]
+            counts = numpy.diff(numpy.append(start,len(coarse)))
+            sums = numpy.add.reduceat(self.values[order],start,axis=0) if len(start) else self.values[:0]
+            values = sums / counts.reshape((-1,)+(1,)*(sums.ndim-1)).astype(float)
+            pix = healpy.nest2ring(nside_out,coarse[start])
+            if pess:
+                full = counts == ratio
+                pix,values = pix[full],values[full]
+        return self.__class__(nside_out,pix,values,self.default_value,self.nside_coverage)
+
+    def _operate(self, other, op):
+        if isinstance(other,SparseHealpixMap):
+            if other.nside != self.nside:
+                raise ValueError("Maps have different nside: %i, %i"%(self.nside,other.nside))
+            pix = numpy.intersect1d(self.pix,other.pix)
+            a = self.values[numpy.searchsorted(self.pix,pix)]
+            b = other.values[numpy.searchsorted(other.pix,pix)]
+            return self.__class__(self.nside,pix,op(a,b),self.default_value,self.nside_coverage)
+        return self.__class__(self.nside,self.pix,op(self.values,other),
+                              self.default_value,self.nside_coverage)
+
+    def __add__(self, other):  return self._operate(other,lambda a,b: a+b)
+    def __radd__(self, other): return self._operate(other,lambda a,b: b+a)
+    def __sub__(self, other):  return self._operate(other,lambda a,b: a-b)
+    def __rsub__(self, other): return self._operate(other,lambda a,b: b-a)
+    def __mul__(self, other):  return self._operate(other,lambda a,b: a*b)
+    def __rmul__(self, other): return self._operate(other,lambda a,b: b*a)
+    def __div__(self, other):  return self._operate(other,lambda a,b: a/b)
+    def __rdiv__(self, other): return self._operate(other,lambda a,b: b/a)
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+    def __neg__(self): return self._operate(None,lambda a,b: -a)
+
+    @classmethod
+    def read(cls, infiles, field, extension='PIX_DATA', 
+             default_value=healpy.UNSEEN, **kwargs):
+        """
+        Read one field of one or more sparse HEALPix map files
+        (later files take precedence for conflicting pixels).
+        """
+        if isinstance(infiles,basestring): infiles = [infiles]
+        nside = None
+        pix_array, value_array = [], []
+        for ii in range(0, len(infiles)):
+            logger.debug('(%i/%i) %s'%(ii+1, len(infiles), infiles[ii]))
+            reader = pyfits.open(infiles[ii],memmap=False)
+            if nside is None: nside = reader[extension].header['NSIDE']
+            elif reader[extension].header['NSIDE'] != nside:
+                raise Exception("Inconsistent NSIDE in %s"%infiles[ii])
+            pix_array.append(numpy.array(reader[extension].data.field('PIX'),copy=True))
+            value_array.append(numpy.array(reader[extension].data.field(field),copy=True))
+            reader.close()
+
+        pix = numpy.concatenate(pix_array)
+        n_conflicting_pixels = len(pix) - len(numpy.unique(pix))
+        if n_conflicting_pixels != 0:
+            logger.warning('%i conflicting pixels during merge.'%(n_conflicting_pixels))
+        return cls(nside,pix,numpy.concatenate(value_array),default_value,**kwargs)
+
+    def write(self, outfile, field='VALUE', **kwargs):
+        """ Write to a sparse HEALPix map file (see writeSparseHealpixMap). """
+        writeSparseHealpixMap(self.pix,{field:self.values},self.nside,outfile,**kwargs)
+
+############################################################
+
+def _tableFormat(hdu):
+    """ Column definitions (without data) and big-endian row dtype of a table. """
+    columns = [pyfits.Column(name=c.name,format=c.format,dim=c.dim) for c in hdu.columns]
+    dtype = numpy.dtype(hdu.data.dtype.descr).newbyteorder('>')
+    return columns, dtype
+
+def _unionFormat(columns, dtype, hdu):
+    """ Append the columns of a table that are missing from (columns, dtype). """
+    if set(hdu.columns.names) <= set(dtype.names): return columns, dtype
+    cols, dt = _tableFormat(hdu)
+    new = [i for i,c in enumerate(cols) if c.name not in dtype.names]
+    columns = columns + [cols[i] for i in new]
+    dtype = numpy.dtype(dtype.descr + [dt.descr[i] for i in new])
+    return columns, dtype
+
+def _streamingTable(outfile, columns, nrows, nside, extname='PIX_DATA'):
+    """ Open a sparse map table of nrows rows to be written in chunks. """
+    hdu = pyfits.new_table(columns,nrows=1)
+    header = hdu.header
+    header.update('NAXIS2', nrows)
+    header.update('EXTNAME', extname)
+    header.update('NSIDE', nside)
+    header.update('COORDSYS', 'NULL')
+    header.update('ORDERING', 'NULL')
+    if os.path.exists(outfile): os.remove(outfile)
+    return pyfits.StreamingHDU(outfile,header)
+
+def _copyRows(writer, data, dtype, start, stop, nchunk):
+    """ 
+    Copy rows [start, stop) of a table to the stream in chunks of nchunk
+    rows. Columns missing from the table (e.g., INTERPOLATED) are zero.
+    """
+    names = data.names
+    for lo in range(start, stop, nchunk):
+        hi = min(lo+nchunk, stop)
+        chunk = numpy.empty(hi-lo, dtype=dtype)
+        for key in dtype.names:
+            chunk[key] = data.field(key)[lo:hi] if key in names else 0
+        writer.write(chunk.view('u1'))
+
+def _appendDistanceModulus(outfile, distance_modulus_array):
+    hdu_distance_modulus = pyfits.new_table([pyfits.Column(name = 'DISTANCE_MODULUS',
+                                                           format = 'E',
+                                                           array = distance_modulus_array)])
+    hdu_distance_modulus.name = 'DISTANCE_MODULUS'
+    hdul = pyfits.open(outfile, mode='append')
+    hdul.append(hdu_distance_modulus)
+    hdul.close()
+
 def mergeSparseHealpixMaps(infiles, outfile=None,
                            pix_data_extension='PIX_DATA',
                            pix_field='PIX',
                            distance_modulus_extension='DISTANCE_MODULUS',
                            distance_modulus_field='DISTANCE_MODULUS',
-                           default_value=healpy.UNSEEN):
+                           default_value=healpy.UNSEEN,
+                           buffer_size=64*1024**2):
     """
-    Use the first infile to determine the basic contents to expect for the other files.
+    Use the first infile to determine the basic contents to expect for
+    the other files. Columns that are only present in some of the files
+    are filled with zero in the others.
+
+    If an outfile is given, the pixel table is streamed to it: the
+    data of each infile is read once and copied in chunks of at most 
+    buffer_size bytes, so neither the merged map nor a full-sky array
+    is held in memory. Otherwise the merged columns are returned.
     """
     # Setup
     if isinstance(infiles,basestring): infiles = [infiles]
     
-    distance_modulus_array = None
-    pix_array = []
-    data_dict = {}
-
     reader = pyfits.open(infiles[0])
     nside = reader[pix_data_extension].header['NSIDE']
-
-    for ii in range(0, len(reader)):
-        if reader[ii].name == distance_modulus_extension:
-            distance_modulus_array = reader[distance_modulus_extension].data.field(distance_modulus_field)
-
-    for key in reader[pix_data_extension].data.names:
-        if key == pix_field:
-            continue
-        data_dict[key] = []
-        #if distance_modulus_array is None:
-        #    data_dict[key] = default_value * numpy.ones(healpy.nside2npix(nside))
-        #else:
-        #    data_dict[key] = default_value * numpy.ones([len(distance_modulus_array),
-        #                                                 healpy.nside2npix(nside)])
+    columns, dtype = _tableFormat(reader[pix_data_extension])
+    distance_modulus_array = None
+    if distance_modulus_extension in [hdu.name for hdu in reader]:
+        distance_modulus_array = numpy.array(reader[distance_modulus_extension].data.field(distance_modulus_field),copy=True)
     reader.close()
 
-    # Now loop over the infiles
-
+    # Check the headers and distance moduli before reading any data
+    selected = []
+    nrows = 0
     for ii in range(0, len(infiles)):
-        logger.debug('(%i/%i) %s'%(ii+1, len(infiles), infiles[ii]))
-
         reader = pyfits.open(infiles[ii])
-        distance_modulus_array_current = numpy.array(reader[distance_modulus_extension].data.field(distance_modulus_field),copy=True)
-        if not numpy.array_equal(distance_modulus_array_current,distance_modulus_array):
-            logger.warning("Distance moduli do not match; skipping...")
-            continue
+        if distance_modulus_array is not None:
+            distance_modulus_array_current = reader[distance_modulus_extension].data.field(distance_modulus_field)
+            if not numpy.array_equal(distance_modulus_array_current,distance_modulus_array):
+                logger.warning("Distance moduli do not match; skipping %s..."%infiles[ii])
+                reader.close()
+                continue
+        selected.append(infiles[ii])
+        nrows += reader[pix_data_extension].header['NAXIS2']
+        columns, dtype = _unionFormat(columns,dtype,reader[pix_data_extension])
         reader.close()
 
-        pix_array_current = readSparseHealpixMap(infiles[ii], pix_field,
-                                                 extension=pix_data_extension, construct_map=False)[0]
-        pix_array.append(pix_array_current)
+    if outfile is not None:
+        writer = _streamingTable(outfile,columns,nrows,nside,pix_data_extension)
+    else:
+        data_dict = dict([(key,[]) for key in dtype.names if key != pix_field])
 
-        for key in data_dict.keys():
-            value_array_current = readSparseHealpixMap(infiles[ii], key,
-                                                       extension=pix_data_extension, construct_map=False)[1]
-            data_dict[key].append(value_array_current)
-            #if distance_modulus_array is None:
-            #    data_dict[key][pix_array_current] = value
-            #else:
-            #    for jj in range(0, len(distance_modulus_array)):
-            #        data_dict[key][jj] = value[jj]
+    nchunk = max(int(buffer_size) // dtype.itemsize, 1)
+    pix_array = []
+    for ii in range(0, len(selected)):
+        logger.debug('(%i/%i) %s'%(ii+1, len(selected), selected[ii]))
+        reader = pyfits.open(selected[ii])
+        data = reader[pix_data_extension].data
+        nrows_current = reader[pix_data_extension].header['NAXIS2']
+        pix_array.append(numpy.array(data.field(pix_field),copy=True))
 
+        if outfile is None:
+            for key in data_dict.keys():
+                if key in data.names:
+                    data_dict[key].append(numpy.array(data.field(key),copy=True))
+                else:
+                    shape = (nrows_current,)+dtype[key].shape
+                    data_dict[key].append(numpy.zeros(shape,dtype=dtype[key].base))
+        else:
+            _copyRows(writer,data,dtype,0,nrows_current,nchunk)
+        reader.close()
+        del data
         gc.collect()
 
-    pix_master = numpy.concatenate(pix_array)
+    pix_master = numpy.concatenate(pix_array) if pix_array else numpy.zeros(0,dtype=int)
     n_conflicting_pixels = len(pix_master) - len(numpy.unique(pix_master)) 
     if n_conflicting_pixels != 0:
         logger.warning('%i conflicting pixels during merge.'%(n_conflicting_pixels))
 
-    for key in data_dict.keys():
-        if distance_modulus_array is not None:
-            data_dict[key] = numpy.concatenate(data_dict[key], axis=1).transpose()
-        else:
+    if outfile is None:
+        for key in data_dict.keys():
             data_dict[key] = numpy.concatenate(data_dict[key])
+        return data_dict
 
-    if outfile is not None:
-        writeSparseHealpixMap(pix_master, data_dict, nside, outfile,
-                              distance_modulus_array=distance_modulus_array,
-                              coordsys='NULL', ordering='NULL')
+    writer.close()
+    if distance_modulus_array is not None:
+        _appendDistanceModulus(outfile,distance_modulus_array)
+
+
+############################################################
+
+def writeCompactHealpixMap(pix, data_dict, nside, outfile,
+                           distance_modulus_array = None,
+                           header_dict = None):
+    """
+    Write a sparse HEALPix map in a compact binary format (numpy
+    '.npz'). The content mirrors writeSparseHealpixMap: the 'PIX'
+    array, one float32 array per data column (first dimension matching
+    the pixels), the distance modulus array, and the header values.
+    """
+    header = dict(header_dict) if header_dict is not None else dict()
+    header['NSIDE'] = nside
+
+    out = dict()
+    out['PIX'] = numpy.asarray(pix,dtype='i8')
+    for key,value in data_dict.items():
+        if value.shape[0] != len(pix):
+            logger.warning('First dimension of column %s (%i) does not match number of pixels (%i).'%(key,value.shape[0],len(pix)))
+        out['DATA_%s'%key] = numpy.asarray(value,dtype='f4')
+    strings = sorted((k,v) for k,v in header.items() if isinstance(v,basestring))
+    numbers = sorted((k,v) for k,v in header.items() if not isinstance(v,basestring))
+    out['HEADER'] = numpy.array(numbers,dtype=[('KEY','S8'),('VALUE','f8')])
+    out['HEADER_STR'] = numpy.array(strings,dtype=[('KEY','S8'),('VALUE','S68')])
+    if distance_modulus_array is not None:
+        out['DISTANCE_MODULUS'] = numpy.asarray(distance_modulus_array,dtype='f4')
+
+    # Write to a temporary file so that readers never see a partial file
+    writer = open(outfile+'.tmp','wb')
+    numpy.savez(writer,**out)
+    writer.close()
+    os.rename(outfile+'.tmp',outfile)
+
+def readCompactHealpixMap(infile):
+    """
+    Read a compact sparse HEALPix map written by writeCompactHealpixMap.
+
+    Returns:
+    pix, data_dict, header_dict, distance_modulus_array
+    """
+    reader = numpy.load(infile)
+    pix = reader['PIX']
+    data_dict = dict([(key[5:],reader[key]) for key in reader.files 
+                      if key.startswith('DATA_')])
+    header_dict = dict()
+    for key,value in reader['HEADER']:
+        header_dict[key] = int(value) if value == int(value) else value
+    if 'HEADER_STR' in reader.files:
+        header_dict.update([(key,str(value)) for key,value in reader['HEADER_STR']])
+    if 'DISTANCE_MODULUS' in reader.files:
+        distance_modulus_array = reader['DISTANCE_MODULUS']
     else:
-        return data_dict
+        distance_modulus_array = None
+    reader.close()
+    return pix, data_dict, header_dict, distance_modulus_array
 
+def likelihoodFiles(likefile):
+    """
+    Existing likelihood files matching the 'likefile' template
+    (e.g., 'likedir/likelihood_%08i_%s.fits'). Checkpoints, temporary
+    files, and anything else sharing the prefix are excluded.
+    """
+    fields = re.compile(r'%[-+ #0]*\d*([ids])')
+    regex,last = '',0
+    for match in fields.finditer(likefile):
+        regex += re.escape(likefile[last:match.start()])
+        regex += r'\d+' if match.group(1) in 'id' else r'[A-Za-z]+'
+        last = match.end()
+    regex = re.compile(regex + re.escape(likefile[last:]) + '$')
+    infiles = glob.glob(fields.sub('*',likefile))
+    return sorted(f for f in infiles if regex.match(f))
+
+def readLikelihoodFile(infile, 
+                       pix_data_extension='PIX_DATA',
+                       distance_modulus_extension='DISTANCE_MODULUS'):
+    """
+    Read all columns of a likelihood file (FITS or compact) at once.
+
+    Returns:
+    pix, data_dict, header_dict, distance_modulus_array
+    """
+    if infile.endswith('.npz'):
+        return readCompactHealpixMap(infile)
+
+    reader = pyfits.open(infile,memmap=False)
+    hdu = reader[pix_data_extension]
+    pix = numpy.array(hdu.data.field('PIX'),copy=True)
+    data_dict = dict([(key,numpy.array(hdu.data.field(key),copy=True))
+                      for key in hdu.data.names if key != 'PIX'])
+    header_dict = dict([(key,hdu.header[key]) for key in 
+                        ['NSIDE','STELLAR','LKDNSIDE','LKDPIX','NROI','NANNULUS','NINSIDE','NTARGET','SCANHASH','STATHASH','RUNTIME']
+                        if key in hdu.header])
+    distance_modulus_array = None
+    if distance_modulus_extension in [h.name for h in reader]:
+        distance_modulus_array = numpy.array(reader[distance_modulus_extension].data.field('DISTANCE_MODULUS'),copy=True)
+    reader.close()
+    return pix, data_dict, header_dict, distance_modulus_array
 
 ############################################################
 
-def mergeLikelihoodFiles(infiles, lkhdfile, roifile):
-    mergeSparseHealpixMaps(infiles,lkhdfile)
+class LikelihoodMerger(object):
+    """
+    Incremental, append-only merge of likelihood scan files.
+
+    Each input file is read once and its rows are appended to
+    preallocated, memory-mapped arrays in 'outdir'. A log of the merged
+    files (with their size, modification time, and ROI header values)
+    is kept alongside, so that the merge can be resumed and new files
+    added as the scan jobs finish. A file that has changed since it was
+    merged is appended again and supersedes its earlier rows.
+
+    Usage:
+    merger = LikelihoodMerger('likelihood/merge')
+    merger.add(glob.glob('likelihood/likelihood_*'))
+    merger.write(mergefile,roifile)
+    """
+    logname = 'merged.log'
+    dmname  = 'DISTANCE_MODULUS.npy'
+
+    def __init__(self, outdir, size=0):
+        """
+        Parameters:
+          outdir : Directory holding the partial merge
+          size   : Initial number of rows to preallocate
+        """
+        import os
+        if not os.path.exists(outdir): os.makedirs(outdir)
+        self.outdir = outdir
+        self.size = size
+        self.logfile = os.path.join(outdir,self.logname)
+
+        self.records = []
+        if os.path.exists(self.logfile):
+            self.records = [json.loads(l) for l in open(self.logfile) if l.strip()]
+        self.nrows = sum(r['nrows'] for r in self.records)
+
+        self.distance_modulus_array = None
+        dmfile = os.path.join(outdir,self.dmname)
+        if os.path.exists(dmfile):
+            self.distance_modulus_array = numpy.load(dmfile)
+
+        self.arrays = dict()
+        for filename in glob.glob(os.path.join(outdir,'*.npy')):
+            key = os.path.basename(filename)[:-4]
+            if filename == dmfile: continue
+            self.arrays[key] = numpy.lib.format.open_memmap(filename,mode='r+')
+
+    def __len__(self):
+        return self.nrows
+
+    @property
+    def merged(self):
+        return set(r['file'] for r in self.records)
+
+    @property
+    def active(self):
+        """ The latest record of each merged file. """
+        latest = dict((r['file'],i) for i,r in enumerate(self.records))
+        return [r for i,r in enumerate(self.records) if latest[r['file']] == i]
+
+    def _rows(self):
+        """ Index of the rows belonging to the active records. """
+        latest = dict((r['file'],i) for i,r in enumerate(self.records))
+        offsets = numpy.cumsum([0]+[r['nrows'] for r in self.records])
+        if len(latest) == len(self.records):
+            return slice(0,self.nrows)
+        return numpy.concatenate([numpy.arange(offsets[i],offsets[i+1]) 
+                                  for i in sorted(latest.values())])
+
+    @staticmethod
+    def _stat(infile):
+        stat = os.stat(infile)
+        return stat.st_size, stat.st_mtime
+
+    def _filename(self, key):
+        import os
+        return os.path.join(self.outdir,'%s.npy'%key)
+
+    def _create(self, pix, data_dict, distance_modulus_array, size):
+        if distance_modulus_array is not None:
+            self.distance_modulus_array = numpy.asarray(distance_modulus_array)
+            numpy.save(self._filename('DISTANCE_MODULUS'),self.distance_modulus_array)
+        columns = dict(data_dict,PIX=pix)
+        for key,value in columns.items():
+            dtype = 'i8' if key == 'PIX' else 'f4'
+            shape = (size,) + value.shape[1:]
+            self.arrays[key] = numpy.lib.format.open_memmap(self._filename(key),mode='w+',
+                                                            dtype=dtype,shape=shape)
+
+    def _reserve(self, nrows):
+        """ Grow the output arrays to hold at least nrows. """
+        import os
+        size = len(self.arrays['PIX'])
+        if nrows <= size: return
+        size = max(nrows,2*size)
+        logger.debug("Resizing merge arrays to %i rows..."%size)
+        for key,array in self.arrays.items():
+            filename = self._filename(key)
+            tmp = numpy.lib.format.open_memmap(filename+'.tmp',mode='w+',dtype=array.dtype,
+                                               shape=(size,)+array.shape[1:])
+            tmp[:self.nrows] = array[:self.nrows]
+            tmp.flush()
+            del tmp, array
+            os.rename(filename+'.tmp',filename)
+            self.arrays[key] = numpy.lib.format.open_memmap(filename,mode='r+')
+
+    def add(self, infiles):
+        """
+        Append the files that have not been merged yet, or that have
+        changed (size or modification time) since they were merged.
+
+        Returns:
+        nfiles : Number of files added
+        """
+        if isinstance(infiles,basestring): infiles = [infiles]
+        merged = dict((r['file'],(r.get('size'),r.get('mtime'))) for r in self.records)
+        infiles = [f for f in infiles if merged.get(f) != self._stat(f)]
+        for ii,infile in enumerate(infiles):
+            logger.debug('(%i/%i) %s'%(ii+1, len(infiles), infile))
+            self.append(infile)
+        return len(infiles)
+
+    def append(self, infile):
+        """ Append a single file. """
+        size, mtime = self._stat(infile)
+        if infile in self.merged:
+            logger.info("Re-merging changed file %s..."%infile)
+        pix, data_dict, header_dict, distance_modulus_array = readLikelihoodFile(infile)
+
+        if not self.arrays:
+            self._create(pix,data_dict,distance_modulus_array,max(self.size,len(pix)))
+        elif not numpy.array_equal(distance_modulus_array,self.distance_modulus_array):
+            logger.warning("Distance moduli do not match; skipping...")
+            return
+
+        start,stop = self.nrows, self.nrows+len(pix)
+        self._reserve(stop)
+        for key,value in data_dict.items():
+            if key in self.arrays: continue
+            # A column missing from the files merged so far
+            logger.debug("Adding column %s..."%key)
+            shape = (len(self.arrays['PIX']),) + value.shape[1:]
+            self.arrays[key] = numpy.lib.format.open_memmap(self._filename(key),mode='w+',
+                                                            dtype='f4',shape=shape)
+            self.arrays[key][:start] = 0
+        self.arrays['PIX'][start:stop] = pix
+        for key,array in self.arrays.items():
+            if key == 'PIX': continue
+            # Columns missing from this file are zero
+            array[start:stop] = data_dict[key] if key in data_dict else 0
+            array.flush()
+        self.arrays['PIX'].flush()
+
+        # Only record the file once its data has been written
+        record = dict(file=infile,nrows=len(pix),size=size,mtime=mtime,
+                      header=header_dict)
+        out = open(self.logfile,'a')
+        out.write(json.dumps(record)+'\n')
+        out.close()
+        self.records.append(record)
+        self.nrows = stop
+
+    def write(self, lkhdfile, roifile=None):
+        """
+        Write the merged likelihood (and ROI) files.
+        """
+        if not self.records:
+            logger.warning("No files merged.")
+            return
+
+        rows = self._rows()
+        pix = self.arrays['PIX'][rows]
+        n_conflicting_pixels = len(pix) - len(numpy.unique(pix)) 
+        if n_conflicting_pixels != 0:
+            logger.warning('%i conflicting pixels during merge.'%(n_conflicting_pixels))
+
+        data_dict = dict([(k,v[rows]) for k,v in self.arrays.items() if k != 'PIX'])
+        nside = self.records[0]['header']['NSIDE']
+        writeSparseHealpixMap(pix, data_dict, nside, lkhdfile,
+                              distance_modulus_array=self.distance_modulus_array,
+                              coordsys='NULL', ordering='NULL')
+
+        if roifile is None: return
+        headers = [r['header'] for r in self.active]
+        pix_array = numpy.array([h['LKDPIX'] for h in headers])
+        data_dict = dict([(k,numpy.array([h[k] for h in headers])) 
+                          for k in ['STELLAR','NINSIDE','NANNULUS']])
+        writeSparseHealpixMap(pix_array, data_dict, headers[0]['LKDNSIDE'], roifile)
+
+############################################################
+
+def _likelihoodHeader(infile):
+    """ Row count, ROI values, and distance moduli of a likelihood file. """
+    reader = pyfits.open(infile)
+    header = reader['PIX_DATA'].header
+    out = dict([(k,header[k]) for k in ['NAXIS2','NSIDE','LKDNSIDE','LKDPIX','STELLAR','NINSIDE','NANNULUS']])
+    out['DISTANCE_MODULUS'] = numpy.array(reader['DISTANCE_MODULUS'].data.field('DISTANCE_MODULUS'),copy=True)
+    reader.close()
+    return out
+
+def _mergePartition(args):
+    infiles, outfile, buffer_size = args
+    mergeSparseHealpixMaps(infiles,outfile,buffer_size=buffer_size)
+    return outfile
+
+def mergeLikelihoodFilesParallel(infiles, lkhdfile, roifile, nproc=2,
+                                 partition_size=1000, buffer_size=64*1024**2):
+    """
+    Merge likelihood files with a pool of nproc processes. The files
+    are grouped by sky region into partitions of at most partition_size
+    files; each partition is merged into an intermediate sparse map,
+    and the partitions are then combined with a k-way merge on the input
+    order. The output is identical to the serial merge.
+    """
+    import multiprocessing, tempfile, shutil, heapq
+    ext = 'PIX_DATA'
+
+    pool = multiprocessing.Pool(nproc)
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(lkhdfile)))
+    try:
+        chunksize = max(len(infiles)//(4*nproc),1)
+        headers = pool.map(_likelihoodHeader,infiles,chunksize)
+
+        distance_modulus_array = headers[0]['DISTANCE_MODULUS']
+        selected = []
+        for ii,header in enumerate(headers):
+            if not numpy.array_equal(header['DISTANCE_MODULUS'],distance_modulus_array):
+                logger.warning("Distance moduli do not match; skipping %s..."%infiles[ii])
+                continue
+            selected.append(ii)
+        selected = numpy.array(selected,dtype=int)
+
+        lkdpix = numpy.array([headers[ii]['LKDPIX'] for ii in selected])
+        if len(lkdpix) != len(numpy.unique(lkdpix)):
+            logger.warning('%i duplicate likelihood pixels during merge.'%(len(lkdpix)-len(numpy.unique(lkdpix))))
+
+        # Partition by sky region; each partition keeps the input order
+        lkdnside = headers[0]['LKDNSIDE']
+        region = superpixel(lkdpix,lkdnside,min(lkdnside,8))
+        ordered = selected[numpy.lexsort((selected,region))]
+        partitions = [numpy.sort(ordered[i:i+partition_size]) 
+                      for i in range(0,len(ordered),partition_size)]
+        outfiles = [os.path.join(tmpdir,'partition_%05i.fits'%k) for k in range(len(partitions))]
+        logger.info("Merging %i files in %i partitions..."%(len(selected),len(partitions)))
+        args = [([infiles[ii] for ii in p],outfile,buffer_size) for p,outfile in zip(partitions,outfiles)]
+        pool.map(_mergePartition,args,1)
+        pool.close()
+
+        # k-way merge of the partitions on the input file index
+        readers = [pyfits.open(outfile) for outfile in outfiles]
+        columns, dtype = _tableFormat(readers[0][ext])
+        for reader in readers[1:]:
+            columns, dtype = _unionFormat(columns,dtype,reader[ext])
+        nside = readers[0][ext].header['NSIDE']
+        nrows = sum(headers[ii]['NAXIS2'] for ii in selected)
+        nchunk = max(int(buffer_size) // dtype.itemsize, 1)
+        writer = _streamingTable(lkhdfile,columns,nrows,nside,ext)
+        streams = [[(ii,k,headers[ii]['NAXIS2']) for ii in p] for k,p in enumerate(partitions)]
+        offset = [0]*len(partitions)
+        for ii,k,n in heapq.merge(*streams):
+            _copyRows(writer,readers[k][ext].data,dtype,offset[k],offset[k]+n,nchunk)
+            offset[k] += n
+        writer.close()
+        for reader in readers: reader.close()
+        _appendDistanceModulus(lkhdfile,distance_modulus_array)
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(tmpdir)
+
+    pix_array = numpy.array([h['LKDPIX'] for h in headers])
+    data_dict = dict([(k,numpy.array([h[k] for h in headers])) 
+                      for k in ['STELLAR','NINSIDE','NANNULUS']])
+    writeSparseHealpixMap(pix_array, data_dict, lkdnside, roifile)
+
+def mergeLikelihoodFiles(infiles, lkhdfile, roifile, buffer_size=64*1024**2, 
+                         nproc=1, partition_size=1000):
+    if nproc > 1 and len(infiles) > 1 and not numpy.any([f.endswith('.npz') for f in infiles]):
+        return mergeLikelihoodFilesParallel(infiles,lkhdfile,roifile,nproc,
+                                            partition_size,buffer_size)
+
+    if numpy.any([f.endswith('.npz') for f in infiles]):
+        # Compact files are merged in a single pass
+        import tempfile, shutil
+        tmpdir = tempfile.mkdtemp()
+        try:
+            merger = LikelihoodMerger(tmpdir)
+            merger.add(infiles)
+            merger.write(lkhdfile,roifile)
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    mergeSparseHealpixMaps(infiles,lkhdfile,buffer_size=buffer_size)
 
     ext='PIX_DATA'
     keys=['STELLAR','NINSIDE','NANNULUS']
@@ -320,10 +1043,10 @@ def mergeLikelihoodFiles(infiles, lkhdfile, roifile):
     data_dict = dict([(k,[]) for k in keys])
     for ii in range(0, len(infiles)):
         logger.debug('(%i/%i) %s'%(ii+1, len(infiles), infiles[ii]))
-        reader = pyfits.open(infiles[ii])
-        pix_array.append(reader[ext].header['LKDPIX'])
+        header = pyfits.getheader(infiles[ii],ext)
+        pix_array.append(header['LKDPIX'])
         for key in data_dict.keys():
-            data_dict[key].append(reader[ext].header[key])
+            data_dict[key].append(header[key])
         
     pix_array = numpy.array(pix_array)
     for key in data_dict.keys():
@@ -2,6 +2,7 @@
 import numpy
 import numpy as np
 import scipy.special
+import scipy.stats
 
 _alpha = 0.32
 
@@ -41,20 +42,61 @@ def kde_peak(data, samples=1000):
     """
     return kde(data,samples)[0]
 
-def kde(data, samples=1000):
+def kde(data, samples=1000, exact=False):
     """
     Identify peak using Gaussian kernel density estimator.
+
+    By default the density comes from the binned estimate (binned_kde),
+    which agrees with scipy.stats.gaussian_kde to within 1e-2 (relative)
+    and places the peak within two evaluation steps (range/samples) of it.
+    Set `exact` to evaluate gaussian_kde directly (O(N x samples)).
     """
     # Clipping of severe outliers to concentrate more KDE samples in the parameter range of interest
     mad = np.median(np.fabs(np.median(data) - data))
     cut = (data > np.median(data) - 5. * mad) & (data < np.median(data) + 5. * mad)
     x = data[cut]
-    kde = scipy.stats.gaussian_kde(x)
     # No penalty for using a finer sampling for KDE evaluation except computation time
     values = np.linspace(np.min(x), np.max(x), samples) 
-    kde_values = kde.evaluate(values)
-    peak = values[np.argmax(kde_values)]
-    return values[np.argmax(kde_values)], kde.evaluate(peak)
+    if exact:
+        kde_values = scipy.stats.gaussian_kde(x).evaluate(values)
+    else:
+        grid,density = binned_kde(x)
+        kde_values = np.interp(values,grid,density)
+    idx = np.argmax(kde_values)
+    return values[idx], kde_values[[idx]]
+
+def binned_kde(data, bins=4096):
+    """
+    Gaussian kernel density estimate on a regular grid spanning the
+    data. The data are linearly binned and convolved with the kernel
+    using FFTs, so the cost is O(N + bins log(bins)). The bandwidth
+    follows Scott's rule, as in scipy.stats.gaussian_kde.
+
+    Returns the grid and the density at each grid point.
+    """
+    x = np.asarray(data,dtype=float).ravel()
+    n = len(x)
+    bw = np.std(x,ddof=1) * n**(-1./5)
+    if not bw > 0:
+        raise ValueError('Zero bandwidth for kernel density estimate')
+
+    grid = np.linspace(x.min(),x.max(),bins)
+    dx = grid[1] - grid[0]
+
+    # Linear binning: split each entry between its two grid points
+    t = (x - grid[0])/dx
+    i = np.floor(t).astype(int).clip(0,bins-2)
+    w = t - i
+    counts = np.bincount(i,weights=1-w,minlength=bins)
+    counts += np.bincount(i+1,weights=w,minlength=bins)
+
+    # Gaussian kernel sampled out to 5 sigma; zero-padded (linear) convolution
+    m = int(np.ceil(5*bw/dx))
+    kernel = np.exp(-0.5*(np.arange(-m,m+1)*dx/bw)**2)
+    nfft = 2**int(np.ceil(np.log2(bins+2*m+1)))
+    conv = np.fft.irfft(np.fft.rfft(counts,nfft)*np.fft.rfft(kernel,nfft),nfft)
+    density = conv[m:m+bins].clip(0,None)/(n*bw*np.sqrt(2*np.pi))
+    return grid, density
 
 
 def peak_interval(data, alpha=_alpha, samples=1000):
@@ -94,6 +136,40 @@ def min_interval(data, alpha=_alpha):
     return interval(mean,lo,hi)
 
 
+def autocorr_function(x):
+    """
+    Normalized autocorrelation function along the last axis (FFT).
+    """
+    x = np.atleast_1d(x)
+    n = x.shape[-1]
+    nfft = 2**int(np.ceil(np.log2(2*n)))
+    dx = x - x.mean(axis=-1)[...,np.newaxis]
+    f = np.fft.rfft(dx,n=nfft,axis=-1)
+    acf = np.fft.irfft(f*np.conjugate(f),n=nfft,axis=-1)[...,:n]
+    return acf/acf[...,:1]
+
+def autocorr_time(chain, c=5.0):
+    """
+    Integrated autocorrelation time (steps) of an ensemble chain with
+    shape (nwalkers, nsteps). The autocorrelation function is averaged
+    over walkers and summed within the automated window of Sokal (1989):
+    the smallest M with M >= c * tau(M).
+    """
+    chain = np.atleast_2d(chain)
+    acf = autocorr_function(chain).mean(axis=0)
+    taus = 2.0*np.cumsum(acf) - 1.0
+    window = np.arange(len(taus)) >= c*taus
+    m = np.argmax(window) if window.any() else len(taus) - 1
+    return taus[m]
+
+def effective_sample_size(chain, tau=None):
+    """
+    Number of independent samples in an ensemble chain.
+    """
+    chain = np.atleast_2d(chain)
+    if tau is None: tau = autocorr_time(chain)
+    return chain.size/tau
+
 def norm_cdf(x):
     # Faster than scipy.stats.norm.cdf
     #https://en.wikipedia.org.wiki/Normal_distribution